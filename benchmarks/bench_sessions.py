@@ -0,0 +1,71 @@
+"""
+Đo chi phí khởi tạo cho mỗi lần gọi downloader (không tính thời gian trích xuất).
+
+- before: dò ffmpeg + tạo YoutubeDL mới + đóng (cách làm cũ cho mỗi request)
+- after:  option với ffmpeg đã dò sẵn + lấy/trả phiên từ SessionPool
+
+Chạy: PYTHONPATH=src python benchmarks/bench_sessions.py [số lần lặp]
+"""
+import sys
+import json
+import math
+import time
+import yt_dlp
+
+from TiktokCrawler import downloader
+
+
+def _measure(func, iterations: int) -> dict:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+
+    def percentile(q):
+        # Hạng gần nhất (nearest-rank)
+        return timings[min(len(timings) - 1, max(0, math.ceil(q * len(timings)) - 1))]
+
+    return {
+        'iterations': iterations,
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 3),
+        'p50_ms': round(percentile(0.50) * 1000, 3),
+        'p95_ms': round(percentile(0.95) * 1000, 3),
+    }
+
+
+def before():
+    ffmpeg_path = downloader.get_ffmpeg_path()
+    opts = downloader._get_ydl_opts(proxy=None, download=True)
+    opts['ffmpeg_location'] = ffmpeg_path
+    with yt_dlp.YoutubeDL(opts):
+        pass
+
+
+def after():
+    opts = downloader._get_ydl_opts(proxy=None, download=True)
+    with downloader._session_pool.session(opts):
+        pass
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    if not downloader.warm_up():
+        sys.exit("Cần cài đặt ffmpeg để chạy benchmark")
+
+    # Lần gọi đầu tiên nạp module extractor, không tính vào kết quả
+    before()
+    after()
+
+    report = {
+        'before': _measure(before, iterations),
+        'after': _measure(after, iterations),
+        'sessions': downloader.get_session_stats(),
+    }
+    report['speedup'] = round(report['before']['mean_ms'] / max(report['after']['mean_ms'], 1e-6), 1)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
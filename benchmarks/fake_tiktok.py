@@ -0,0 +1,254 @@
+"""
+TikTok giả lập chạy trên máy (không cần mạng) dùng cho benchmark.
+
+- Server HTTP cục bộ phục vụ trang video (JSON), danh sách video của profile theo trang
+  (cursor như API TikTok) và file MP4.
+- Extractor yt-dlp tương ứng (FakeTikTokIE, FakeTikTokUserIE) gọi server qua HTTP như extractor
+  thật, nên đo được cả chi phí request trích xuất lẫn tải media.
+
+URL dạng: http://127.0.0.1:<port>/tiktok.com/@<user>/video/<id> và http://127.0.0.1:<port>/tiktok.com/@<user>
+(có "tiktok.com" để qua bước kiểm tra URL của downloader).
+"""
+import os
+import json
+import time
+import shutil
+import subprocess
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from yt_dlp.extractor.common import InfoExtractor
+
+# Số video mỗi trang danh sách (giống API TikTok)
+PAGE_SIZE = 30
+
+
+def sample_mp4(ffmpeg_path: str) -> bytes:
+    """
+    Tạo video MP4 thật 2 giây bằng ffmpeg (để bước hậu xử lý ffmpeg chạy như với video thật).
+
+    Returns:
+        bytes: Nội dung file, None nếu ffmpeg không tạo được
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="fake-tiktok-")
+    path = os.path.join(tmp_dir, "sample.mp4")
+    try:
+        subprocess.run(
+            [ffmpeg_path, '-v', 'error', '-y', '-f', 'lavfi', '-i', 'testsrc=duration=2:size=540x960:rate=30',
+             '-f', 'lavfi', '-i', 'sine=duration=2', '-c:v', 'mpeg4', '-c:a', 'aac', '-shortest', path],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60
+        )
+        with open(path, 'rb') as f:
+            return f.read() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def synthetic_mp4(size: int) -> bytes:
+    """Dữ liệu giả có header MP4 (đủ để đo tải/ghi file, không xử lý được bằng ffmpeg)"""
+    header = b'\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom'
+    return header + b'\x00' * max(0, size - len(header))
+
+
+class FakeTikTok:
+    """Server HTTP giả lập TikTok, chạy trong thread nền"""
+
+    def __init__(self, payload: bytes, latency: float = 0.0, host: str = '127.0.0.1', port: int = 0):
+        self.payload = payload
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def video_url(self, user: str, video_id) -> str:
+        return f"{self.base_url}/tiktok.com/@{user}/video/{video_id}"
+
+    def user_url(self, videos: int, suffix: str = "") -> str:
+        # Số video của profile nằm trong tên user: bench-<số video>[-<hậu tố>]
+        user = f"bench-{videos}" + (f"-{suffix}" if suffix else "")
+        return f"{self.base_url}/tiktok.com/@{user}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with fake._lock:
+                    fake.requests += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                parts = urlsplit(self.path)
+                segments = [s for s in parts.path.split('/') if s]
+                try:
+                    if segments[:1] == ['api'] and len(segments) == 3 and segments[1] == 'user':
+                        self._send_json(fake._user_page(segments[2], parse_qs(parts.query)))
+                    elif segments[:1] == ['api'] and len(segments) == 3 and segments[1] == 'video':
+                        self._send_json(fake._video(segments[2]))
+                    elif segments[:1] == ['media']:
+                        self._send_media()
+                    else:
+                        self._send(404, b'not found', 'text/plain')
+                except (ValueError, IndexError):
+                    self._send(400, b'bad request', 'text/plain')
+
+            def _send(self, status, body, content_type, headers=None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_json(self, data):
+                self._send(200, json.dumps(data).encode(), 'application/json')
+
+            def _send_media(self):
+                payload = fake.payload
+                start = 0
+                status = 200
+                headers = {'Accept-Ranges': 'bytes'}
+                range_header = self.headers.get('Range')
+                if range_header and range_header.startswith('bytes='):
+                    start = int(range_header[6:].split('-')[0] or 0)
+                    status = 206
+                    headers['Content-Range'] = f"bytes {start}-{len(payload) - 1}/{len(payload)}"
+                self._send(status, payload[start:], 'video/mp4', headers)
+
+        return Handler
+
+    @staticmethod
+    def _profile_size(user: str) -> int:
+        # bench-<số video>[-<hậu tố>]
+        return int(user.split('-')[1])
+
+    def _user_page(self, user: str, query: dict) -> dict:
+        total = self._profile_size(user)
+        cursor = int(query.get('cursor', ['0'])[0])
+        # Video mới nhất có ID lớn nhất, như profile thật
+        ids = [str(10 ** 12 + total - i) for i in range(cursor, min(cursor + PAGE_SIZE, total))]
+        return {
+            'user': user,
+            'items': [{'id': video_id, 'title': f"Video {video_id}", 'stats': self._stats(video_id)}
+                      for video_id in ids],
+            'cursor': cursor + len(ids),
+            'hasMore': cursor + len(ids) < total,
+        }
+
+    @staticmethod
+    def _stats(video_id: str) -> dict:
+        # Số liệu cố định theo ID để các lần chạy cho cùng kết quả
+        n = int(video_id) % 100000
+        return {'playCount': n * 37, 'diggCount': n * 3, 'commentCount': n % 97, 'shareCount': n % 13}
+
+    def _video(self, video_id: str) -> dict:
+        return {
+            'id': video_id,
+            'title': f"Video {video_id}",
+            'duration': 2,
+            'size': len(self.payload),
+            'stats': self._stats(video_id),
+        }
+
+
+def _stat_fields(stats: dict) -> dict:
+    return {
+        'view_count': stats['playCount'],
+        'like_count': stats['diggCount'],
+        'comment_count': stats['commentCount'],
+        'repost_count': stats['shareCount'],
+    }
+
+
+class FakeTikTokIE(InfoExtractor):
+    IE_NAME = 'TikTok'
+    _VALID_URL = r'https?://127\.0\.0\.1:\d+/tiktok\.com/@(?P<user>[\w.-]+)/video/(?P<id>\d+)'
+
+    @classmethod
+    def ie_key(cls):
+        return 'FakeTikTok'
+
+    def _real_extract(self, url):
+        user, video_id = self._match_valid_url(url).group('user', 'id')
+        base = url.split('/tiktok.com/')[0]
+        data = self._download_json(f"{base}/api/video/{video_id}", video_id)
+        return {
+            'id': video_id,
+            'title': data['title'],
+            'uploader': user,
+            'uploader_id': user,
+            'duration': data['duration'],
+            'webpage_url': url,
+            **_stat_fields(data['stats']),
+            'formats': [{
+                'format_id': 'h264',
+                'url': f"{base}/media/{video_id}.mp4",
+                'ext': 'mp4',
+                'vcodec': 'h264',
+                'acodec': 'aac',
+                'width': 540,
+                'height': 960,
+                'filesize': data['size'],
+            }],
+        }
+
+
+class FakeTikTokUserIE(InfoExtractor):
+    IE_NAME = 'TikTok:user'
+    _VALID_URL = r'https?://127\.0\.0\.1:\d+/tiktok\.com/@(?P<id>[\w.-]+)/?(?:$|[?#])'
+
+    @classmethod
+    def ie_key(cls):
+        return 'FakeTikTokUser'
+
+    def _entries(self, base: str, user: str):
+        cursor = 0
+        while True:
+            page = self._download_json(f"{base}/api/user/{user}", user, query={'cursor': cursor},
+                                       note=f"Downloading page {cursor // PAGE_SIZE + 1}")
+            for item in page['items']:
+                # Danh sách kèm số liệu thống kê như API profile thật (dùng cho xuất metadata dạng flat)
+                yield self.url_result(f"{base}/tiktok.com/@{user}/video/{item['id']}", FakeTikTokIE.ie_key(),
+                                      item['id'], item['title'], uploader=user, **_stat_fields(item['stats']))
+            if not page['hasMore']:
+                break
+            cursor = page['cursor']
+
+    def _real_extract(self, url):
+        user = self._match_id(url)
+        base = url.split('/tiktok.com/')[0]
+        return self.playlist_result(self._entries(base, user), user, user)
+
+
+def install(downloader_module):
+    """
+    Cho các phiên YoutubeDL của downloader dùng extractor giả lập
+    (thay danh sách extractor của nhóm phiên bằng hai extractor này).
+    """
+    downloader_module._session_pool.clear()
+    downloader_module._session_pool.extractors = lambda: [FakeTikTokUserIE(), FakeTikTokIE()]
@@ -0,0 +1,416 @@
+"""
+Bộ benchmark offline: đo downloader với TikTok giả lập chạy trên máy (benchmarks/fake_tiktok.py),
+không cần mạng, nên kết quả giữa các lần chạy/commit so sánh được với nhau.
+
+- video:     độ trễ tải một video và lấy thông tin video (không cache / có cache)
+- profile:   thông lượng tải toàn bộ profile theo số video và số luồng
+- sync:      đồng bộ tăng dần một profile: lần đầu tải toàn bộ, lần sau dừng ngay ở video đã tải
+             (số request và thời gian mỗi lần)
+- ffmpeg:    chi phí hậu xử lý ffmpeg cho mỗi video (fast path so với mặc định)
+- dir_scan:  chi phí liệt kê thư viện lớn (duyệt thư mục so với chỉ mục SQLite)
+- export:    thông lượng xuất metadata profile (bản ghi/giây, không tải media)
+- pipeline:  thông lượng tải danh sách URL qua DownloadPipeline và mức sử dụng từng bước
+- startup:   thời gian khởi động CLI (--help, import) trong tiến trình mới, CLI có nạp yt-dlp hay không,
+             thời gian khởi tạo phiên YoutubeDL (chỉ extractor TikTok so với toàn bộ extractor)
+
+Chạy: PYTHONPATH=src python benchmarks/run_benchmarks.py [--output report.json] [--only video,profile]
+Với --startup-budget-ms, lệnh thoát với mã lỗi khi CLI khởi động chậm hơn ngân sách hoặc nạp yt-dlp khi import.
+"""
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+
+# Trạng thái (chỉ mục, cache, số liệu) nằm trong thư mục tạm, không đụng vào downloads thật;
+# tắt giới hạn tốc độ và nhóm proxy để đo đúng chi phí của downloader
+_STATE_DIR = tempfile.mkdtemp(prefix="tiktok-bench-state-")
+os.environ['TIKTOK_CRAWLER_STATE_DIR'] = _STATE_DIR
+os.environ['TIKTOK_CRAWLER_RATE_LIMIT'] = '0'
+os.environ['TIKTOK_CRAWLER_PROXIES'] = ''
+os.environ.pop('TIKTOK_CRAWLER_PROXY_FILE', None)
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import yt_dlp
+
+from TiktokCrawler import downloader
+from TiktokCrawler.batch import stdout_to_stderr
+from TiktokCrawler.index import DownloadIndex
+from TiktokCrawler.export import RecordWriter, run_export
+
+import fake_tiktok
+
+SECTIONS = ('video', 'profile', 'sync', 'ffmpeg', 'dir_scan', 'export', 'pipeline', 'startup')
+# Các phần tải video qua downloader (cần ffmpeg)
+FFMPEG_SECTIONS = ('video', 'profile', 'sync', 'ffmpeg', 'pipeline')
+
+
+def _percentile(timings: list, q: float) -> float:
+    """Phân vị theo hạng gần nhất (nearest-rank) của danh sách đã sắp xếp"""
+    return timings[min(len(timings) - 1, max(0, math.ceil(q * len(timings)) - 1))]
+
+
+def _summarize(timings: list) -> dict:
+    timings = sorted(timings)
+    return {
+        'iterations': len(timings),
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 3),
+        'p50_ms': round(_percentile(timings, 0.50) * 1000, 3),
+        'p95_ms': round(_percentile(timings, 0.95) * 1000, 3),
+    }
+
+
+def _measure(func, iterations: int) -> dict:
+    """Gọi func(i) iterations lần, trả về thời gian trung bình/p50/p95"""
+    timings = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        func(i)
+        timings.append(time.perf_counter() - start)
+    return _summarize(timings)
+
+
+def _fresh_dir(root: str, name: str) -> str:
+    path = os.path.join(root, name)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    return path
+
+
+def _count_mp4(directory: str) -> tuple[int, int]:
+    """Số file MP4 và tổng dung lượng trong thư mục (kể cả thư mục con)"""
+    count = size = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.lower().endswith('.mp4'):
+                count += 1
+                size += os.path.getsize(os.path.join(root, name))
+    return count, size
+
+
+def _check(result: tuple, what: str):
+    success, message = result
+    if not success:
+        raise RuntimeError(f"{what} thất bại: {message}")
+
+
+def bench_video(fake, work_dir: str, iterations: int) -> dict:
+    """Độ trễ của từng thao tác trên một video"""
+    output_dir = _fresh_dir(work_dir, "video")
+    # Mỗi lần đo là một video mới (không bị bỏ qua vì đã tải)
+    video_ids = iter(range(2 * 10 ** 12, 3 * 10 ** 12))
+
+    def download(_):
+        _check(downloader.download_video(fake.video_url("bench", next(video_ids)), output_dir=output_dir,
+                                         fast_path=True), "Tải video")
+
+    def info_uncached(_):
+        _check(downloader.get_video_info(fake.video_url("bench", next(video_ids)), use_cache=False),
+               "Lấy thông tin video")
+
+    cached_url = fake.video_url("bench", next(video_ids))
+    downloader.get_video_info(cached_url)
+
+    def info_cached(_):
+        _check(downloader.get_video_info(cached_url), "Lấy thông tin video")
+
+    return {
+        'download': _measure(download, iterations),
+        'info_uncached': _measure(info_uncached, iterations),
+        'info_cached': _measure(info_cached, iterations),
+    }
+
+
+def bench_profile(fake, work_dir: str, sizes: list, concurrencies: list) -> list:
+    """Thông lượng tải toàn bộ profile"""
+    results = []
+    for size in sizes:
+        for concurrency in concurrencies:
+            output_dir = _fresh_dir(work_dir, f"profile-{size}-{concurrency}")
+            url = fake.user_url(size, f"c{concurrency}")
+            start = time.perf_counter()
+            success, message = downloader.download_user_videos(url, output_dir=output_dir, concurrency=concurrency,
+                                                               fast_path=True)
+            elapsed = time.perf_counter() - start
+            files, total_bytes = _count_mp4(output_dir)
+            results.append({
+                'videos': size,
+                'concurrency': concurrency,
+                'success': success,
+                'files': files,
+                'seconds': round(elapsed, 3),
+                'videos_per_second': round(files / elapsed, 2),
+                'megabytes_per_second': round(total_bytes / 1024 / 1024 / elapsed, 2),
+            })
+    return results
+
+
+def bench_sync(fake, work_dir: str, size: int) -> list:
+    """Đồng bộ tăng dần một profile hai lần: lần đầu tải toàn bộ, lần hai không có video mới"""
+    output_dir = _fresh_dir(work_dir, "sync")
+    url = fake.user_url(size, "sync")
+    results = []
+    for run in ('initial', 'repeat'):
+        files_before = _count_mp4(output_dir)[0]
+        requests_before = fake.requests
+        start = time.perf_counter()
+        success, message = downloader.download_user_videos(url, output_dir=output_dir, incremental=True,
+                                                           fast_path=True)
+        elapsed = time.perf_counter() - start
+        results.append({
+            'run': run,
+            'videos': size,
+            'success': success,
+            'new_files': _count_mp4(output_dir)[0] - files_before,
+            'requests': fake.requests - requests_before,
+            'seconds': round(elapsed, 3),
+        })
+    return results
+
+
+def bench_ffmpeg(fake, work_dir: str, iterations: int) -> dict:
+    """Chi phí hậu xử lý ffmpeg cho mỗi video: fast path so với mặc định (ghi metadata)"""
+    video_ids = iter(range(3 * 10 ** 12, 4 * 10 ** 12))
+    report = {}
+    for name, fast_path in (('default', False), ('fast_path', True)):
+        output_dir = _fresh_dir(work_dir, f"ffmpeg-{name}")
+        ffmpeg_seconds = []
+        steps = {}
+
+        def on_event(event):
+            if event.get('event') == 'postprocessor' and event.get('ffmpeg'):
+                ffmpeg_seconds.append(event['seconds'])
+                steps[event['postprocessor']] = steps.get(event['postprocessor'], 0) + 1
+
+        def download(_):
+            _check(downloader.download_video(fake.video_url("bench", next(video_ids)), output_dir=output_dir,
+                                             progress_callback=on_event, fast_path=fast_path), "Tải video")
+
+        total = _measure(download, iterations)
+        report[name] = {
+            'total': total,
+            'ffmpeg_runs': len(ffmpeg_seconds),
+            'ffmpeg_ms_per_video': round(sum(ffmpeg_seconds) / iterations * 1000, 3),
+            'steps': steps,
+        }
+    return report
+
+
+def bench_dir_scan(work_dir: str, sizes: list, iterations: int) -> list:
+    """Liệt kê thư viện N file: duyệt thư mục + stat từng file so với chỉ mục SQLite"""
+    results = []
+    for size in sizes:
+        library = _fresh_dir(work_dir, f"library-{size}")
+        for i in range(size):
+            with open(os.path.join(library, f"Video {i}_{10 ** 12 + i}.mp4"), 'wb') as f:
+                f.write(b'\0' * 1024)
+        index = DownloadIndex(os.path.join(work_dir, f"index-{size}.db"))
+
+        def listdir(_):
+            for name in downloader.get_mp4_files_only(library):
+                path = os.path.join(library, name)
+                os.path.getsize(path)
+                os.path.getmtime(path)
+
+        start = time.perf_counter()
+        index.sync(library)
+        first_sync = time.perf_counter() - start
+
+        results.append({
+            'files': size,
+            'listdir_stat': _measure(listdir, iterations),
+            'index_first_sync_ms': round(first_sync * 1000, 3),
+            'index_resync': _measure(lambda _: index.sync(library), iterations),
+            'index_list': _measure(lambda _: index.list(library), iterations),
+            'index_list_page': _measure(lambda _: index.list(library, limit=50), iterations),
+        })
+    return results
+
+
+class _NullOutput:
+    def write(self, text):
+        return len(text)
+
+
+def bench_export(fake, sizes: list) -> list:
+    """Thông lượng xuất metadata (danh sách flat theo trang, không mở trang từng video)"""
+    results = []
+    for size in sizes:
+        for fmt in ('jsonl', 'csv'):
+            requests_before = fake.requests
+            summary = run_export([fake.user_url(size, f"export-{fmt}")], RecordWriter(_NullOutput(), fmt))
+            results.append({
+                'videos': size,
+                'format': fmt,
+                'records': summary['records'],
+                'seconds': summary['elapsed'],
+                'records_per_second': summary['records_per_second'],
+                'requests': fake.requests - requests_before,
+            })
+    return results
+
+
+def bench_pipeline(fake, work_dir: str, videos: int, fetch_workers: list) -> list:
+    """Tải danh sách URL qua DownloadPipeline theo số worker tải dữ liệu, kèm mức sử dụng từng bước"""
+    video_ids = iter(range(5 * 10 ** 12, 6 * 10 ** 12))
+    results = []
+    for workers in fetch_workers:
+        output_dir = _fresh_dir(work_dir, f"pipeline-{workers}")
+        urls = [fake.video_url("bench", next(video_ids)) for _ in range(videos)]
+        pipeline = downloader.DownloadPipeline(output_dir=output_dir, fast_path=True, fetch_workers=workers)
+        summary = pipeline.run(urls)
+        files, total_bytes = _count_mp4(output_dir)
+        results.append({
+            'videos': videos,
+            'fetch_workers': workers,
+            'files': files,
+            'seconds': summary['elapsed'],
+            'videos_per_second': round(files / summary['elapsed'], 2) if summary['elapsed'] else 0.0,
+            'megabytes_per_second': round(total_bytes / 1024 / 1024 / summary['elapsed'], 2)
+            if summary['elapsed'] else 0.0,
+            'stages': summary['stages'],
+        })
+    return results
+
+
+def _run_python(args: list) -> subprocess.CompletedProcess:
+    """Chạy python trong tiến trình mới (cùng PYTHONPATH, cùng thư mục trạng thái tạm)"""
+    return subprocess.run([sys.executable] + args, capture_output=True, text=True, timeout=60)
+
+
+def bench_startup(iterations: int) -> dict:
+    """Thời gian khởi động CLI trong tiến trình mới và thời gian khởi tạo một phiên YoutubeDL"""
+    results = {}
+    for name, args in (('cli_help', ['-m', 'TiktokCrawler.cli', '--help']),
+                       ('cli_import', ['-c', 'import TiktokCrawler.cli']),
+                       ('python', ['-c', 'pass'])):
+        def run(_):
+            completed = _run_python(args)
+            if completed.returncode != 0:
+                raise RuntimeError(f"{' '.join(args)} thất bại: {completed.stderr.strip()}")
+        results[name] = _measure(run, iterations)
+
+    # --help và các lệnh xem trạng thái không được nạp yt-dlp (chỉ nạp khi lệnh cần tải)
+    check = _run_python(['-c', "import sys, TiktokCrawler.cli; print('yt_dlp' in sys.modules)"])
+    results['cli_imports_yt_dlp'] = check.stdout.strip() == 'True'
+
+    extractors = downloader.EXTRACTORS
+    try:
+        for mode in ('tiktok', 'all'):
+            downloader.EXTRACTORS = mode
+            results[f'session_init_{mode}'] = _measure(lambda _: downloader._YoutubeDL({'quiet': True}), iterations)
+    finally:
+        downloader.EXTRACTORS = extractors
+    return results
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _int_list(value: str) -> list:
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark downloader với TikTok giả lập (offline)")
+    parser.add_argument('--only', default=",".join(SECTIONS), help="Các phần cần chạy, cách nhau bởi dấu phẩy")
+    parser.add_argument('--iterations', type=int, default=20, help="Số lần đo cho mỗi thao tác")
+    parser.add_argument('--profile-sizes', type=_int_list, default=[10, 50, 200], help="Số video của profile")
+    parser.add_argument('--concurrency', type=_int_list, default=[1, 4], help="Số luồng tải profile")
+    parser.add_argument('--sync-videos', type=int, default=50, help="Số video của profile khi đồng bộ tăng dần")
+    parser.add_argument('--export-sizes', type=_int_list, default=[1000, 10000], help="Số video của profile khi xuất metadata")
+    parser.add_argument('--pipeline-videos', type=int, default=100, help="Số URL tải qua pipeline")
+    parser.add_argument('--pipeline-workers', type=_int_list, default=[4, 16], help="Số worker tải dữ liệu của pipeline")
+    parser.add_argument('--startup-budget-ms', type=float,
+                        help="Ngân sách p50 của 'tiktok-crawler --help' (ms); vượt ngân sách thì thoát với mã lỗi 1")
+    parser.add_argument('--library-sizes', type=_int_list, default=[1000, 10000], help="Số file của thư viện")
+    parser.add_argument('--latency', type=float, default=0.0, help="Độ trễ giả lập mỗi request (ms)")
+    parser.add_argument('--video-size', type=int, default=512, help="Dung lượng video giả lập (KB)")
+    parser.add_argument('--output', help="Ghi báo cáo JSON vào file (mặc định chỉ in ra stdout)")
+    args = parser.parse_args()
+    sections = [s.strip() for s in args.only.split(',') if s.strip()]
+
+    if any(section in FFMPEG_SECTIONS for section in sections) and not downloader.warm_up():
+        sys.exit(f"Cần cài đặt ffmpeg để chạy các phần {', '.join(FFMPEG_SECTIONS)} của benchmark")
+
+    # Video MP4 thật để bước ffmpeg chạy như thật; nếu ffmpeg không tạo được thì bỏ qua phần ffmpeg
+    sample = fake_tiktok.sample_mp4(downloader.get_ffmpeg_path()) if 'ffmpeg' in sections else None
+    payload = sample or fake_tiktok.synthetic_mp4(args.video_size * 1024)
+
+    work_dir = tempfile.mkdtemp(prefix="tiktok-bench-")
+    fake = fake_tiktok.FakeTikTok(payload, latency=args.latency / 1000).start()
+    fake_tiktok.install(downloader)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': _git_commit(),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'yt_dlp': yt_dlp.version.__version__,
+        },
+        'parameters': {
+            'iterations': args.iterations,
+            'latency_ms': args.latency,
+            'video_bytes': len(payload),
+        },
+        'results': {},
+    }
+    results = report['results']
+
+    try:
+        # Output của downloader (rich, yt-dlp) ra stderr, stdout chỉ chứa báo cáo JSON
+        with stdout_to_stderr() as out:
+            if 'video' in sections:
+                results['video'] = bench_video(fake, work_dir, args.iterations)
+            if 'profile' in sections:
+                results['profile'] = bench_profile(fake, work_dir, args.profile_sizes, args.concurrency)
+            if 'sync' in sections:
+                results['sync'] = bench_sync(fake, work_dir, args.sync_videos)
+            if 'ffmpeg' in sections:
+                results['ffmpeg'] = (bench_ffmpeg(fake, work_dir, args.iterations) if sample
+                                     else {'skipped': "ffmpeg không tạo được video mẫu"})
+            if 'dir_scan' in sections:
+                results['dir_scan'] = bench_dir_scan(work_dir, args.library_sizes, args.iterations)
+            if 'export' in sections:
+                results['export'] = bench_export(fake, args.export_sizes)
+            if 'pipeline' in sections:
+                results['pipeline'] = bench_pipeline(fake, work_dir, args.pipeline_videos, args.pipeline_workers)
+            if 'startup' in sections:
+                results['startup'] = bench_startup(args.iterations)
+                if args.startup_budget_ms is not None:
+                    results['startup']['budget_ms'] = args.startup_budget_ms
+                    results['startup']['within_budget'] = (
+                        results['startup']['cli_help']['p50_ms'] <= args.startup_budget_ms
+                        and not results['startup']['cli_imports_yt_dlp'])
+            report['sessions'] = downloader.get_session_stats()
+            report['requests'] = fake.requests
+
+            text = json.dumps(report, indent=2, ensure_ascii=False)
+            out.write(text + "\n")
+    finally:
+        fake.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+        shutil.rmtree(_STATE_DIR, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    if results.get('startup', {}).get('within_budget') is False:
+        sys.exit(f"CLI khởi động vượt ngân sách {args.startup_budget_ms:.0f} ms hoặc đã nạp yt-dlp khi import")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+import time
+from contextlib import contextmanager
+
+from .state import DOWNLOADS_DIR
+from .cache import canonical_video_key
+
+# Số URL tải song song mặc định của lệnh batch
+DEFAULT_BATCH_CONCURRENCY = int(os.getenv('TIKTOK_CRAWLER_BATCH_CONCURRENCY', '4'))
+
+
+def read_urls(lines) -> tuple[list, int]:
+    """
+    Đọc danh sách URL (mỗi dòng một URL, bỏ qua dòng trống và dòng bắt đầu bằng #),
+    bỏ các URL trùng nhau theo ID video.
+
+    Returns:
+        tuple: (urls: list, duplicates: int)
+    """
+    urls = []
+    seen = set()
+    duplicates = 0
+    for line in lines:
+        url = line.strip()
+        if not url or url.startswith('#'):
+            continue
+        key = canonical_video_key(url)
+        if key in seen:
+            duplicates += 1
+            continue
+        seen.add(key)
+        urls.append(url)
+    return urls, duplicates
+
+
+@contextmanager
+def stdout_to_stderr():
+    """
+    Chuyển mọi output ghi ra stdout (rich, yt-dlp) sang stderr trong lúc chạy,
+    trả về file ghi vào stdout thật để stdout chỉ chứa các dòng JSON.
+    """
+    sys.stdout.flush()
+    saved_fd = os.dup(1)
+    out = os.fdopen(os.dup(saved_fd), 'w', encoding='utf-8', buffering=1)
+    os.dup2(2, 1)
+    try:
+        yield out
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved_fd, 1)
+        os.close(saved_fd)
+        out.close()
+
+
+def _result_record(url: str, outcome: tuple, elapsed: float) -> dict:
+    """Bản ghi kết quả của một URL (trạng thái, file, dung lượng, thời gian)"""
+    success, message, _, files = outcome
+    path = next((f for f in reversed(files) if os.path.isfile(f)), None)
+    return {
+        'url': url,
+        'status': 'ok' if success else 'failed',
+        'file': path,
+        'bytes': os.path.getsize(path) if path else 0,
+        'elapsed': round(elapsed, 3),
+        'message': message,
+    }
+
+
+def run_batch(urls: list, out, proxy: str = None, concurrency: int = DEFAULT_BATCH_CONCURRENCY,
+              output_dir: str = DOWNLOADS_DIR, fast_path: bool = None) -> dict:
+    """
+    Tải danh sách URL qua DownloadPipeline (trích xuất, tải dữ liệu và hậu xử lý ffmpeg chạy
+    song song ở các bước riêng), ghi một dòng JSON cho mỗi URL ngay khi tải xong.
+
+    Args:
+        urls: Danh sách URL (đã bỏ trùng)
+        out: File nhận các dòng JSON
+        proxy: Proxy tùy chọn (mặc định dùng nhóm proxy đã cấu hình, nếu có)
+        concurrency: Số URL tải dữ liệu song song (bước fetch của pipeline)
+        output_dir: Thư mục lưu video
+        fast_path: Ưu tiên MP4 có sẵn, chỉ chạy ffmpeg khi cần
+
+    Returns:
+        dict: Tổng kết (số URL thành công/lỗi, tổng dung lượng, thời gian, thông lượng,
+            mức sử dụng từng bước của pipeline trong 'stages')
+    """
+    # Import khi dùng: đọc danh sách URL, stdout_to_stderr... không cần nạp yt-dlp
+    from . import downloader
+
+    downloader.warm_up()
+    summary = {'total': len(urls), 'succeeded': 0, 'failed': 0, 'bytes': 0}
+    urls_by_index = dict(enumerate(urls, 1))
+
+    def on_result(idx, url, outcome, elapsed):
+        # URL gốc (pipeline bỏ phần query khi chuẩn hóa)
+        result = _result_record(urls_by_index.get(idx, url), outcome, elapsed)
+        out.write(json.dumps(result, ensure_ascii=False) + "\n")
+        out.flush()
+        summary['succeeded' if result['status'] == 'ok' else 'failed'] += 1
+        summary['bytes'] += result['bytes']
+
+    pipeline = downloader.DownloadPipeline(proxy=proxy, output_dir=output_dir, fast_path=fast_path,
+                                           fetch_workers=max(1, concurrency))
+    started = time.monotonic()
+    summary['stages'] = pipeline.run(urls, on_result)['stages']
+
+    elapsed = time.monotonic() - started
+    summary['elapsed'] = round(elapsed, 3)
+    summary['videos_per_second'] = round(summary['succeeded'] / elapsed, 3) if elapsed else 0.0
+    summary['megabytes_per_second'] = round(summary['bytes'] / 1024 / 1024 / elapsed, 3) if elapsed else 0.0
+    return summary
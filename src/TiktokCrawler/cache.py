@@ -0,0 +1,172 @@
+import os
+import re
+import json
+import time
+import threading
+from contextlib import closing
+
+from . import state
+
+INFO_CACHE_DB_NAME = "info_cache.db"
+
+# Thời gian sống của thông tin video (giây), của kết quả lỗi vĩnh viễn
+# (video riêng tư/đã xóa) và số mục tối đa trước khi loại bỏ theo LRU
+DEFAULT_TTL = int(os.getenv('TIKTOK_CRAWLER_INFO_CACHE_TTL', '300'))
+DEFAULT_NEGATIVE_TTL = int(os.getenv('TIKTOK_CRAWLER_INFO_CACHE_NEGATIVE_TTL', '60'))
+DEFAULT_MAX_ENTRIES = int(os.getenv('TIKTOK_CRAWLER_INFO_CACHE_MAX_ENTRIES', '10000'))
+
+# Các trường của info dict được lưu lại (không lưu danh sách format, quá lớn)
+CACHED_FIELDS = (
+    'id', 'title', 'uploader', 'uploader_id', 'upload_date', 'timestamp', 'duration',
+    'duration_string', 'view_count', 'like_count', 'comment_count', 'repost_count',
+    'webpage_url', 'thumbnail', 'description',
+)
+
+_VIDEO_ID_RE = re.compile(r'/(?:video|v)/(\d+)')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS info_cache (
+    key TEXT PRIMARY KEY,
+    payload TEXT,
+    error TEXT,
+    expires_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_info_cache_last_access ON info_cache (last_access);
+CREATE TABLE IF NOT EXISTS cache_stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def is_video_url(url: str) -> bool:
+    """URL trỏ tới một video cụ thể (có ID video trong đường dẫn, ví dụ /@user/video/<id>)"""
+    return bool(_VIDEO_ID_RE.search(url.split('?')[0]))
+
+
+def canonical_video_key(url: str) -> str:
+    """
+    Khóa cache cho một URL video: ID video nếu có trong URL,
+    nếu không (ví dụ link rút gọn vm.tiktok.com) dùng URL đã bỏ query.
+    """
+    match = _VIDEO_ID_RE.search(url)
+    if match:
+        return f"id:{match.group(1)}"
+    return f"url:{url.split('?')[0].rstrip('/').lower()}"
+
+
+class InfoCache:
+    """
+    Cache thông tin video dùng chung giữa các tiến trình (SQLite trên volume downloads).
+
+    Hỗ trợ TTL, giới hạn số mục với loại bỏ theo LRU, và lưu tạm kết quả lỗi
+    (video riêng tư/đã xóa) trong thời gian ngắn để không gọi lại TikTok liên tục.
+    """
+
+    def __init__(self, db_path: str = None, ttl: int = DEFAULT_TTL,
+                 negative_ttl: int = DEFAULT_NEGATIVE_TTL, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.db_path = db_path or state.get_state_path(INFO_CACHE_DB_NAME)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        with closing(state.connect(self.db_path)) as conn:
+            conn.executescript(_SCHEMA)
+
+    def get(self, key: str):
+        """
+        Tra cứu cache.
+
+        Returns:
+            None nếu không có trong cache, ngược lại tuple (success: bool, info dict hoặc thông báo lỗi)
+        """
+        now = time.time()
+        with closing(state.connect(self.db_path)) as conn:
+            row = conn.execute(
+                "SELECT payload, error, expires_at FROM info_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if not row or row['expires_at'] <= now:
+                self._count(conn, 'misses')
+                return None
+
+            conn.execute("UPDATE info_cache SET last_access = ? WHERE key = ?", (now, key))
+            if row['error'] is not None:
+                self._count(conn, 'negative_hits')
+                return False, row['error']
+            self._count(conn, 'hits')
+            return True, json.loads(row['payload'])
+
+    def put(self, keys, info: dict):
+        """Lưu thông tin video dưới một hoặc nhiều khóa (ví dụ khóa URL và khóa ID)"""
+        payload = json.dumps({k: info.get(k) for k in CACHED_FIELDS if info.get(k) is not None})
+        self._store(keys, payload, None, self.ttl)
+
+    def put_error(self, keys, message: str):
+        """Lưu kết quả lỗi vĩnh viễn (video riêng tư/đã xóa) trong thời gian ngắn"""
+        self._store(keys, None, message, self.negative_ttl)
+
+    def _store(self, keys, payload, error, ttl):
+        if isinstance(keys, str):
+            keys = [keys]
+        now = time.time()
+        with closing(state.connect(self.db_path)) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO info_cache (key, payload, error, expires_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(key, payload, error, now + ttl, now) for key in set(keys)]
+            )
+            self._evict(conn)
+
+    def _evict(self, conn):
+        """Xóa mục hết hạn, sau đó loại bỏ các mục ít được dùng gần đây nhất nếu vượt giới hạn"""
+        conn.execute("DELETE FROM info_cache WHERE expires_at <= ?", (time.time(),))
+        size = conn.execute("SELECT COUNT(*) FROM info_cache").fetchone()[0]
+        if self.max_entries and size > self.max_entries:
+            removed = size - self.max_entries
+            conn.execute(
+                "DELETE FROM info_cache WHERE key IN "
+                "(SELECT key FROM info_cache ORDER BY last_access LIMIT ?)",
+                (removed,)
+            )
+            self._count(conn, 'evictions', removed)
+
+    @staticmethod
+    def _count(conn, name: str, amount: int = 1):
+        conn.execute(
+            "INSERT INTO cache_stats (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, amount)
+        )
+
+    def stats(self) -> dict:
+        """Số liệu hit/miss (cộng dồn của mọi tiến trình) và kích thước cache"""
+        with closing(state.connect(self.db_path)) as conn:
+            counters = {row['name']: row['value'] for row in conn.execute("SELECT name, value FROM cache_stats")}
+            size = conn.execute("SELECT COUNT(*) FROM info_cache").fetchone()[0]
+        result = {name: counters.get(name, 0) for name in ('hits', 'negative_hits', 'misses', 'evictions')}
+        lookups = result['hits'] + result['negative_hits'] + result['misses']
+        result['hit_rate'] = round((result['hits'] + result['negative_hits']) / lookups, 4) if lookups else 0.0
+        result['size'] = size
+        result['max_entries'] = self.max_entries
+        result['ttl'] = self.ttl
+        result['negative_ttl'] = self.negative_ttl
+        return result
+
+    def clear(self):
+        """Xóa toàn bộ cache và bộ đếm"""
+        with closing(state.connect(self.db_path)) as conn:
+            conn.execute("DELETE FROM info_cache")
+            conn.execute("DELETE FROM cache_stats")
+
+
+_info_cache = None
+_info_cache_lock = threading.Lock()
+
+
+def get_info_cache() -> InfoCache:
+    """Cache thông tin video dùng chung trong tiến trình (khởi tạo khi cần)"""
+    global _info_cache
+    with _info_cache_lock:
+        if _info_cache is None:
+            _info_cache = InfoCache()
+        return _info_cache
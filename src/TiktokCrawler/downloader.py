@@ -1,16 +1,261 @@
 import os
+import re
 import sys
 import platform
 import shutil
 import subprocess
+import random
+import threading
+import time
+import itertools
+import inspect
+import queue
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import yt_dlp
+try:
+    from yt_dlp.postprocessor import get_postprocessor
+except ImportError:
+    get_postprocessor = None
+from yt_dlp.extractor import gen_extractors
+from yt_dlp.extractor.common import InfoExtractor
+from yt_dlp.postprocessor.common import PostProcessor
 from rich.console import Console
 from rich.panel import Panel
 from rich.text import Text
 
-DOWNLOADS_DIR = "downloads"
+from .state import DOWNLOADS_DIR, ProcessSemaphore
+from .cache import get_info_cache, canonical_video_key
+from .sessions import SessionPool
+from .index import get_download_index
+from .quota import get_disk_quota
+from .singleflight import get_single_flight
+from . import storage
+from .ratelimit import get_rate_limiter, host_of
+from .metrics import get_metrics
+from .proxies import get_proxy_pool, mask_proxy, OUTCOME_BLOCKED, OUTCOME_FAILURE, OUTCOME_SUCCESS
+# Số video tải song song mặc định khi tải theo user (1 = tuần tự như cũ)
+DEFAULT_CONCURRENCY = int(os.getenv('TIKTOK_CRAWLER_CONCURRENCY', '1'))
 console = Console()
 
+# Bộ đếm số lần gọi extractor (mỗi lần là một lượt truy cập trang/API TikTok)
+_extraction_lock = threading.Lock()
+_extraction_count = 0
+
+class _IndexRecorderPP(PostProcessor):
+    """Ghi file cuối cùng (sau khi hậu xử lý và di chuyển) vào chỉ mục file đã tải"""
+
+    def run(self, info):
+        filepath = info.get('filepath')
+        if filepath:
+            _record_download(filepath, info, (self._downloader.params.get('paths') or {}).get('home'))
+        return [], info
+
+def _record_download(filepath: str, info: dict, output_dir: str = None):
+    """Ghi file đã tải xong vào chỉ mục và số liệu"""
+    try:
+        get_download_index().record(filepath, info, directory=output_dir)
+    except Exception as e:
+        console.print(f"[red]Không thể ghi chỉ mục cho {filepath}: {e}[/red]")
+    if os.path.isfile(filepath):
+        metrics = get_metrics()
+        metrics.inc('downloaded_files_total')
+        metrics.inc('downloaded_bytes_total', os.path.getsize(filepath))
+
+# Extractor nạp vào mỗi phiên YoutubeDL: 'tiktok' chỉ nạp các extractor TikTok/Douyin
+# (không nạp hơn 1700 extractor của yt-dlp khi khởi tạo phiên), 'all' nạp toàn bộ như yt-dlp
+EXTRACTORS = os.getenv('TIKTOK_CRAWLER_EXTRACTORS', 'tiktok').strip().lower()
+_tiktok_extractors = None
+
+def _get_tiktok_extractors() -> list:
+    """Các lớp extractor TikTok/Douyin của yt-dlp (video, user, sound, tag, collection, live, vm.tiktok...)"""
+    global _tiktok_extractors
+    if _tiktok_extractors is None:
+        from yt_dlp.extractor import tiktok
+        _tiktok_extractors = [
+            cls for cls in vars(tiktok).values()
+            if isinstance(cls, type) and issubclass(cls, InfoExtractor) and cls.__module__ == tiktok.__name__
+            and cls.__dict__.get('_VALID_URL') and cls._ENABLED
+        ]
+    return _tiktok_extractors
+
+# Trạng thái theo thread: host của request gần nhất (để gán lỗi chặn/giới hạn cho đúng host)
+# và thông báo lỗi gần nhất yt-dlp đã báo (khi ignoreerrors nuốt mất exception)
+_call_state = threading.local()
+
+class _YoutubeDL(yt_dlp.YoutubeDL):
+    """
+    YoutubeDL có đếm số lần trích xuất, kể cả các lần yt-dlp tự gọi cho từng video trong playlist,
+    ghi mọi file tải xong vào chỉ mục, giữ chỗ trong hạn mức thư mục downloads trước mỗi lần tải,
+    và đi qua bộ giới hạn tốc độ theo host trước mỗi lần trích xuất/tải.
+
+    Mặc định chỉ nạp các extractor TikTok/Douyin (xem TIKTOK_CRAWLER_EXTRACTORS).
+
+    Với option 'defer_postprocessing' (dùng trong DownloadPipeline), bước hậu xử lý không chạy
+    trên thread tải mà được giữ lại trong _call_state.deferred để chạy ở tiến trình khác. Nếu phiên
+    bản yt-dlp không có các điểm móc cần thiết (xem _DEFERRED_POSTPROCESSING), hậu xử lý chạy ngay
+    như mặc định và _call_state.deferred chỉ đánh dấu là đã xong (inline).
+    """
+
+    def __init__(self, params=None, *args, **kwargs):
+        super().__init__(params, *args, **kwargs)
+        self.add_post_processor(_IndexRecorderPP(self), when='after_move')
+
+    def add_default_info_extractors(self):
+        if EXTRACTORS == 'all':
+            return super().add_default_info_extractors()
+        for ie in _get_tiktok_extractors():
+            self.add_info_extractor(ie)
+        self.write_debug(f'Loaded {len(_get_tiktok_extractors())} extractors (TikTok/Douyin)')
+
+    def extract_info(self, url, *args, **kwargs):
+        global _extraction_count
+        with _extraction_lock:
+            _extraction_count += 1
+        host = _rate_limit(url)
+        # Mốc thời gian bắt đầu, được lấy ra trong add_default_extra_info ngay khi extractor trả về
+        # (không tính thời gian tải/xử lý các video con sau đó)
+        pending = getattr(_call_state, 'extractions', None)
+        if pending is None:
+            pending = _call_state.extractions = []
+        marker = [time.perf_counter()]
+        pending.append(marker)
+        try:
+            info = super().extract_info(url, *args, **kwargs)
+        finally:
+            # Extractor lỗi trước khi trả về kết quả: mốc thời gian vẫn còn trong danh sách
+            if any(item is marker for item in pending):
+                pending[:] = [item for item in pending if item is not marker]
+                get_metrics().inc('extractions_total', result='error')
+        if info:
+            get_rate_limiter().report_success(host)
+        return info
+
+    def add_default_extra_info(self, *args, **kwargs):
+        pending = getattr(_call_state, 'extractions', None)
+        if pending:
+            started = pending.pop()[0]
+            metrics = get_metrics()
+            metrics.observe('extraction_seconds', time.perf_counter() - started)
+            metrics.inc('extractions_total', result='ok')
+        return super().add_default_extra_info(*args, **kwargs)
+
+    def process_info(self, info_dict, *args, **kwargs):
+        # Giữ chỗ trong hạn mức thư mục downloads trước khi tải (xóa bớt video cũ nếu cần),
+        # để không hỏng giữa chừng khi ổ đĩa đầy
+        if self.params.get('simulate') or self.params.get('skip_download'):
+            return super().process_info(info_dict, *args, **kwargs)
+        output_dir = (self.params.get('paths') or {}).get('home') or DOWNLOADS_DIR
+        if os.path.exists(self.prepare_filename(info_dict)):
+            return super().process_info(info_dict, *args, **kwargs)
+        success, reservation = get_disk_quota().reserve(output_dir, _estimate_size(info_dict))
+        if not success:
+            self.report_error(reservation)
+            return
+        try:
+            return super().process_info(info_dict, *args, **kwargs)
+        finally:
+            get_disk_quota().unreserve(reservation)
+
+    def post_process(self, filename, info, *args, **kwargs):
+        if not self.params.get('defer_postprocessing'):
+            return super().post_process(filename, info, *args, **kwargs)
+        # Các bước ghép/sửa lỗi yt-dlp lên lịch cho video nằm trong info['__postprocessors']
+        specs = (_postprocessor_specs(info['__postprocessors'])
+                 if _DEFERRED_POSTPROCESSING and '__postprocessors' in info else None)
+        if specs is None:
+            # yt-dlp không hỗ trợ, hoặc có bước không dựng lại được ở tiến trình con:
+            # hậu xử lý ngay trên thread này, pipeline bỏ qua bước hậu xử lý của nó
+            result = super().post_process(filename, info, *args, **kwargs)
+            _call_state.deferred = {'inline': True, 'filepath': (result or info).get('filepath')}
+            return result
+        files_to_move = kwargs.get('files_to_move', args[0] if args else None)
+        # Chụp lại ngay công việc hậu xử lý (yt-dlp còn sửa info sau bước này): spec các bước
+        # ghép/sửa lỗi đã lên lịch và info dạng JSON để gửi được sang tiến trình con
+        _call_state.deferred = {
+            'filename': filename,
+            'files_to_move': dict(files_to_move or {}),
+            'postprocessors': specs,
+            'info': self.sanitize_info({k: v for k, v in info.items() if k != '__postprocessors'}),
+        }
+        info['filepath'] = filename
+        return info
+
+    def dl(self, name, info, *args, **kwargs):
+        host = _rate_limit(info.get('url'))
+        started = time.perf_counter()
+        success = False
+        try:
+            success = super().dl(name, info, *args, **kwargs)
+        finally:
+            metrics = get_metrics()
+            metrics.observe('download_seconds', time.perf_counter() - started)
+            metrics.inc('downloads_total', result='ok' if success else 'error')
+        if success:
+            get_rate_limiter().report_success(host)
+        return success
+
+    def report_error(self, message, *args, **kwargs):
+        # yt-dlp có thể truyền thẳng đối tượng lỗi (ví dụ lỗi hậu xử lý ffmpeg)
+        _call_state.last_error = str(message)
+        error_kind = _classify_error(_call_state.last_error)
+        get_metrics().inc('errors_total', error_class=error_kind or 'unknown')
+        # Bị chặn/giới hạn (403/429): giảm tốc độ cho host của request vừa thực hiện
+        if error_kind in (ERROR_BLOCKED, ERROR_THROTTLED):
+            get_rate_limiter().report_block(getattr(_call_state, 'host', None))
+        return super().report_error(message, *args, **kwargs)
+
+def _estimate_size(info: dict) -> int:
+    """Dung lượng dự kiến của video (tổng các format được chọn), None nếu không biết"""
+    formats = info.get('requested_formats') or [info]
+    sizes = [f.get('filesize') or f.get('filesize_approx') for f in formats]
+    return sum(sizes) if all(sizes) else None
+
+def _rate_limit(url: str) -> str:
+    """Chờ lượt request cho host của URL, trả về host đó"""
+    host = host_of(url)
+    _call_state.host = host
+    waited = get_rate_limiter().acquire(host)
+    if waited >= 1:
+        console.print(f"[yellow]Giới hạn tốc độ: đã chờ {waited:.1f}s cho {host}[/yellow]")
+    return host
+
+def get_extraction_count() -> int:
+    """Tổng số lần trích xuất thông tin đã thực hiện trong tiến trình này"""
+    return _extraction_count
+
+def reset_extraction_count():
+    """Đặt lại bộ đếm số lần trích xuất"""
+    global _extraction_count
+    with _extraction_lock:
+        _extraction_count = 0
+
+def _session_extractors() -> list:
+    """Extractor (instance) của một phiên mới theo TIKTOK_CRAWLER_EXTRACTORS"""
+    if EXTRACTORS == 'all':
+        return list(gen_extractors())
+    return [ie() for ie in _get_tiktok_extractors()]
+
+# Nhóm phiên YoutubeDL (extractor đã khởi tạo, cookie) dùng lại theo bộ option (proxy, thư mục output...)
+_session_pool = SessionPool(_YoutubeDL, _session_extractors)
+
+def get_session_stats() -> dict:
+    """Số phiên YoutubeDL đã tạo mới / dùng lại trong tiến trình này"""
+    return _session_pool.stats()
+
+def _download_with_info(ydl, info: dict, url: str):
+    """
+    Tải từ info dict đã trích xuất, không gọi lại extractor.
+    Chỉ trích xuất lại từ URL khi yt-dlp yêu cầu (ví dụ link format đã hết hạn).
+    """
+    try:
+        ydl.process_ie_result(info, download=True)
+    except yt_dlp.utils.ReExtractInfo as e:
+        console.print(f"[yellow]Cần trích xuất lại thông tin: {e}[/yellow]")
+        ydl.download([url])
+
 def get_ffmpeg_path():
     """
     Tìm đường dẫn ffmpeg trong hệ thống theo thứ tự ưu tiên:
@@ -87,10 +332,17 @@ def get_ffmpeg_path():
             
     return None
 
+# Kết quả dò ffmpeg, chỉ dò một lần cho mỗi tiến trình
+_ffmpeg_path = None
+
 def _ensure_ffmpeg():
     """
     Kiểm tra và đảm bảo ffmpeg được cài đặt 
     """
+    global _ffmpeg_path
+    if _ffmpeg_path:
+        return _ffmpeg_path
+
     ffmpeg_path = get_ffmpeg_path()
     if not ffmpeg_path:
         console.print("[red]LỖI: Không tìm thấy ffmpeg trong hệ thống![/red]")
@@ -105,10 +357,31 @@ def _ensure_ffmpeg():
             console.print("Chạy lệnh: brew install ffmpeg")
         console.print("\nSau khi cài đặt, vui lòng chạy lại chương trình!")
         return None
+    _ffmpeg_path = ffmpeg_path
     return ffmpeg_path
 
-def _get_ydl_opts(proxy: str = None, download: bool = True, output_dir: str = DOWNLOADS_DIR, max_filesize: str = "50M"):
-    """Cấu hình yt-dlp để chỉ tải video MP4"""
+def warm_up() -> bool:
+    """Dò ffmpeg ngay khi khởi động để các lần tải sau không phải dò lại"""
+    return _ensure_ffmpeg() is not None
+
+# Format ưu tiên file MP4 H.264 đã có sẵn cả hình và tiếng (không cần ffmpeg ghép/chuyển đổi),
+# chỉ ghép bằng ffmpeg khi TikTok không cung cấp file như vậy
+FAST_PATH_FORMAT = (
+    'best[ext=mp4][vcodec^=h264]/best[ext=mp4][vcodec^=avc1]/best[ext=mp4]'
+    '/bestvideo[ext=mp4]+bestaudio[ext=m4a]/bestvideo+bestaudio/best'
+)
+DEFAULT_FAST_PATH = os.getenv('TIKTOK_CRAWLER_FAST_PATH', '0') == '1'
+# Không in thanh tiến trình tải của yt-dlp (CLI bật khi chạy với --quiet)
+QUIET = os.getenv('TIKTOK_CRAWLER_QUIET', '0') == '1'
+
+def _get_ydl_opts(proxy: str = None, download: bool = True, output_dir: str = DOWNLOADS_DIR, max_filesize: str = "50M",
+                  fast_path: bool = None):
+    """
+    Cấu hình yt-dlp để chỉ tải video MP4
+
+    fast_path: Ưu tiên MP4 H.264 có sẵn và bỏ bước ghi metadata bằng ffmpeg,
+        nên đa số video không phải qua ffmpeg (mặc định TIKTOK_CRAWLER_FAST_PATH)
+    """
     # Đảm bảo ffmpeg được cài đặt
     ffmpeg_path = _ensure_ffmpeg()
     if not ffmpeg_path:
@@ -134,9 +407,10 @@ def _get_ydl_opts(proxy: str = None, download: bool = True, output_dir: str = DO
         # Chỉ định đường dẫn ffmpeg
         'ffmpeg_location': ffmpeg_path,
         
-        # Tên file output
+        # Tên file output, nằm trong thư mục con theo kiểu bố trí thư mục (TIKTOK_CRAWLER_STORAGE_LAYOUT)
+        'paths': {'home': output_dir},
         'outtmpl': {
-            'default': os.path.join(output_dir, '%(title).50s_%(id)s.%(ext)s')
+            'default': storage.output_template()
         },
         
         # TikTok specific settings
@@ -161,6 +435,15 @@ def _get_ydl_opts(proxy: str = None, download: bool = True, output_dir: str = DO
         'filesize_limit': max_filesize
     }
 
+    if fast_path is None:
+        fast_path = DEFAULT_FAST_PATH
+    if fast_path:
+        ydl_opts['format'] = FAST_PATH_FORMAT
+        # FFmpegVideoConvertor tự bỏ qua khi file đã là MP4, chỉ bỏ bước metadata (luôn chạy ffmpeg)
+        ydl_opts['postprocessors'] = [pp for pp in ydl_opts['postprocessors'] if pp['key'] != 'FFmpegMetadata']
+    if QUIET:
+        ydl_opts['noprogress'] = True
+
     if not download:
         ydl_opts['simulate'] = True
         ydl_opts['skip_download'] = True
@@ -168,71 +451,344 @@ def _get_ydl_opts(proxy: str = None, download: bool = True, output_dir: str = DO
     if proxy:
         ydl_opts['proxy'] = proxy
 
+    # Tải tiếp từ file .part khi bị gián đoạn, chờ tăng dần có jitter giữa các lần thử lại của yt-dlp
+    ydl_opts['continuedl'] = True
+    ydl_opts['retry_sleep_functions'] = {
+        'http': _retry_sleep,
+        'fragment': _retry_sleep,
+        'extractor': _retry_sleep,
+    }
+
     return ydl_opts
 
-def _clean_non_mp4_files(directory):
-    """Xóa tất cả các tệp không phải MP4"""
+def _emit(progress_callback, event: str, **data):
+    """Gửi sự kiện tiến trình tới callback (nếu có), lỗi của callback không làm hỏng quá trình tải"""
+    if not progress_callback:
+        return
     try:
-        if not os.path.exists(directory):
-            return
-            
-        for file in os.listdir(directory):
-            full_path = os.path.join(directory, file)
-            if os.path.isfile(full_path) and not file.lower().endswith('.mp4'):
-                try:
-                    os.remove(full_path)
-                    console.print(f"[yellow]Đã xóa tệp phụ: {file}[/yellow]")
-                except OSError as e:
-                    console.print(f"[red]Không thể xóa {file}: {e}[/red]")
+        progress_callback({'event': event, **data})
     except Exception as e:
-        console.print(f"[red]Lỗi khi dọn dẹp tệp: {e}[/red]")
+        console.print(f"[red]Lỗi callback tiến trình: {e}[/red]")
 
-def _verify_mp4_files(directory):
-    """Kiểm tra và đổi tên các file thành .mp4 nếu cần"""
-    try:
-        if not os.path.exists(directory):
-            return
-            
-        for file in os.listdir(directory):
-            full_path = os.path.join(directory, file)
-            if os.path.isfile(full_path) and not file.lower().endswith('.mp4'):
-                # Đổi tên thành .mp4 nếu là file video
-                name, ext = os.path.splitext(file)
-                if ext.lower() in ['.webm', '.mkv', '.m4v', '.mov']:
-                    new_name = f"{name}.mp4"
-                    new_path = os.path.join(directory, new_name)
-                    try:
-                        os.rename(full_path, new_path)
-                        console.print(f"[green]Đã đổi tên: {file} -> {new_name}[/green]")
-                    except OSError as e:
-                        console.print(f"[red]Không thể đổi tên {file}: {e}[/red]")
-    except Exception as e:
-        console.print(f"[red]Lỗi khi kiểm tra file MP4: {e}[/red]")
+# Đuôi file video có thể đổi thành .mp4 mà không cần chuyển đổi
+_RENAMEABLE_VIDEO_EXTS = ('.webm', '.mkv', '.m4v', '.mov')
+# Không xóa: file MP4 và dữ liệu tải dở (yt-dlp tải tiếp từ đây ở lần thử sau)
+_RESUMABLE_EXTS = ('.mp4', '.part', '.ytdl')
+
+class _OutputTracker:
+    """
+    Theo dõi chính xác các file do một lần tải tạo ra (qua hook của yt-dlp),
+    để chỉ hoàn thiện/dọn dẹp các file đó thay vì duyệt cả thư mục. An toàn khi
+    nhiều lần tải cùng ghi vào một thư mục.
+    """
+
+    def __init__(self, progress_callback=None):
+        self.progress_callback = progress_callback
+        self.final_files = []
+        self.temp_files = set()
+        self._lock = threading.Lock()
+
+    def attach(self, ydl_opts: dict):
+        """Gắn hook theo dõi vào option (nối thêm vào các hook đã có)"""
+        ydl_opts['post_hooks'] = list(ydl_opts.get('post_hooks', [])) + [self._on_final]
+        ydl_opts['progress_hooks'] = list(ydl_opts.get('progress_hooks', [])) + [self._on_progress]
+
+    def _on_progress(self, d):
+        with self._lock:
+            for key in ('filename', 'tmpfilename'):
+                if d.get(key):
+                    self.temp_files.add(d[key])
+        if self.progress_callback:
+            info = d.get('info_dict') or {}
+            _emit(self.progress_callback, 'progress',
+                  status=d.get('status'),
+                  video_id=info.get('id'),
+                  filename=os.path.basename(d.get('filename') or ''),
+                  downloaded_bytes=d.get('downloaded_bytes'),
+                  total_bytes=d.get('total_bytes') or d.get('total_bytes_estimate'),
+                  speed=d.get('speed'),
+                  eta=d.get('eta'))
+
+    def _on_final(self, path):
+        with self._lock:
+            self.final_files.append(path)
+        _emit(self.progress_callback, 'file', path=path)
+
+    def mark(self) -> int:
+        """Vị trí hiện tại trong danh sách file cuối cùng (dùng với finalize(start))"""
+        with self._lock:
+            return len(self.final_files)
+
+    def finalize(self, start: int = 0) -> list:
+        """
+        Đổi đuôi file video cuối cùng thành .mp4 nếu cần và xóa file tạm không phải MP4
+        của lần tải này. File dở dang (.part) được giữ lại để lần thử sau tải tiếp.
+
+        Args:
+            start: Chỉ trả về các file hoàn tất sau vị trí này (xem mark())
+
+        Returns:
+            list: Đường dẫn các file MP4 cuối cùng
+        """
+        with self._lock:
+            final_files = self.final_files[start:]
+            temp_files = self.temp_files - set(self.final_files)
+
+        mp4_files = []
+        for path in final_files:
+            path = self._ensure_mp4(path)
+            if path and path not in mp4_files:
+                mp4_files.append(path)
+
+        for path in temp_files:
+            if path.lower().endswith(_RESUMABLE_EXTS) or not os.path.isfile(path):
+                continue
+            try:
+                os.remove(path)
+                get_download_index().remove(path)
+                console.print(f"[yellow]Đã xóa tệp phụ: {os.path.basename(path)}[/yellow]")
+            except OSError as e:
+                console.print(f"[red]Không thể xóa {os.path.basename(path)}: {e}[/red]")
+        return mp4_files
+
+    @staticmethod
+    def _ensure_mp4(path: str) -> str:
+        if path.lower().endswith('.mp4'):
+            return path if os.path.isfile(path) else None
+        name, ext = os.path.splitext(path)
+        new_path = f"{name}.mp4"
+        if ext.lower() not in _RENAMEABLE_VIDEO_EXTS or not os.path.isfile(path):
+            return new_path if os.path.isfile(new_path) else None
+        try:
+            os.rename(path, new_path)
+            get_download_index().rename(path, new_path)
+            console.print(f"[green]Đã đổi tên: {os.path.basename(path)} -> {os.path.basename(new_path)}[/green]")
+            return new_path
+        except OSError as e:
+            console.print(f"[red]Không thể đổi tên {os.path.basename(path)}: {e}[/red]")
+            return None
+
+def _add_postprocessor_hook(ydl_opts: dict, progress_callback, timings: list):
+    """Ghi lại các bước hậu xử lý đã chạy cho từng video và thời gian của mỗi bước"""
+    started = {}
+
+    def hook(d):
+        name = d.get('postprocessor')
+        video_id = (d.get('info_dict') or {}).get('id')
+        key = (name, video_id)
+        if d.get('status') == 'started':
+            started[key] = time.perf_counter()
+            _emit(progress_callback, 'postprocessor', status='started', postprocessor=name, video_id=video_id,
+                  ffmpeg=bool(name and name.startswith('FFmpeg')))
+        elif d.get('status') == 'finished' and key in started:
+            timing = {
+                'postprocessor': name,
+                'video_id': video_id,
+                'seconds': round(time.perf_counter() - started.pop(key), 3),
+                'ffmpeg': bool(name and name.startswith('FFmpeg')),
+            }
+            timings.append(timing)
+            if timing['ffmpeg']:
+                get_metrics().observe('ffmpeg_seconds', timing['seconds'])
+            _emit(progress_callback, 'postprocessor', status='finished', **timing)
+
+    ydl_opts['postprocessor_hooks'] = list(ydl_opts.get('postprocessor_hooks', [])) + [hook]
 
-def download_video(url: str, proxy: str = None, output_dir: str = DOWNLOADS_DIR, limit: int = None) -> tuple[bool, str]:
+def _report_postprocessors(timings: list):
+    """In tóm tắt các bước ffmpeg đã chạy"""
+    ffmpeg_steps = [t for t in timings if t['ffmpeg']]
+    if not ffmpeg_steps:
+        console.print("[green]Không cần chạy ffmpeg (MP4 có sẵn)[/green]")
+        return
+    total = sum(t['seconds'] for t in ffmpeg_steps)
+    steps = ", ".join(f"{t['postprocessor']} {t['seconds']}s" for t in ffmpeg_steps)
+    console.print(f"[cyan]Hậu xử lý ffmpeg ({total:.2f}s): {steps}[/cyan]")
+
+# Từ khóa cho lỗi vĩnh viễn (video riêng tư/đã xóa), được lưu tạm vào cache
+PERMANENT_ERROR_KEYWORDS = ["private", "removed", "deleted", "unavailable", "not available", "does not exist"]
+# Từ khóa cho lỗi bị giới hạn tốc độ, bị chặn IP/proxy hoặc theo vùng, và lỗi mạng tạm thời
+THROTTLED_ERROR_KEYWORDS = ["429", "too many requests", "rate limit", "rate-limit"]
+BLOCKED_ERROR_KEYWORDS = ["blocked", "403", "captcha", "verify you are human", "not available in your country",
+                          "geo restrict", "geo-restrict", "your region", "your location"]
+NETWORK_ERROR_KEYWORDS = ["timed out", "timeout", "connection", "proxy", "tunnel", "unreachable",
+                          "name resolution", "name or service not known", "transporterror", "ssl",
+                          "eof occurred", "incomplete read", "did not get any data", "500", "502", "503", "504"]
+
+# Loại lỗi: mạng tạm thời và bị giới hạn (thử lại sau khi chờ), bị chặn IP/theo vùng (thử proxy khác),
+# lỗi vĩnh viễn của video (không thử lại, proxy vẫn hoạt động)
+ERROR_NETWORK = "network"
+ERROR_THROTTLED = "throttled"
+ERROR_BLOCKED = "blocked"
+ERROR_PERMANENT = "permanent"
+RETRYABLE_ERRORS = (ERROR_NETWORK, ERROR_THROTTLED)
+
+# Số lần thử cho mỗi video khi gặp lỗi tạm thời, thời gian chờ cơ sở và tối đa (giây)
+RETRY_ATTEMPTS = int(os.getenv('TIKTOK_CRAWLER_RETRIES', '3'))
+RETRY_BACKOFF = float(os.getenv('TIKTOK_CRAWLER_RETRY_BACKOFF', '2'))
+RETRY_MAX_BACKOFF = float(os.getenv('TIKTOK_CRAWLER_RETRY_MAX_BACKOFF', '60'))
+
+def _keyword_pattern(keywords: list):
+    # Mã HTTP chỉ khớp nguyên số, không khớp một phần ID video trong thông báo lỗi
+    return re.compile('|'.join(rf'\b{k}\b' if k.isdigit() else re.escape(k) for k in keywords))
+
+_ERROR_PATTERNS = [
+    (ERROR_THROTTLED, _keyword_pattern(THROTTLED_ERROR_KEYWORDS)),
+    (ERROR_BLOCKED, _keyword_pattern(BLOCKED_ERROR_KEYWORDS)),
+    # Lỗi mạng xét trước lỗi vĩnh viễn: "503 Service Unavailable" là lỗi tạm thời
+    (ERROR_NETWORK, _keyword_pattern(NETWORK_ERROR_KEYWORDS)),
+    (ERROR_PERMANENT, _keyword_pattern(PERMANENT_ERROR_KEYWORDS)),
+]
+
+def _classify_error(error_msg: str) -> str:
+    """Phân loại thông báo lỗi của yt-dlp, None nếu không xác định"""
+    error_msg = (error_msg or "").lower()
+    for error_kind, pattern in _ERROR_PATTERNS:
+        if pattern.search(error_msg):
+            return error_kind
+    return None
+
+def _backoff_delay(attempt: int) -> float:
+    """Thời gian chờ trước lần thử thứ attempt + 1: lũy thừa 2 có jitter ngẫu nhiên (full jitter)"""
+    return random.uniform(0, min(RETRY_MAX_BACKOFF, RETRY_BACKOFF * 2 ** (attempt - 1)))
+
+def _retry_sleep(n: int) -> float:
+    """Hàm chờ cho các lần thử lại bên trong yt-dlp (n bắt đầu từ 0)"""
+    return _backoff_delay(n + 1)
+
+def _with_retries(operation, attempts: int = None):
+    """
+    Chạy operation(attempt) -> (success, message, error_kind, ...), thử lại lỗi mạng tạm thời
+    và lỗi bị giới hạn với thời gian chờ tăng dần. File dở dang (.part) được giữ lại nên lần thử
+    sau tải tiếp từ chỗ đã dừng.
+    """
+    attempts = max(1, attempts or RETRY_ATTEMPTS)
+    for attempt in range(1, attempts + 1):
+        result = operation(attempt)
+        success, error_kind = result[0], result[2]
+        if success or error_kind not in RETRYABLE_ERRORS or attempt == attempts:
+            return result
+        delay = _backoff_delay(attempt)
+        console.print(f"[yellow]Lỗi tạm thời ({error_kind}), thử lại lần {attempt + 1}/{attempts} "
+                      f"sau {delay:.1f}s...[/yellow]")
+        time.sleep(delay)
+    return result
+
+def _with_proxy_failover(proxy: str, operation) -> tuple[bool, str]:
+    """
+    Chạy operation(proxy) -> (success, message, error_kind).
+
+    Proxy chỉ định rõ được dùng trực tiếp. Nếu không, chọn proxy khỏe nhất từ nhóm proxy
+    đã cấu hình, ghi nhận kết quả và tự động thử proxy khác khi bị chặn hoặc lỗi kết nối
+    (sau khi đã thử lại lỗi tạm thời trên proxy hiện tại).
+    """
+    pool = get_proxy_pool()
+    if proxy or not pool:
+        success, message, _ = operation(proxy)
+        return success, message
+
+    tried = []
+    result = None
+    for _ in range(pool.attempts):
+        candidate = pool.choose(exclude=tried)
+        if candidate is None:
+            break
+        tried.append(candidate)
+        started = time.monotonic()
+        success, message, error_kind = operation(candidate)
+        elapsed = time.monotonic() - started
+        result = success, message
+
+        if not success and error_kind in (ERROR_BLOCKED, ERROR_THROTTLED, ERROR_NETWORK):
+            outcome = OUTCOME_FAILURE if error_kind == ERROR_NETWORK else OUTCOME_BLOCKED
+            pool.report(candidate, outcome, elapsed, message)
+            console.print(f"[yellow]Proxy {mask_proxy(candidate)} lỗi ({error_kind}), thử proxy khác...[/yellow]")
+            continue
+        if success or error_kind == ERROR_PERMANENT:
+            pool.report(candidate, OUTCOME_SUCCESS, elapsed)
+        return result
+
+    if result:
+        return result
+    wait = pool.next_available_in()
+    return False, f"Tất cả proxy đang tạm ngưng do lỗi, thử lại sau {wait:.0f} giây"
+
+def download_video(url: str, proxy: str = None, output_dir: str = DOWNLOADS_DIR, limit: int = None,
+                   progress_callback=None, fast_path: bool = None) -> tuple[bool, str]:
     """
     Tải video TikTok dưới định dạng MP4
     
     Args:
         url: URL của video TikTok
-        proxy: Proxy tùy chọn
+        proxy: Proxy tùy chọn (mặc định dùng nhóm proxy đã cấu hình, nếu có)
         output_dir: Thư mục lưu video
         limit: Số lượng video tối đa (không áp dụng cho video đơn)
+        progress_callback: Hàm nhận các sự kiện tiến trình (dict có khóa 'event')
+        fast_path: Ưu tiên MP4 có sẵn, chỉ chạy ffmpeg khi cần (mặc định TIKTOK_CRAWLER_FAST_PATH)
     
+    Các yêu cầu trùng video (cùng ID video và thư mục) được gộp giữa mọi tiến trình: yêu cầu đầu tiên
+    tải, yêu cầu đến trong lúc đó chờ và nhận kết quả của nó, yêu cầu sau đó trả về ngay file đã có.
+
     Returns:
         tuple: (success: bool, message: str)
     """
+    def operation():
+        files = []
+
+        def on_event(event):
+            if event.get('event') == 'file':
+                files.append(event['path'])
+            if progress_callback:
+                progress_callback(event)
+
+        success, message = _with_proxy_failover(proxy, lambda p: _with_retries(
+            lambda attempt: _download_video(url, p, output_dir, on_event, fast_path)))
+        return success, message, _final_paths(files)
+
+    key = f"{os.path.abspath(output_dir)}|{canonical_video_key(url)}"
+    success, message, files, role = get_single_flight().run(key, operation, lambda: _existing_video(url, output_dir))
+    if role in ('shared', 'existing'):
+        get_metrics().inc('coalesced_requests_total', result=role)
+        console.print(f"[green]{message}[/green]" if success else f"[red]{message}[/red]")
+        _emit(progress_callback, 'start', total=1)
+        for path in files:
+            _emit(progress_callback, 'file', path=path)
+    return success, message
+
+def _final_paths(files: list) -> list:
+    """Đường dẫn thực của các file đã báo qua sự kiện 'file' (có thể đã được đổi đuôi thành .mp4)"""
+    paths = []
+    for path in files:
+        for option in (path, os.path.splitext(path)[0] + '.mp4'):
+            if os.path.isfile(option) and option not in paths:
+                paths.append(option)
+                break
+    return paths
+
+def _existing_video(url: str, output_dir: str):
+    """(True, message, files) nếu video của URL đã được tải vào thư mục (theo chỉ mục), None nếu chưa"""
+    key = canonical_video_key(url)
+    if not key.startswith('id:'):
+        return None
+    paths = [row['path'] for row in get_download_index().find_by_video_id(key[3:], output_dir)
+             if row['path'].lower().endswith('.mp4') and os.path.isfile(row['path'])][:1]
+    if not paths:
+        return None
+    return True, f"Video đã có sẵn: {os.path.basename(paths[0])}", paths
+
+def _download_video(url: str, proxy: str, output_dir: str, progress_callback=None,
+                    fast_path: bool = None) -> tuple[bool, str, str]:
+    """Một lần tải video qua một proxy, trả về thêm loại lỗi (xem _classify_error)"""
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
     try:
         # Kiểm tra và chuẩn hóa URL
         if not url:
-            return False, "URL không được để trống"
+            return False, "URL không được để trống", None
             
         # Kiểm tra xem có phải là URL TikTok không
         if not any(x in url.lower() for x in ['tiktok.com', 'douyin.com']):
-            return False, "URL không phải là URL TikTok hợp lệ"
+            return False, "URL không phải là URL TikTok hợp lệ", None
             
         # Nếu URL chứa tham số query (sau dấu ?), loại bỏ chúng
         clean_url = url.split('?')[0]
@@ -240,24 +796,28 @@ def download_video(url: str, proxy: str = None, output_dir: str = DOWNLOADS_DIR,
         
         console.print(f"[blue]Đang tải video: {clean_url}[/blue]")
         if proxy:
-            console.print(f"[blue]Sử dụng proxy: {proxy}[/blue]")
+            console.print(f"[blue]Sử dụng proxy: {mask_proxy(proxy)}[/blue]")
 
         # Kiểm tra và lấy cấu hình ffmpeg
-        ydl_opts = _get_ydl_opts(proxy=proxy, download=True, output_dir=output_dir)
+        ydl_opts = _get_ydl_opts(proxy=proxy, download=True, output_dir=output_dir, fast_path=fast_path)
         if not ydl_opts:
-            return False, "Chưa cài đặt ffmpeg. Vui lòng cài đặt ffmpeg theo hướng dẫn và thử lại."
+            return False, "Chưa cài đặt ffmpeg. Vui lòng cài đặt ffmpeg theo hướng dẫn và thử lại.", None
             
         # Thêm cấu hình đặc biệt cho TikTok
-        ydl_opts.update({
-            'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/mp4',
-            'force_generic_extractor': False
-        })
+        ydl_opts['force_generic_extractor'] = False
+        if ydl_opts['format'] != FAST_PATH_FORMAT:
+            ydl_opts['format'] = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/mp4'
+        tracker = _OutputTracker(progress_callback)
+        tracker.attach(ydl_opts)
+        pp_timings = []
+        _add_postprocessor_hook(ydl_opts, progress_callback, pp_timings)
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        _call_state.last_error = None
+        with _session_pool.session(ydl_opts) as ydl:
             # Lấy thông tin video trước
             info = ydl.extract_info(clean_url, download=False)
             if not info:
-                return False, "Không thể lấy thông tin video"
+                return False, "Không thể lấy thông tin video", None
             
             # Debug thông tin response
             console.print("[yellow]Debug - Keys trong response:[/yellow]")
@@ -273,98 +833,814 @@ def download_video(url: str, proxy: str = None, output_dir: str = DOWNLOADS_DIR,
             console.print(f"[cyan]- Tiêu đề: {video_title}[/cyan]")
             console.print(f"[cyan]- Tác giả: {uploader}[/cyan]")
             console.print(f"[cyan]- Thời lượng: {duration}s[/cyan]")
+            _emit(progress_callback, 'start', total=1)
             
-            # Tải video
-            ydl.download([url])
-            
-            # Kiểm tra và đảm bảo file là MP4
-            _verify_mp4_files(output_dir)
-            _clean_non_mp4_files(output_dir)
+            # Tải video từ thông tin đã trích xuất (không trích xuất lần hai)
+            _download_with_info(ydl, info, clean_url)
+            _report_postprocessors(pp_timings)
             
-            # Kiểm tra xem có file MP4 nào được tạo không
-            mp4_files = [f for f in os.listdir(output_dir) if f.lower().endswith('.mp4')]
+            # Hoàn thiện file MP4 của chính lần tải này (ghi nhận từ hook), hoặc dùng bản đã có trong chỉ mục
+            mp4_files = tracker.finalize()[-1:]
+            if not mp4_files:
+                mp4_files = [row['path'] for row in get_download_index().find_by_video_id(video_id, output_dir)
+                             if os.path.isfile(row['path'])][:1]
             if mp4_files:
-                latest_file = max(mp4_files, key=lambda x: os.path.getctime(os.path.join(output_dir, x)))
+                latest_file = os.path.basename(mp4_files[0])
                 console.print(f"[green]Tải thành công: {latest_file}[/green]")
-                return True, f"Tải video thành công: {latest_file}"
-            else:
-                return False, "Không tìm thấy file MP4 sau khi tải"
+                return True, f"Tải video thành công: {latest_file}", None
+            error = getattr(_call_state, 'last_error', None)
+            if error:
+                return False, f"Lỗi tải video: {error}", _classify_error(error)
+            return False, "Không tìm thấy file MP4 sau khi tải", None
 
     except yt_dlp.utils.DownloadError as e:
         error_msg = str(e)
         console.print(f"[red]Lỗi tải video: {error_msg}[/red]")
         
         if any(keyword in error_msg.lower() for keyword in ["blocked", "timed out", "403", "404"]):
-            return False, "IP bị chặn hoặc video không khả dụng. Thử sử dụng proxy."
-        return False, f"Lỗi tải video: {error_msg}"
+            return False, "IP bị chặn hoặc video không khả dụng. Thử sử dụng proxy.", _classify_error(error_msg)
+        return False, f"Lỗi tải video: {error_msg}", _classify_error(error_msg)
         
     except Exception as e:
         msg = f"Lỗi không mong muốn: {e}"
         console.print(f"[red]{msg}[/red]")
-        return False, msg
+        return False, msg, _classify_error(str(e))
+
+def _format_video_info(info: dict) -> str:
+    """Định dạng thông tin video để hiển thị"""
+    return (
+        f"Tiêu đề: {info.get('title', 'N/A')}\n"
+        f"Tác giả: {info.get('uploader', 'N/A')}\n"
+        f"Ngày tải: {info.get('upload_date', 'N/A')}\n"
+        f"Thời lượng: {info.get('duration_string', 'N/A')}\n"
+        f"Lượt xem: {info.get('view_count', 'N/A')}\n"
+        f"Lượt thích: {info.get('like_count', 'N/A')}\n"
+        f"Bình luận: {info.get('comment_count', 'N/A')}\n"
+        f"URL: {info.get('webpage_url', 'N/A')}"
+    )
 
-def get_video_info(url: str, proxy: str = None) -> tuple[bool, str]:
-    """Lấy thông tin video TikTok"""
+def _show_video_info(info_text: str, cached: bool = False):
+    title = "[bold blue]Thông tin Video[/bold blue]"
+    if cached:
+        title = "[bold blue]Thông tin Video (cache)[/bold blue]"
+    console.print(Panel(
+        Text(info_text, justify="left"),
+        title=title,
+        border_style="blue"
+    ))
+
+def get_video_info(url: str, proxy: str = None, use_cache: bool = True) -> tuple[bool, str]:
+    """
+    Lấy thông tin video TikTok
+
+    Args:
+        url: URL của video TikTok
+        proxy: Proxy tùy chọn (mặc định dùng nhóm proxy đã cấu hình, nếu có)
+        use_cache: Dùng cache thông tin video dùng chung (TTL, LRU, lưu tạm lỗi vĩnh viễn)
+    """
+    info_cache = None
+    cache_key = None
     try:
         console.print(f"[blue]Đang lấy thông tin video: {url}[/blue]")
+
+        if use_cache:
+            info_cache = get_info_cache()
+            cache_key = canonical_video_key(url)
+            cached = info_cache.get(cache_key)
+            if cached is not None:
+                success, cached_info = cached
+                if not success:
+                    console.print(f"[yellow]Lỗi đã lưu trong cache: {cached_info}[/yellow]")
+                    return False, cached_info
+                info_text = _format_video_info(cached_info)
+                _show_video_info(info_text, cached=True)
+                return True, info_text
+    except Exception as e:
+        msg = f"Lỗi không mong muốn: {e}"
+        console.print(f"[red]{msg}[/red]")
+        return False, msg
+
+    return _with_proxy_failover(proxy, lambda p: _with_retries(
+        lambda attempt: _fetch_video_info(url, p, info_cache, cache_key)))
+
+def _fetch_video_info(url: str, proxy: str, info_cache=None, cache_key: str = None) -> tuple[bool, str, str]:
+    """Một lần lấy thông tin video qua một proxy, trả về thêm loại lỗi (xem _classify_error)"""
+    try:
         if proxy:
-            console.print(f"[blue]Sử dụng proxy: {proxy}[/blue]")
+            console.print(f"[blue]Sử dụng proxy: {mask_proxy(proxy)}[/blue]")
 
         # Kiểm tra và lấy cấu hình ffmpeg
         ydl_opts = _get_ydl_opts(proxy=proxy, download=False)
         if not ydl_opts:
-            return False, "Chưa cài đặt ffmpeg. Vui lòng cài đặt ffmpeg theo hướng dẫn và thử lại."
+            return False, "Chưa cài đặt ffmpeg. Vui lòng cài đặt ffmpeg theo hướng dẫn và thử lại.", None
+        # Để lỗi được ném ra và phân loại (cần cho việc lưu tạm lỗi vĩnh viễn)
+        ydl_opts['ignoreerrors'] = False
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with _session_pool.session(ydl_opts) as ydl:
             info = ydl.extract_info(url, download=False)
             if info:
+                if info_cache:
+                    keys = [cache_key]
+                    if info.get('id'):
+                        keys.append(f"id:{info['id']}")
+                    info_cache.put(keys, info)
+
                 # Format thông tin video
-                info_text = (
-                    f"Tiêu đề: {info.get('title', 'N/A')}\n"
-                    f"Tác giả: {info.get('uploader', 'N/A')}\n"
-                    f"Ngày tải: {info.get('upload_date', 'N/A')}\n"
-                    f"Thời lượng: {info.get('duration_string', 'N/A')}\n"
-                    f"Lượt xem: {info.get('view_count', 'N/A')}\n"
-                    f"Lượt thích: {info.get('like_count', 'N/A')}\n"
-                    f"Bình luận: {info.get('comment_count', 'N/A')}\n"
-                    f"URL: {info.get('webpage_url', 'N/A')}"
-                )
-                
-                console.print(Panel(
-                    Text(info_text, justify="left"),
-                    title="[bold blue]Thông tin Video[/bold blue]",
-                    border_style="blue"
-                ))
-                return True, info_text
+                info_text = _format_video_info(info)
+                _show_video_info(info_text)
+                return True, info_text, None
             else:
-                return False, "Không thể lấy thông tin video"
+                return False, "Không thể lấy thông tin video", None
 
     except yt_dlp.utils.DownloadError as e:
         error_msg = str(e)
         console.print(f"[red]Lỗi lấy thông tin: {error_msg}[/red]")
         
         if any(keyword in error_msg.lower() for keyword in ["blocked", "timed out", "403", "404"]):
-            return False, "IP bị chặn hoặc video không khả dụng. Thử sử dụng proxy."
-        return False, f"Lỗi: {error_msg}"
+            message = "IP bị chặn hoặc video không khả dụng. Thử sử dụng proxy."
+        else:
+            message = f"Lỗi: {error_msg}"
+
+        # Video riêng tư/đã xóa: lưu tạm kết quả lỗi để không gọi lại TikTok liên tục
+        error_kind = _classify_error(error_msg)
+        if info_cache and error_kind == ERROR_PERMANENT:
+            info_cache.put_error(cache_key, message)
+        return False, message, error_kind
         
     except Exception as e:
         msg = f"Lỗi không mong muốn: {e}"
         console.print(f"[red]{msg}[/red]")
-        return False, msg
+        return False, msg, _classify_error(str(e))
+
+def _download_info_entry(ydl, entry: dict, entry_url: str, tracker: _OutputTracker,
+                         attempt: int) -> tuple[bool, str, str, list]:
+    """
+    Tải một video của playlist từ info đã trích xuất. Lần thử lại trích xuất lại từ URL
+    của video (link format có thể đã hết hạn); file .part của lần trước được tải tiếp.
+
+    Returns:
+        tuple: (success: bool, message: str, error_kind: str, files: list)
+    """
+    start = tracker.mark()
+    _call_state.last_error = None
+    error = None
+    try:
+        if attempt == 1:
+            _download_with_info(ydl, entry, entry_url)
+        else:
+            ydl.download([entry_url])
+    except yt_dlp.utils.DownloadError as e:
+        error = str(e)
+    except Exception as e:
+        error = f"Lỗi không mong muốn: {e}"
+
+    files = tracker.finalize(start)
+    if files:
+        return True, f"Tải thành công: {os.path.basename(files[-1])}", None, files
+    error = error or getattr(_call_state, 'last_error', None)
+    if error:
+        return False, f"Lỗi tải video: {error}", _classify_error(error), files
+    return False, "Không tải được video", None, files
+
+def _entry_url(entry: dict, info: dict) -> str:
+    """URL trang của một video trong playlist"""
+    entry_url = entry.get('webpage_url') or entry.get('original_url')
+    if not entry_url and entry.get('_type') in ('url', 'url_transparent'):
+        entry_url = entry.get('url')
+    if not entry_url:
+        entry_url = f"https://www.tiktok.com/@{info.get('uploader_id', '_')}/video/{entry.get('id')}"
+    return entry_url
+
+def _record_result(results: list, total: int, idx: int, entry: dict, entry_url: str, outcome: tuple,
+                   progress_callback=None):
+    """Ghi kết quả tải của một video vào danh sách kết quả và báo sự kiện 'video'"""
+    success, message, error_kind, files = outcome
+    result = {
+        'index': idx,
+        'id': entry.get('id'),
+        'url': entry_url,
+        'success': success,
+        'message': message,
+        'error': error_kind,
+        'files': files,
+    }
+    results.append(result)
+    _emit(progress_callback, 'video', **result)
+    if success:
+        console.print(f"[green]{idx}/{total} {message}[/green]")
+    else:
+        console.print(f"[red]{idx}/{total} {entry_url}: {message}[/red]")
+
+def _summarize_results(results: list, total: int, output_dir: str) -> tuple[bool, str, str]:
+    """
+    Tổng kết danh sách kết quả từng video thành (success, message, error_kind).
+    Khi mọi video đều lỗi cùng một loại (ví dụ bị chặn), trả về loại lỗi đó để thử proxy khác.
+    """
+    succeeded = sum(1 for r in results if r['success'])
+    failed = total - succeeded
+    if succeeded > 0:
+        message = f"Đã tải {succeeded}/{total} video MP4 thành công"
+        if failed:
+            message += f", {failed} video lỗi"
+        console.print(f"[green]{message} vào {output_dir}[/green]")
+        return True, message, None
+    error_kinds = {r['error'] for r in results}
+    error_kind = error_kinds.pop() if len(error_kinds) == 1 else None
+    return False, f"Không có video MP4 nào được tải về ({failed} video lỗi)", error_kind
+
+# Pipeline tải nhiều video: trích xuất thông tin -> tải dữ liệu -> hậu xử lý bằng ffmpeg,
+# mỗi bước một giới hạn song song riêng
+PIPELINE_RESOLVE_WORKERS = int(os.getenv('TIKTOK_CRAWLER_PIPELINE_RESOLVE_WORKERS', '4'))
+PIPELINE_FETCH_WORKERS = int(os.getenv('TIKTOK_CRAWLER_PIPELINE_FETCH_WORKERS', '8'))
+# Số tiến trình hậu xử lý (0 = bằng số CPU), giới hạn chung cho mọi tiến trình trên máy
+PIPELINE_POSTPROCESS_WORKERS = int(os.getenv('TIKTOK_CRAWLER_PIPELINE_POSTPROCESS_WORKERS', '0'))
+POSTPROCESS_PROCESSES = max(1, PIPELINE_POSTPROCESS_WORKERS or os.cpu_count() or 1)
+# Số video tối đa chờ trong hàng đợi giữa hai bước
+PIPELINE_QUEUE_SIZE = int(os.getenv('TIKTOK_CRAWLER_PIPELINE_QUEUE_SIZE', '16'))
 
-def download_user_videos(user_url: str, proxy: str = None, limit: int = None, output_dir: str = DOWNLOADS_DIR) -> tuple[bool, str]:
+PIPELINE_STAGES = ('resolve', 'fetch', 'postprocess')
+
+# Option của yt-dlp cần cho bước hậu xử lý trong tiến trình con
+_POSTPROCESS_PARAMS = ('ffmpeg_location', 'postprocessors', 'paths', 'outtmpl', 'keepvideo',
+                       'merge_output_format', 'final_ext', 'postprocessor_args', 'ignoreerrors', 'quiet',
+                       'no_warnings')
+
+# Nhóm tiến trình hậu xử lý dùng chung cho mọi pipeline trong tiến trình (tạo khi cần, đóng khi thoát)
+_postprocess_pool = None
+_postprocess_slots = None
+_postprocess_pool_lock = threading.Lock()
+
+def _get_postprocess_pool() -> ProcessPoolExecutor:
+    """
+    Nhóm tiến trình hậu xử lý của tiến trình này. Tiến trình con được tạo qua forkserver/spawn,
+    không fork từ tiến trình đang có thread (gunicorn, job), kết nối SQLite hay khóa đang giữ.
+    """
+    global _postprocess_pool
+    with _postprocess_pool_lock:
+        if _postprocess_pool is None:
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload([__name__])
+            else:
+                context = multiprocessing.get_context('spawn')
+            _postprocess_pool = ProcessPoolExecutor(max_workers=POSTPROCESS_PROCESSES, mp_context=context)
+        return _postprocess_pool
+
+def _discard_postprocess_pool(pool: ProcessPoolExecutor):
+    """Bỏ nhóm tiến trình bị hỏng (một tiến trình con chết), lần sau tạo nhóm mới"""
+    global _postprocess_pool
+    with _postprocess_pool_lock:
+        if _postprocess_pool is pool:
+            _postprocess_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+@atexit.register
+def _shutdown_postprocess_pool():
+    global _postprocess_pool
+    with _postprocess_pool_lock:
+        pool, _postprocess_pool = _postprocess_pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def _get_postprocess_slots() -> ProcessSemaphore:
+    """Số lượt hậu xử lý chạy cùng lúc trên cả máy (mọi worker gunicorn, job, CLI) tối đa bằng số CPU"""
+    global _postprocess_slots
+    with _postprocess_pool_lock:
+        if _postprocess_slots is None:
+            _postprocess_slots = ProcessSemaphore('postprocess', POSTPROCESS_PROCESSES)
+        return _postprocess_slots
+
+def _supports_deferred_postprocessing() -> bool:
+    """
+    Phiên bản yt-dlp đang cài có đủ các điểm móc để tách hậu xử lý sang tiến trình con:
+    post_process(filename, info, files_to_move), add_post_processor, sanitize_info và get_postprocessor
+    """
+    if get_postprocessor is None:
+        return False
+    if not all(hasattr(yt_dlp.YoutubeDL, name) for name in ('post_process', 'add_post_processor', 'sanitize_info')):
+        return False
+    try:
+        parameters = list(inspect.signature(yt_dlp.YoutubeDL.post_process).parameters)
+    except (TypeError, ValueError):
+        return False
+    return parameters[1:4] == ['filename', 'info', 'files_to_move']
+
+_DEFERRED_POSTPROCESSING = _supports_deferred_postprocessing()
+
+def _postprocessor_specs(postprocessors: list) -> list:
+    """
+    Spec dạng option 'postprocessors' của yt-dlp ({'key': ..., tham số...}) cho các bước ghép/sửa lỗi
+    yt-dlp đã lên lịch cho một video. yt-dlp tạo các bước này chỉ với YoutubeDL (cls(ydl)), nên
+    dựng lại được khi mọi tham số khác của hàm khởi tạo đều có giá trị mặc định.
+    None nếu có bước không dựng lại được như vậy.
+    """
+    specs = []
+    for pp in postprocessors or []:
+        # Khóa của get_postprocessor là tên lớp bỏ hậu tố PP (ví dụ FFmpegMerger)
+        key = type(pp).__name__[:-2] if type(pp).__name__.endswith('PP') else None
+        try:
+            cls = get_postprocessor(key)
+        except (KeyError, TypeError):
+            return None
+        if type(pp) is not cls:
+            return None
+        parameters = list(inspect.signature(cls.__init__).parameters.values())[2:]
+        if any(p.default is p.empty and p.kind not in (p.VAR_POSITIONAL, p.VAR_KEYWORD) for p in parameters):
+            return None
+        specs.append({'key': key})
+    return specs
+
+def _build_postprocessor(ydl, spec: dict):
+    """Tạo post-processor từ spec dạng option 'postprocessors' của yt-dlp, trả về (pp, when)"""
+    spec = dict(spec)
+    when = spec.pop('when', 'post_process')
+    return get_postprocessor(spec.pop('key'))(ydl, **spec), when
+
+def _run_postprocessors(job: dict, params: dict) -> dict:
+    """
+    Chạy các bước hậu xử lý của một video đã tải xong (ghép hình/tiếng, sửa lỗi, chuyển MP4,
+    metadata, di chuyển file) trong tiến trình con của DownloadPipeline
+
+    Returns:
+        dict: filepath cuối cùng, thời gian từng bước (timings) và lỗi (error) nếu có
+    """
+    timings = []
+    started = {}
+
+    def hook(d):
+        name = d.get('postprocessor')
+        if d.get('status') == 'started':
+            started[name] = time.perf_counter()
+        elif d.get('status') == 'finished' and name in started:
+            timings.append({
+                'postprocessor': name,
+                'video_id': job['info'].get('id'),
+                'seconds': round(time.perf_counter() - started.pop(name), 3),
+                'ffmpeg': bool(name and name.startswith('FFmpeg')),
+            })
+
+    result = {'filepath': None, 'timings': timings, 'error': None}
+    try:
+        opts = dict(params, postprocessor_hooks=[hook])
+        configured = opts.pop('postprocessors', None) or []
+        # Hậu xử lý không cần extractor nào
+        with yt_dlp.YoutubeDL(opts, auto_init=False) as ydl:
+            # Cùng thứ tự như yt-dlp: các bước ghép/sửa lỗi đã lên lịch trước các bước đã cấu hình
+            for spec in job['postprocessors'] + list(configured):
+                ydl.add_post_processor(*_build_postprocessor(ydl, spec))
+            info = ydl.post_process(job['filename'], dict(job['info']), job['files_to_move'])
+            result['filepath'] = info.get('filepath')
+    except Exception as e:
+        result['error'] = str(e)
+    return result
+
+class _StageStats:
+    """Số liệu một bước của pipeline: số video, thời gian bận, thời gian chờ trong hàng đợi"""
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.queue_wait = 0.0
+        self.max_queue = 0
+        self._lock = threading.Lock()
+
+    def queued(self, depth: int):
+        with self._lock:
+            self.max_queue = max(self.max_queue, depth)
+
+    def record(self, busy: float, waited: float, success: bool):
+        with self._lock:
+            self.items += 1
+            self.failed += 0 if success else 1
+            self.busy += busy
+            self.queue_wait += waited
+        metrics = get_metrics()
+        metrics.inc('pipeline_busy_seconds_total', busy, stage=self.name)
+        metrics.inc('pipeline_items_total', stage=self.name, result='ok' if success else 'error')
+
+    def as_dict(self, elapsed: float) -> dict:
+        with self._lock:
+            capacity = self.workers * elapsed
+            return {
+                'workers': self.workers,
+                'items': self.items,
+                'failed': self.failed,
+                'busy_seconds': round(self.busy, 3),
+                # Tỷ lệ thời gian các worker của bước này bận trong suốt lần chạy
+                'utilisation': round(self.busy / capacity, 3) if capacity else 0.0,
+                'avg_queue_wait_seconds': round(self.queue_wait / self.items, 3) if self.items else 0.0,
+                'max_queue': self.max_queue,
+            }
+
+def _report_pipeline(stages: dict):
+    """In mức sử dụng của từng bước pipeline (để chỉnh số worker)"""
+    for name, stage in stages.items():
+        console.print(f"[cyan]Pipeline {name}: {stage['workers']} worker, {stage['items']} video, "
+                      f"bận {stage['utilisation']:.0%}, chờ hàng đợi trung bình "
+                      f"{stage['avg_queue_wait_seconds']:.2f}s (tối đa {stage['max_queue']})[/cyan]")
+
+class DownloadPipeline:
+    """
+    Tải nhiều video qua ba bước nối với nhau bằng hàng đợi có giới hạn: trích xuất thông tin
+    (resolve), tải dữ liệu (fetch) và hậu xử lý (postprocess). Mỗi bước có số worker riêng:
+    nhiều lượt tải mạng song song, còn ffmpeg chạy trong nhóm tiến trình dùng chung của tiến trình,
+    giới hạn theo số CPU cho cả máy (khóa file trong thư mục trạng thái), nên một lần ghép ffmpeg chậm không làm mạng đứng chờ và ngược lại.
+
+    Hàng đợi đầy thì bước trước dừng lại chờ, nên số video nằm giữa các bước luôn có giới hạn.
+    """
+
+    def __init__(self, proxy: str = None, output_dir: str = DOWNLOADS_DIR, fast_path: bool = None,
+                 progress_callback=None, resolve_workers: int = None, fetch_workers: int = None,
+                 postprocess_workers: int = None, queue_size: int = None):
+        self.proxy = proxy
+        self.output_dir = output_dir
+        self.fast_path = fast_path
+        self.progress_callback = progress_callback
+        self.workers = {
+            'resolve': max(1, resolve_workers or PIPELINE_RESOLVE_WORKERS),
+            'fetch': max(1, fetch_workers or PIPELINE_FETCH_WORKERS),
+            'postprocess': max(1, postprocess_workers or POSTPROCESS_PROCESSES),
+        }
+        self.queue_size = max(1, queue_size or PIPELINE_QUEUE_SIZE)
+        self.pp_timings = []
+        self._stats = {}
+        self._succeeded = 0
+        self._on_result = None
+        self._result_lock = threading.Lock()
+
+    def run(self, urls: list, on_result=None) -> dict:
+        """
+        Tải danh sách URL video qua pipeline.
+
+        Args:
+            urls: Danh sách URL video (hoặc các cặp (index, URL))
+            on_result: Hàm nhận (index, url, (success, message, error_kind, files), elapsed)
+                ngay khi từng video xong (được gọi từ các thread của pipeline)
+
+        Returns:
+            dict: Tổng kết (số video thành công/lỗi, thời gian, số liệu từng bước trong 'stages')
+        """
+        items = [item if isinstance(item, tuple) else (idx, item) for idx, item in enumerate(urls, 1)]
+        self._on_result = on_result
+        self._stats = {name: _StageStats(name, self.workers[name]) for name in PIPELINE_STAGES}
+        self._succeeded = 0
+        started = time.monotonic()
+
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        if items and not self._options(self.proxy):
+            for idx, url in items:
+                self._finish({'index': idx, 'url': url, 'started': started},
+                             (False, "Chưa cài đặt ffmpeg. Vui lòng cài đặt ffmpeg theo hướng dẫn và thử lại.",
+                              None, []))
+            items = []
+
+        if items:
+            queues = {name: queue.Queue(maxsize=self.queue_size) for name in PIPELINE_STAGES}
+            handlers = {'resolve': self._resolve, 'fetch': self._fetch, 'postprocess': self._postprocess}
+            threads = {}
+            for position, name in enumerate(PIPELINE_STAGES):
+                target = queues[PIPELINE_STAGES[position + 1]] if position + 1 < len(PIPELINE_STAGES) else None
+                threads[name] = [
+                    threading.Thread(target=self._worker, args=(name, handlers[name], queues[name], target),
+                                     name=f"pipeline-{name}", daemon=True)
+                    for _ in range(self.workers[name])
+                ]
+                for thread in threads[name]:
+                    thread.start()
+            for idx, url in items:
+                self._put(queues['resolve'], 'resolve',
+                          {'index': idx, 'url': url, 'started': time.monotonic()})
+            # Dừng lần lượt từng bước khi bước trước đã xử lý xong mọi video
+            for name in PIPELINE_STAGES:
+                for _ in threads[name]:
+                    queues[name].put(None)
+                for thread in threads[name]:
+                    thread.join()
+
+        elapsed = time.monotonic() - started
+        stages = {name: stats.as_dict(elapsed) for name, stats in self._stats.items()}
+        return {
+            'total': len(urls),
+            'succeeded': self._succeeded,
+            'failed': len(urls) - self._succeeded,
+            'elapsed': round(elapsed, 3),
+            'stages': stages,
+        }
+
+    def _options(self, proxy: str) -> dict:
+        ydl_opts = _get_ydl_opts(proxy=proxy, download=True, output_dir=self.output_dir, fast_path=self.fast_path)
+        if ydl_opts:
+            ydl_opts['defer_postprocessing'] = True
+        return ydl_opts
+
+    def _put(self, target: queue.Queue, name: str, item: dict):
+        item['queued_at'] = time.monotonic()
+        target.put(item)
+        self._stats[name].queued(target.qsize())
+
+    def _worker(self, name: str, handler, source: queue.Queue, target: queue.Queue):
+        """Worker của một bước: lấy video từ hàng đợi, xử lý rồi chuyển sang bước sau hoặc kết thúc"""
+        stats = self._stats[name]
+        while True:
+            item = source.get()
+            if item is None:
+                return
+            waited = time.monotonic() - item['queued_at']
+            began = time.monotonic()
+            try:
+                outcome = handler(item)
+            except Exception as e:
+                outcome = False, f"Lỗi không mong muốn: {e}", _classify_error(str(e)), item.get('files', [])
+            stats.record(time.monotonic() - began, waited, outcome is None or outcome[0])
+            if outcome is None:
+                self._put(target, PIPELINE_STAGES[PIPELINE_STAGES.index(name) + 1], item)
+            else:
+                self._finish(item, outcome)
+
+    def _finish(self, item: dict, outcome: tuple):
+        """Kết thúc một video (thành công hoặc lỗi ở bất kỳ bước nào) và báo kết quả"""
+        with self._result_lock:
+            if outcome[0]:
+                self._succeeded += 1
+            if self._on_result:
+                try:
+                    self._on_result(item['index'], item['url'], outcome, time.monotonic() - item['started'])
+                except Exception as e:
+                    console.print(f"[red]Lỗi xử lý kết quả {item['url']}: {e}[/red]")
+
+    def _resolve(self, item: dict):
+        """Bước 1: trích xuất thông tin video (có thử lại và đổi proxy), None nếu chuyển tiếp được"""
+        url = item['url']
+        if not url or not any(x in url.lower() for x in ['tiktok.com', 'douyin.com']):
+            return False, "URL không phải là URL TikTok hợp lệ", None, []
+        item['url'] = url = url.split('?')[0]
+        _emit(self.progress_callback, 'video_start', index=item['index'], url=url)
+
+        def attempt_resolve(proxy):
+            ydl_opts = self._options(proxy)
+            _call_state.last_error = None
+            try:
+                with _session_pool.session(ydl_opts) as ydl:
+                    info = ydl.extract_info(url, download=False)
+            except yt_dlp.utils.DownloadError as e:
+                return False, f"Lỗi lấy thông tin: {e}", _classify_error(str(e))
+            if not info:
+                error = getattr(_call_state, 'last_error', None)
+                if error:
+                    return False, f"Lỗi lấy thông tin: {error}", _classify_error(error)
+                return False, "Không thể lấy thông tin video", None
+            item.update(info=info, proxy=proxy)
+            return True, info.get('id'), None
+
+        success, message = _with_proxy_failover(self.proxy, lambda p: _with_retries(lambda attempt: attempt_resolve(p)))
+        if not success:
+            return False, message, _classify_error(message), []
+        return None
+
+    def _fetch(self, item: dict):
+        """Bước 2: tải dữ liệu video (không hậu xử lý), None nếu chuyển tiếp được"""
+        tracker = item['tracker'] = _OutputTracker(self.progress_callback)
+
+        def attempt_fetch(attempt):
+            ydl_opts = dict(self._options(item['proxy']))
+            tracker.attach(ydl_opts)
+            # File cuối cùng chỉ có sau bước hậu xử lý
+            ydl_opts.pop('post_hooks', None)
+            _call_state.last_error = None
+            _call_state.deferred = None
+            error = None
+            try:
+                with _session_pool.session(ydl_opts) as ydl:
+                    if attempt == 1:
+                        _download_with_info(ydl, item['info'], item['url'])
+                    else:
+                        ydl.download([item['url']])
+            except yt_dlp.utils.DownloadError as e:
+                error = str(e)
+            job, _call_state.deferred = _call_state.deferred, None
+            if job:
+                item['job'] = job
+                return True, None, None
+            error = error or getattr(_call_state, 'last_error', None)
+            if error:
+                return False, f"Lỗi tải video: {error}", _classify_error(error)
+            return False, "Không tải được video", None
+
+        success, message, error_kind = _with_retries(attempt_fetch)
+        if not success:
+            tracker.finalize()
+            return False, message, error_kind, []
+        return None
+
+    def _postprocess(self, item: dict):
+        """Bước 3: hậu xử lý trong nhóm tiến trình, ghi chỉ mục và hoàn thiện file MP4"""
+        job, tracker = item['job'], item['tracker']
+        if job.get('inline'):
+            # Đã hậu xử lý ngay trên thread tải (và đã ghi chỉ mục)
+            result = {'filepath': job['filepath'], 'timings': [], 'error': None}
+        else:
+            params = {k: v for k, v in self._options(item['proxy']).items() if k in _POSTPROCESS_PARAMS}
+            pool = _get_postprocess_pool()
+            try:
+                with _get_postprocess_slots().acquire():
+                    result = pool.submit(_run_postprocessors, job, params).result()
+            except BrokenProcessPool as e:
+                _discard_postprocess_pool(pool)
+                result = {'filepath': None, 'timings': [], 'error': f"Tiến trình hậu xử lý bị dừng: {e}"}
+        for timing in result['timings']:
+            self.pp_timings.append(timing)
+            if timing['ffmpeg']:
+                get_metrics().observe('ffmpeg_seconds', timing['seconds'])
+            _emit(self.progress_callback, 'postprocessor', status='finished', **timing)
+
+        if result['error']:
+            error = f"Postprocessing: {result['error']}"
+            get_metrics().inc('errors_total', error_class=_classify_error(error) or 'unknown')
+            tracker.finalize()
+            return False, f"Lỗi tải video: {error}", _classify_error(error), []
+
+        filepath = result['filepath']
+        if filepath:
+            if not job.get('inline'):
+                _record_download(filepath, job['info'], self.output_dir)
+            tracker._on_final(filepath)
+        files = tracker.finalize()
+        if files:
+            return True, f"Tải thành công: {os.path.basename(files[-1])}", None, files
+        return False, "Không tìm thấy file MP4 sau khi tải", None, []
+
+def _download_user_videos_concurrent(user_url: str, ydl_opts: dict, output_dir: str, concurrency: int,
+                                     progress_callback=None, proxy: str = None,
+                                     fast_path: bool = None) -> tuple[bool, str, str]:
+    """
+    Lấy danh sách video của user (flat, không tải) rồi tải các video qua DownloadPipeline,
+    với tối đa concurrency video tải dữ liệu cùng lúc.
+    """
+    list_opts = dict(ydl_opts)
+    list_opts['extract_flat'] = 'in_playlist'
+    list_opts.pop('post_hooks', None)
+
+    with _session_pool.session(list_opts) as ydl:
+        info, error_kind = _extract_user_info(ydl, user_url)
+    if not info:
+        return False, "Không thể lấy thông tin user", error_kind
+
+    entries = [e for e in (info.get('entries') or []) if e]
+    if not entries and info.get('id'):
+        entries = [info]
+    if not entries:
+        return False, "Không tìm thấy video nào từ user này. Vui lòng kiểm tra URL và thử lại.", None
+
+    playlistend = ydl_opts.get('playlistend')
+    if playlistend:
+        entries = entries[:playlistend]
+
+    total = len(entries)
+    console.print(f"[cyan]Tìm thấy {total} video từ {info.get('uploader', 'N/A')}, "
+                  f"tải song song {concurrency} video một lúc...[/cyan]")
+    _emit(progress_callback, 'start', total=total)
+
+    results = []
+
+    def on_result(idx, entry_url, outcome, elapsed):
+        _record_result(results, total, idx, entries[idx - 1], entry_url, outcome, progress_callback)
+
+    pipeline = DownloadPipeline(proxy=proxy, output_dir=output_dir, fast_path=fast_path,
+                                progress_callback=progress_callback, fetch_workers=concurrency)
+    summary = pipeline.run([(idx, _entry_url(entry, info)) for idx, entry in enumerate(entries, 1)], on_result)
+    _report_postprocessors(pipeline.pp_timings)
+    _report_pipeline(summary['stages'])
+
+    return _summarize_results(results, total, output_dir)
+
+_USER_HANDLE_RE = re.compile(r'@([^/?#]+)')
+
+def _user_key(user_url: str) -> str:
+    """Khóa định danh user từ URL (handle sau dấu @), dùng cho đồng bộ tăng dần"""
+    match = _USER_HANDLE_RE.search(user_url)
+    if match:
+        return match.group(1).lower()
+    return user_url.split('?')[0].rstrip('/').lower()
+
+class _VideoIdArchive(set):
+    """
+    Download archive trong bộ nhớ cho đồng bộ tăng dần. yt-dlp ghi mục dạng '<khóa extractor> <ID>'
+    ('tiktok ...', 'douyin ...'), nên video đã biết được so khớp theo ID, không phụ thuộc extractor.
+    Các mục trong set là video yt-dlp vừa tải ở lần đồng bộ này.
+    """
+
+    def __init__(self, known_ids):
+        super().__init__()
+        self.known_ids = frozenset(known_ids)
+
+    def __contains__(self, archive_id):
+        if super().__contains__(archive_id):
+            return True
+        return isinstance(archive_id, str) and archive_id.split(' ', 1)[-1] in self.known_ids
+
+    def __bool__(self):
+        # yt-dlp bỏ qua kiểm tra archive khi archive rỗng
+        return bool(self.known_ids) or len(self) > 0
+
+def _sync_user_videos(user_url: str, ydl_opts: dict, output_dir: str, tracker: _OutputTracker,
+                      progress_callback=None) -> tuple[bool, str]:
+    """
+    Đồng bộ tăng dần: duyệt profile từ video mới nhất và dừng phân trang ngay khi
+    gặp video đã tải trước đó, nên một lần đồng bộ hằng ngày chỉ tốn vài request.
+    """
+    index = get_download_index()
+    user_key = _user_key(user_url)
+    known_ids = index.known_user_videos(user_key)
+    archive = _VideoIdArchive(known_ids)
+    console.print(f"[cyan]Đồng bộ tăng dần cho {user_key}: đã có {len(known_ids)} video[/cyan]")
+
+    opts = dict(ydl_opts)
+    opts.update({
+        'download_archive': archive,
+        'break_on_existing': True,
+        # Lấy từng trang khi cần để có thể dừng sớm
+        'lazy_playlist': True,
+    })
+
+    stopped_early = False
+    retcode = 0
+    with _session_pool.session(opts) as ydl:
+        try:
+            retcode = ydl.download([user_url])
+        except yt_dlp.utils.ExistingVideoReached:
+            stopped_early = True
+
+    new_ids = [entry.split(' ', 1)[-1] for entry in archive]
+    index.mark_user_videos(user_key, list(known_ids) + new_ids)
+
+    downloaded = len(tracker.finalize())
+    if retcode and not downloaded and not stopped_early:
+        return False, "Không thể đồng bộ video từ user này. Vui lòng kiểm tra URL hoặc thử sử dụng proxy."
+
+    reason = "gặp video đã tải" if stopped_early else "hết danh sách"
+    message = f"Đồng bộ xong ({reason}): {downloaded} video mới"
+    console.print(f"[green]{message} vào {output_dir}[/green]")
+    return True, message
+
+def download_user_videos(user_url: str, proxy: str = None, limit: int = None, output_dir: str = DOWNLOADS_DIR,
+                         progress_callback=None, concurrency: int = None,
+                         incremental: bool = False, fast_path: bool = None) -> tuple[bool, str]:
     """
     Tải video từ user TikTok (chỉ định dạng MP4)
     
     Args:
         user_url: URL của user TikTok
-        proxy: Proxy tùy chọn
+        proxy: Proxy tùy chọn (mặc định dùng nhóm proxy đã cấu hình, nếu có)
         limit: Số lượng video tối đa
         output_dir: Thư mục lưu video
+        progress_callback: Hàm nhận các sự kiện tiến trình (dict có khóa 'event'),
+            nhận thêm sự kiện 'video_start' và 'video' khi bắt đầu/kết thúc từng video
+        concurrency: Số video tải song song (mặc định TIKTOK_CRAWLER_CONCURRENCY, 1 = tuần tự)
+        incremental: Chỉ tải video mới kể từ lần đồng bộ trước, dừng ở video đã tải đầu tiên
+        fast_path: Ưu tiên MP4 có sẵn, chỉ chạy ffmpeg khi cần (mặc định TIKTOK_CRAWLER_FAST_PATH)
     
     Returns:
         tuple: (success: bool, message: str)
     """
+    def operation(p):
+        run = lambda attempt: _download_user_videos(user_url, p, limit, output_dir, progress_callback,
+                                                    concurrency, incremental, fast_path)
+        # Đồng bộ tăng dần là một lần gọi yt-dlp (lấy danh sách và tải xen kẽ) nên thử lại cả lần gọi;
+        # các chế độ khác chỉ thử lại bước lấy danh sách, mỗi video có lượt thử lại riêng
+        return _with_retries(run) if incremental else run(1)
+
+    return _with_proxy_failover(proxy, operation)
+
+def _extract_user_info(ydl, user_url: str) -> tuple:
+    """
+    Lấy thông tin và danh sách video của user, thử lại riêng bước này khi gặp lỗi tạm thời.
+
+    Returns:
+        tuple: (info hoặc None, loại lỗi); exception của lần thử cuối được ném lại như extract_info
+    """
+    def attempt_listing(attempt):
+        _call_state.last_error = None
+        try:
+            info = ydl.extract_info(user_url, download=False)
+        except yt_dlp.utils.DownloadError as e:
+            return False, e, _classify_error(str(e)), None
+        if not info:
+            return False, None, _classify_error(getattr(_call_state, 'last_error', None)), None
+        return True, None, None, info
+
+    _, error, error_kind, info = _with_retries(attempt_listing)
+    if error is not None:
+        raise error
+    return info, error_kind
+
+def _download_user_videos(user_url: str, proxy: str, limit: int, output_dir: str, progress_callback=None,
+                          concurrency: int = None, incremental: bool = False,
+                          fast_path: bool = None) -> tuple[bool, str, str]:
+    """Một lần tải video của user qua một proxy, trả về thêm loại lỗi (xem _classify_error)"""
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
@@ -373,22 +1649,38 @@ def download_user_videos(user_url: str, proxy: str = None, limit: int = None, ou
         if limit:
             console.print(f"[blue]Giới hạn: {limit} video mới nhất[/blue]")
         if proxy:
-            console.print(f"[blue]Sử dụng proxy: {proxy}[/blue]")
+            console.print(f"[blue]Sử dụng proxy: {mask_proxy(proxy)}[/blue]")
 
-        ydl_opts = _get_ydl_opts(proxy=proxy, download=True, output_dir=output_dir)
+        ydl_opts = _get_ydl_opts(proxy=proxy, download=True, output_dir=output_dir, fast_path=fast_path)
+        if not ydl_opts:
+            return False, "Chưa cài đặt ffmpeg. Vui lòng cài đặt ffmpeg theo hướng dẫn và thử lại.", None
+        tracker = _OutputTracker(progress_callback)
+        tracker.attach(ydl_opts)
+        pp_timings = []
+        _add_postprocessor_hook(ydl_opts, progress_callback, pp_timings)
         
         # Cấu hình cho playlist
         ydl_opts['noplaylist'] = False
         if limit and isinstance(limit, int) and limit > 0:
             ydl_opts['playlistend'] = limit
+
+        if incremental:
+            result = _sync_user_videos(user_url, ydl_opts, output_dir, tracker, progress_callback)
+            _report_postprocessors(pp_timings)
+            return (*result, None)
+
+        concurrency = concurrency or DEFAULT_CONCURRENCY
+        if concurrency > 1:
+            return _download_user_videos_concurrent(user_url, ydl_opts, output_dir, concurrency, progress_callback,
+                                                    proxy, fast_path)
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with _session_pool.session(ydl_opts) as ydl:
             # Lấy thông tin user trước
-            info = ydl.extract_info(user_url, download=False)
+            info, error_kind = _extract_user_info(ydl, user_url)
             console.print(f"[yellow]Debug - Thông tin nhận được: {info.keys() if info else 'None'}[/yellow]")
             
             if not info:
-                return False, "Không thể lấy thông tin user"
+                return False, "Không thể lấy thông tin user", error_kind
             
             # Xử lý các trường hợp khác nhau của cấu trúc dữ liệu
             entries = []
@@ -401,7 +1693,7 @@ def download_user_videos(user_url: str, proxy: str = None, limit: int = None, ou
             if not entries:
                 console.print("[red]Không tìm thấy video nào. Chi tiết response:[/red]")
                 console.print(info)
-                return False, "Không tìm thấy video nào từ user này. Vui lòng kiểm tra URL và thử lại."
+                return False, "Không tìm thấy video nào từ user này. Vui lòng kiểm tra URL và thử lại.", None
             
             total_videos = len(entries)
             download_count = min(limit, total_videos) if limit else total_videos
@@ -413,55 +1705,147 @@ def download_user_videos(user_url: str, proxy: str = None, limit: int = None, ou
             
             console.print(f"[cyan]Tìm thấy {total_videos} video từ {info.get('uploader', 'N/A')}[/cyan]")
             console.print(f"[cyan]Sẽ tải {download_count} video...[/cyan]")
-            
-            # Đếm file MP4 trước khi tải
-            initial_mp4_count = len([f for f in os.listdir(output_dir) if f.lower().endswith('.mp4')])
+            _emit(progress_callback, 'start', total=download_count)
             
             # In thông tin từng video trước khi tải
             console.print("\n[cyan]Danh sách video sẽ tải:[/cyan]")
             for idx, entry in enumerate(entries[:download_count], 1):
                 console.print(f"[cyan]{idx}. {entry.get('title', 'Unknown')} - Duration: {entry.get('duration_string', 'N/A')}[/cyan]")
             
-            try:
-                # Tải video
-                ydl.download([user_url])
-                console.print("[green]Hoàn tất quá trình tải xuống[/green]")
-            except Exception as e:
-                console.print(f"[red]Lỗi trong quá trình tải: {str(e)}[/red]")
-                return False, f"Lỗi trong quá trình tải: {str(e)}"
-            
-            # Kiểm tra và đảm bảo tất cả file là MP4
-            _verify_mp4_files(output_dir)
-            _clean_non_mp4_files(output_dir)
-            
-            # Đếm file MP4 sau khi tải
-            final_mp4_count = len([f for f in os.listdir(output_dir) if f.lower().endswith('.mp4')])
-            actual_downloaded = final_mp4_count - initial_mp4_count
-            
-            if actual_downloaded > 0:
-                console.print(f"[green]Tải thành công {actual_downloaded} video MP4 vào {output_dir}[/green]")
-                return True, f"Đã tải {actual_downloaded} video MP4 thành công"
-            else:
-                return False, "Không có video MP4 nào được tải về"
+            # Tải từng video từ thông tin đã trích xuất (không trích xuất lại cả profile),
+            # video lỗi được thử lại hoặc bỏ qua mà không dừng cả danh sách
+            results = []
+            for idx, entry in enumerate(entries[:download_count], 1):
+                entry_url = _entry_url(entry, info)
+                _emit(progress_callback, 'video_start', index=idx, id=entry.get('id'), url=entry_url)
+                outcome = _with_retries(
+                    lambda attempt: _download_info_entry(ydl, entry, entry_url, tracker, attempt))
+                _record_result(results, download_count, idx, entry, entry_url, outcome, progress_callback)
+            console.print("[green]Hoàn tất quá trình tải xuống[/green]")
+            _report_postprocessors(pp_timings)
+
+            return _summarize_results(results, download_count, output_dir)
 
     except yt_dlp.utils.DownloadError as e:
         error_msg = str(e)
         console.print(f"[red]Lỗi tải video user: {error_msg}[/red]")
         
         if any(keyword in error_msg.lower() for keyword in ["blocked", "timed out", "403", "404"]):
-            return False, "IP bị chặn hoặc user không khả dụng. Thử sử dụng proxy."
-        return False, f"Lỗi: {error_msg}"
+            return False, "IP bị chặn hoặc user không khả dụng. Thử sử dụng proxy.", _classify_error(error_msg)
+        return False, f"Lỗi: {error_msg}", _classify_error(error_msg)
         
     except Exception as e:
         msg = f"Lỗi không mong muốn: {e}"
         console.print(f"[red]{msg}[/red]")
-        return False, msg
+        return False, msg, _classify_error(str(e))
+
+# Các trường của bản ghi metadata khi xuất profile (thứ tự cột của CSV)
+METADATA_FIELDS = (
+    'id', 'url', 'uploader', 'uploader_id', 'channel', 'channel_id', 'title', 'description',
+    'timestamp', 'upload_date', 'duration', 'view_count', 'like_count', 'comment_count',
+    'repost_count', 'save_count', 'track', 'artists',
+)
+# Các trường thống kê: bản ghi flat thiếu các trường này thì lấy thêm từ trang video (khi full=True)
+_STAT_FIELDS = ('view_count', 'like_count', 'comment_count')
+
+def _get_metadata_opts(proxy: str = None) -> dict:
+    """Cấu hình yt-dlp chỉ lấy metadata (không tải media, không cần ffmpeg)"""
+    opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'skip_download': True,
+        'simulate': True,
+        'ignoreerrors': False,
+        'noplaylist': False,
+        # Danh sách video dạng flat, lấy từng trang khi duyệt tới
+        'extract_flat': 'in_playlist',
+        'lazy_playlist': True,
+        'retry_sleep_functions': {
+            'http': _retry_sleep,
+            'extractor': _retry_sleep,
+        },
+    }
+    if proxy:
+        opts['proxy'] = proxy
+    return opts
+
+def _metadata_record(entry: dict, profile: str) -> dict:
+    """Bản ghi metadata của một video (chỉ các trường trong METADATA_FIELDS)"""
+    record = {field: entry.get(field) for field in METADATA_FIELDS}
+    record['url'] = entry.get('webpage_url') or entry.get('url')
+    if not record['upload_date'] and record['timestamp']:
+        record['upload_date'] = time.strftime('%Y%m%d', time.gmtime(record['timestamp']))
+    record['profile'] = profile
+    return record
+
+def _export_user_videos(user_url: str, proxy: str, on_record, limit: int, full: bool,
+                        exported: list) -> tuple[bool, str, str]:
+    """
+    Một lần duyệt profile qua một proxy. exported[0] là số video đã xuất ở các lần thử trước:
+    thứ tự danh sách cố định (mới nhất trước) nên lần thử lại bỏ qua chừng ấy video thay vì xuất trùng.
+    """
+    try:
+        with _session_pool.session(_get_metadata_opts(proxy)) as ydl:
+            # process=False: entries là generator của extractor, mỗi trang chỉ được lấy khi duyệt tới,
+            # bộ nhớ không phụ thuộc số video của profile
+            info = ydl.extract_info(user_url, download=False, process=False)
+            if not info:
+                return False, "Không thể lấy thông tin user", None
+            entries = info.get('entries') if info.get('_type') == 'playlist' else [info]
+
+            remaining = limit - exported[0] if limit else None
+            for entry in itertools.islice(entries or [], exported[0], exported[0] + remaining if limit else None):
+                if not entry:
+                    continue
+                if full and any(entry.get(field) is None for field in _STAT_FIELDS):
+                    url = entry.get('url') or entry.get('webpage_url')
+                    try:
+                        entry = {**entry, **(ydl.extract_info(url, download=False, process=False) or {})}
+                    except yt_dlp.utils.YoutubeDLError as e:
+                        console.print(f"[yellow]Không lấy được thông tin đầy đủ của {url}: {e}[/yellow]")
+                on_record(_metadata_record(entry, user_url))
+                exported[0] += 1
+        return True, f"Đã xuất {exported[0]} video", None
+
+    except yt_dlp.utils.YoutubeDLError as e:
+        error_msg = str(e)
+        console.print(f"[red]Lỗi xuất metadata của {user_url}: {error_msg}[/red]")
+        return False, f"Lỗi: {error_msg}", _classify_error(error_msg)
+
+    except Exception as e:
+        msg = f"Lỗi không mong muốn: {e}"
+        console.print(f"[red]{msg}[/red]")
+        return False, msg, _classify_error(str(e))
+
+def export_user_videos(user_url: str, on_record, proxy: str = None, limit: int = None,
+                       full: bool = False) -> tuple[bool, str]:
+    """
+    Xuất metadata (lượt xem/thích/bình luận...) của mọi video trong một profile, không tải media.
+
+    Danh sách video được lấy dạng flat theo từng trang (một request cho mỗi trang, không mở trang
+    từng video) và mỗi bản ghi được đưa ra ngay khi có, nên profile hàng chục nghìn video
+    vẫn dùng lượng bộ nhớ cố định.
+
+    Args:
+        user_url: URL của user TikTok (hoặc URL một video)
+        on_record: Hàm nhận bản ghi của từng video (dict theo METADATA_FIELDS, thêm 'profile')
+        proxy: Proxy tùy chọn (mặc định dùng nhóm proxy đã cấu hình, nếu có)
+        limit: Số video mới nhất tối đa
+        full: Mở trang video để lấy thống kê khi danh sách flat không có (chậm hơn nhiều)
+
+    Returns:
+        tuple: (success: bool, message: str)
+    """
+    exported = [0]
+    return _with_proxy_failover(proxy, lambda p: _with_retries(
+        lambda attempt: _export_user_videos(user_url, p, on_record, limit, full, exported)))
 
 def get_mp4_files_only(directory: str) -> list:
-    """Lấy danh sách chỉ các file MP4 trong thư mục"""
+    """Lấy danh sách chỉ các file MP4 trong thư mục (kể cả thư mục con theo kiểu bố trí, đường dẫn tương đối)"""
     try:
         if not os.path.exists(directory):
             return []
-        return [f for f in os.listdir(directory) if f.lower().endswith('.mp4') and os.path.isfile(os.path.join(directory, f))]
+        return [os.path.relpath(entry.path, directory).replace(os.sep, '/')
+                for entry in storage.iter_files(directory, ('.mp4',))]
     except Exception:
         return []
\ No newline at end of file
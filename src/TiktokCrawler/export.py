@@ -0,0 +1,87 @@
+import csv
+import json
+import time
+
+EXPORT_FORMATS = ('jsonl', 'csv')
+
+
+def export_fields() -> tuple:
+    """Các cột của file xuất: metadata của video và profile nguồn"""
+    # Import khi dùng: CLI nạp module này mà không cần nạp yt-dlp
+    from .downloader import METADATA_FIELDS
+    return METADATA_FIELDS + ('profile',)
+
+
+def format_for(path: str, default: str = 'jsonl') -> str:
+    """Định dạng xuất theo đuôi file (.csv -> csv, còn lại jsonl)"""
+    return 'csv' if path and path.lower().endswith('.csv') else default
+
+
+class RecordWriter:
+    """Ghi từng bản ghi ra file ngay khi có (JSON lines hoặc CSV có dòng tiêu đề)"""
+
+    def __init__(self, out, fmt: str = 'jsonl'):
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Định dạng xuất không hợp lệ: {fmt} (hỗ trợ: {', '.join(EXPORT_FORMATS)})")
+        self.out = out
+        self.fmt = fmt
+        self.count = 0
+        self._csv = None
+        if fmt == 'csv':
+            self._csv = csv.DictWriter(out, fieldnames=export_fields(), extrasaction='ignore')
+            self._csv.writeheader()
+
+    def write(self, record: dict):
+        if self._csv:
+            row = dict(record)
+            if isinstance(row.get('artists'), list):
+                row['artists'] = ', '.join(row['artists'])
+            self._csv.writerow(row)
+        else:
+            self.out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.count += 1
+
+
+def run_export(user_urls: list, writer: RecordWriter, proxy: str = None, limit: int = None,
+               full: bool = False, progress=None, cancelled=None) -> dict:
+    """
+    Xuất metadata video của danh sách profile (lần lượt từng profile, ghi ngay từng bản ghi).
+
+    Args:
+        user_urls: Danh sách URL profile
+        writer: Nơi ghi các bản ghi (RecordWriter)
+        proxy: Proxy tùy chọn (mặc định dùng nhóm proxy đã cấu hình, nếu có)
+        limit: Số video mới nhất tối đa của mỗi profile
+        full: Mở trang video khi danh sách flat không có số liệu thống kê
+        progress: Hàm nhận (số bản ghi đã xuất, số bản ghi mỗi giây) sau mỗi bản ghi
+        cancelled: threading.Event, dừng trước profile tiếp theo khi được đặt (ví dụ client đã ngắt kết nối)
+
+    Returns:
+        dict: Tổng kết (số profile thành công/lỗi, số bản ghi, thời gian, số bản ghi mỗi giây, lỗi từng profile)
+    """
+    from . import downloader
+
+    summary = {'profiles': len(user_urls), 'succeeded': 0, 'failed': 0, 'records': 0, 'errors': []}
+    started = time.monotonic()
+
+    def on_record(record):
+        writer.write(record)
+        if progress:
+            elapsed = time.monotonic() - started
+            progress(writer.count, writer.count / elapsed if elapsed else 0.0)
+
+    for user_url in user_urls:
+        if cancelled is not None and cancelled.is_set():
+            break
+        success, message = downloader.export_user_videos(user_url, on_record, proxy=proxy, limit=limit, full=full)
+        if success:
+            summary['succeeded'] += 1
+        else:
+            summary['failed'] += 1
+            summary['errors'].append({'profile': user_url, 'message': message})
+
+    elapsed = time.monotonic() - started
+    summary['records'] = writer.count
+    summary['elapsed'] = round(elapsed, 3)
+    summary['records_per_second'] = round(writer.count / elapsed, 3) if elapsed else 0.0
+    return summary
@@ -0,0 +1,343 @@
+import os
+import re
+import json
+import time
+import base64
+import threading
+from contextlib import closing
+
+from . import state
+from .storage import iter_files
+
+INDEX_DB_NAME = "downloads.db"
+
+# ID video ở cuối tên file theo mẫu '%(title).50s_%(id)s.%(ext)s'
+_FILENAME_ID_RE = re.compile(r'_(\d+)\.\w+$')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS downloads (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    video_id TEXT,
+    uploader TEXT,
+    uploader_id TEXT,
+    title TEXT,
+    size INTEGER NOT NULL DEFAULT 0,
+    duration REAL,
+    upload_date TEXT,
+    downloaded_at REAL NOT NULL,
+    modified_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_downloads_dir_time ON downloads (directory, downloaded_at);
+CREATE INDEX IF NOT EXISTS idx_downloads_video_id ON downloads (video_id);
+CREATE INDEX IF NOT EXISTS idx_downloads_uploader ON downloads (uploader);
+CREATE TABLE IF NOT EXISTS user_videos (
+    user_key TEXT NOT NULL,
+    video_id TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (user_key, video_id)
+);
+CREATE TABLE IF NOT EXISTS indexed_dirs (
+    directory TEXT PRIMARY KEY,
+    synced_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_downloads_dir_size ON downloads (directory, size);
+CREATE INDEX IF NOT EXISTS idx_downloads_dir_name ON downloads (directory, filename);
+CREATE TABLE IF NOT EXISTS index_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO index_version (id, version) VALUES (1, 0);
+CREATE TRIGGER IF NOT EXISTS trg_downloads_insert AFTER INSERT ON downloads
+BEGIN UPDATE index_version SET version = version + 1; END;
+CREATE TRIGGER IF NOT EXISTS trg_downloads_update AFTER UPDATE ON downloads
+BEGIN UPDATE index_version SET version = version + 1; END;
+CREATE TRIGGER IF NOT EXISTS trg_downloads_delete AFTER DELETE ON downloads
+BEGIN UPDATE index_version SET version = version + 1; END;
+"""
+
+# Cột sắp xếp của danh sách file (sắp xếp theo giá trị gốc, không theo chuỗi đã định dạng)
+SORT_COLUMNS = {'date': 'downloaded_at', 'size': 'size', 'name': 'filename'}
+
+
+def _normalize(path: str) -> str:
+    return os.path.realpath(os.path.abspath(path))
+
+
+def _video_id_from_filename(path: str) -> str:
+    match = _FILENAME_ID_RE.search(os.path.basename(path))
+    return match.group(1) if match else None
+
+
+def _encode_cursor(value, rowid: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([value, rowid]).encode()).decode().rstrip('=')
+
+
+def _decode_cursor(cursor: str) -> tuple:
+    try:
+        value, rowid = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return value, int(rowid)
+    except (ValueError, TypeError):
+        raise ValueError("Cursor không hợp lệ")
+
+
+class DownloadIndex:
+    """
+    Chỉ mục các file đã tải (SQLite trên volume downloads).
+
+    Được cập nhật ngay khi yt-dlp hoàn tất một file, nên việc tìm file vừa tải
+    hay liệt kê thư viện là truy vấn theo chỉ mục thay vì duyệt thư mục.
+    """
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or state.get_state_path(INDEX_DB_NAME)
+        with closing(state.connect(self.db_path)) as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        return state.connect(self.db_path)
+
+    def record(self, path: str, info: dict = None, directory: str = None):
+        """
+        Ghi (hoặc cập nhật) một file vừa tải cùng thông tin video
+
+        Args:
+            directory: Thư mục downloads chứa file (file có thể nằm trong thư mục con của nó),
+                mặc định là thư mục chứa file
+        """
+        info = info or {}
+        path = _normalize(path)
+        directory = _normalize(directory) if directory else os.path.dirname(path)
+        try:
+            stats = os.stat(path)
+        except OSError:
+            return
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO downloads (path, directory, filename, video_id, uploader, uploader_id, title, "
+                "size, duration, upload_date, downloaded_at, modified_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET video_id = COALESCE(excluded.video_id, video_id), "
+                "uploader = COALESCE(excluded.uploader, uploader), "
+                "uploader_id = COALESCE(excluded.uploader_id, uploader_id), "
+                "title = COALESCE(excluded.title, title), size = excluded.size, "
+                "duration = COALESCE(excluded.duration, duration), "
+                "upload_date = COALESCE(excluded.upload_date, upload_date), "
+                "downloaded_at = excluded.downloaded_at, modified_at = excluded.modified_at",
+                (path, directory, os.path.basename(path), info.get('id'), info.get('uploader'),
+                 info.get('uploader_id'), info.get('title'), stats.st_size, info.get('duration'),
+                 info.get('upload_date'), now, stats.st_mtime)
+            )
+
+    def rename(self, old_path: str, new_path: str):
+        """Cập nhật đường dẫn khi file được đổi tên hoặc chuyển sang thư mục con khác (giữ thư mục downloads)"""
+        old_path = _normalize(old_path)
+        new_path = _normalize(new_path)
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE OR REPLACE downloads SET path = ?, filename = ? WHERE path = ?",
+                (new_path, os.path.basename(new_path), old_path)
+            )
+
+    def remove(self, path: str):
+        """Xóa một file khỏi chỉ mục"""
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM downloads WHERE path = ?", (_normalize(path),))
+
+    def remove_directory(self, directory: str):
+        """Xóa toàn bộ file của một thư mục khỏi chỉ mục"""
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM downloads WHERE directory = ?", (_normalize(directory),))
+
+    def get(self, path: str) -> dict:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM downloads WHERE path = ?", (_normalize(path),)).fetchone()
+        return dict(row) if row else None
+
+    def find_by_video_id(self, video_id: str, directory: str = None) -> list:
+        """Tìm các file của một video (mới nhất trước)"""
+        query = "SELECT * FROM downloads WHERE video_id = ?"
+        args = [str(video_id)]
+        if directory:
+            query += " AND directory = ?"
+            args.append(_normalize(directory))
+        query += " ORDER BY downloaded_at DESC"
+        with closing(self._connect()) as conn:
+            return [dict(row) for row in conn.execute(query, args)]
+
+    def list(self, directory: str, limit: int = None) -> list:
+        """Liệt kê file của một thư mục, mới tải nhất trước"""
+        query = "SELECT * FROM downloads WHERE directory = ? ORDER BY downloaded_at DESC"
+        args = [_normalize(directory)]
+        if limit:
+            query += " LIMIT ?"
+            args.append(limit)
+        with closing(self._connect()) as conn:
+            return [dict(row) for row in conn.execute(query, args)]
+
+    def page(self, directory: str, sort: str = 'date', descending: bool = True, limit: int = 100,
+             cursor: str = None, uploader: str = None, prefix: str = None, since: float = None,
+             until: float = None, min_size: int = None, max_size: int = None) -> dict:
+        """
+        Một trang danh sách file của thư mục, phân trang theo cursor (keyset): mỗi trang
+        là một truy vấn theo chỉ mục, không phụ thuộc vị trí trang hay kích thước thư viện.
+
+        Args:
+            sort: 'date' (thời điểm tải), 'size' hoặc 'name'
+            descending: Sắp xếp giảm dần
+            limit: Số file mỗi trang
+            cursor: Cursor của trang tiếp theo (next_cursor của trang trước)
+            uploader: Chỉ lấy file của một tác giả
+            prefix: Tên file bắt đầu bằng chuỗi này
+            since, until: Khoảng thời điểm tải (timestamp)
+            min_size, max_size: Khoảng dung lượng (byte)
+
+        Returns:
+            dict: {'files': list, 'next_cursor': str hoặc None, 'total': int}
+
+        Raises:
+            ValueError: Cột sắp xếp hoặc cursor không hợp lệ
+        """
+        column = SORT_COLUMNS.get(sort)
+        if not column:
+            raise ValueError(f"Cột sắp xếp không hợp lệ: {sort}")
+
+        where = ["directory = ?"]
+        args = [_normalize(directory)]
+        if uploader:
+            where.append("(uploader = ? OR uploader_id = ?)")
+            args += [uploader, uploader]
+        if prefix:
+            escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            where.append("filename LIKE ? ESCAPE '\\'")
+            args.append(escaped + '%')
+        for condition, value in (("downloaded_at >= ?", since), ("downloaded_at < ?", until),
+                                 ("size >= ?", min_size), ("size <= ?", max_size)):
+            if value is not None:
+                where.append(condition)
+                args.append(value)
+
+        with closing(self._connect()) as conn:
+            total = conn.execute(f"SELECT COUNT(*) FROM downloads WHERE {' AND '.join(where)}", args).fetchone()[0]
+
+            # Cursor: giá trị cột sắp xếp và rowid của file cuối trang trước (rowid phân định các giá trị trùng)
+            if cursor:
+                value, rowid = _decode_cursor(cursor)
+                op = '<' if descending else '>'
+                where.append(f"({column} {op} ? OR ({column} = ? AND rowid {op} ?))")
+                args += [value, value, rowid]
+
+            direction = 'DESC' if descending else 'ASC'
+            rows = conn.execute(
+                f"SELECT rowid AS _rowid, * FROM downloads WHERE {' AND '.join(where)} "
+                f"ORDER BY {column} {direction}, rowid {direction} LIMIT ?",
+                args + [limit + 1]
+            ).fetchall()
+
+        files = [dict(row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = files[-1]
+            next_cursor = _encode_cursor(last[column], last['_rowid'])
+        for entry in files:
+            entry.pop('_rowid')
+        return {'files': files, 'next_cursor': next_cursor, 'total': total}
+
+    def version(self) -> int:
+        """Số phiên bản của chỉ mục, tăng sau mỗi lần thêm/sửa/xóa file (kể cả từ tiến trình khác)"""
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT version FROM index_version WHERE id = 1").fetchone()[0]
+
+    def known_user_videos(self, user_key: str) -> set:
+        """
+        ID các video đã tải của một user (dùng cho đồng bộ tăng dần): các video đã ghi nhận
+        ở lần đồng bộ trước cùng các file của user đó đang có trong chỉ mục.
+        """
+        user_key = user_key.lower()
+        with closing(self._connect()) as conn:
+            ids = {row['video_id'] for row in conn.execute(
+                "SELECT video_id FROM user_videos WHERE user_key = ?", (user_key,)
+            )}
+            ids.update(row['video_id'] for row in conn.execute(
+                "SELECT DISTINCT video_id FROM downloads "
+                "WHERE video_id IS NOT NULL AND (lower(uploader) = ? OR lower(uploader_id) = ?)",
+                (user_key, user_key)
+            ))
+        return ids
+
+    def mark_user_videos(self, user_key: str, video_ids):
+        """Ghi nhận các video đã tải của một user"""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO user_videos (user_key, video_id, fetched_at) VALUES (?, ?, ?)",
+                [(user_key.lower(), str(video_id), now) for video_id in video_ids]
+            )
+
+    def is_synced(self, directory: str) -> bool:
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                "SELECT 1 FROM indexed_dirs WHERE directory = ?", (_normalize(directory),)
+            ).fetchone() is not None
+
+    def sync(self, directory: str, extensions=('.mp4',)) -> int:
+        """
+        Đồng bộ chỉ mục với nội dung thư mục (một lần duyệt thư mục).
+        Dùng để nhập thư viện có sẵn hoặc sửa sai lệch khi file bị thay đổi từ bên ngoài.
+
+        Returns:
+            int: Số file có trong thư mục sau khi đồng bộ
+        """
+        directory = _normalize(directory)
+        found = {}
+        if os.path.isdir(directory):
+            # Gồm cả các thư mục con của kiểu bố trí phân nhánh (xem storage.LAYOUTS)
+            for entry in iter_files(directory, extensions):
+                found[entry.path] = entry.stat()
+
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                known = {row['path'] for row in conn.execute(
+                    "SELECT path FROM downloads WHERE directory = ?", (directory,)
+                )}
+                conn.executemany(
+                    "DELETE FROM downloads WHERE path = ?", [(path,) for path in known - found.keys()]
+                )
+                # File trong thư mục con đã được ghi theo thư mục khác thì chuyển về thư mục này
+                conn.executemany(
+                    "INSERT INTO downloads (path, directory, filename, video_id, size, downloaded_at, modified_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(path) DO UPDATE SET directory = excluded.directory",
+                    [(path, directory, os.path.basename(path), _video_id_from_filename(path),
+                      st.st_size, st.st_mtime, st.st_mtime)
+                     for path, st in found.items() if path not in known]
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO indexed_dirs (directory, synced_at) VALUES (?, ?)",
+                    (directory, time.time())
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return len(found)
+
+    def ensure_synced(self, directory: str):
+        """Nhập thư mục vào chỉ mục ở lần dùng đầu tiên"""
+        if not self.is_synced(directory):
+            self.sync(directory)
+
+
+_download_index = None
+_download_index_lock = threading.Lock()
+
+
+def get_download_index() -> DownloadIndex:
+    """Chỉ mục file đã tải dùng chung trong tiến trình (khởi tạo khi cần)"""
+    global _download_index
+    with _download_index_lock:
+        if _download_index is None:
+            _download_index = DownloadIndex()
+        return _download_index
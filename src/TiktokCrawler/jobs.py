@@ -0,0 +1,425 @@
+import os
+import json
+import time
+import uuid
+import threading
+from contextlib import closing
+from rich.console import Console
+
+from . import state
+
+console = Console()
+
+JOBS_DB_NAME = "jobs.db"
+
+# Trạng thái của một job
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_FINISHED = "finished"
+STATUS_FAILED = "failed"
+
+DEFAULT_MAX_WORKERS = int(os.getenv('TIKTOK_CRAWLER_JOB_WORKERS', '2'))
+DEFAULT_MAX_PENDING = int(os.getenv('TIKTOK_CRAWLER_MAX_PENDING_JOBS', '1000'))
+# Thời gian giữ lại job đã kết thúc (giây)
+DEFAULT_RETENTION = int(os.getenv('TIKTOK_CRAWLER_JOB_RETENTION', str(7 * 24 * 3600)))
+# Khoảng cách tối thiểu (giây) giữa hai lần ghi tiến trình tải (byte, tốc độ, ETA) vào database
+PROGRESS_INTERVAL = float(os.getenv('TIKTOK_CRAWLER_PROGRESS_INTERVAL', '0.5'))
+# Chu kỳ (giây) tiến trình ghi heartbeat cho các job đang chạy, và thời gian (giây) không có heartbeat
+# sau đó job đang chạy được coi là bị gián đoạn (tiến trình xử lý đã chết)
+HEARTBEAT_INTERVAL = float(os.getenv('TIKTOK_CRAWLER_JOB_HEARTBEAT_INTERVAL', '10'))
+STALE_AFTER = float(os.getenv('TIKTOK_CRAWLER_JOB_STALE_AFTER', '60'))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    message TEXT,
+    progress TEXT,
+    files TEXT,
+    worker_pid INTEGER,
+    worker_token TEXT,
+    heartbeat_at REAL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at);
+"""
+
+# Cột thêm sau phiên bản đầu, bổ sung vào database cũ khi khởi tạo
+_ADDED_COLUMNS = {
+    'worker_token': "TEXT",
+    'heartbeat_at': "REAL",
+}
+
+_process_token = None
+_process_token_pid = None
+
+
+def _worker_token() -> str:
+    """Mã định danh ngẫu nhiên của tiến trình hiện tại (tạo lại sau fork, không trùng khi PID bị dùng lại)"""
+    global _process_token, _process_token_pid
+    if _process_token_pid != os.getpid():
+        _process_token = f"{os.getpid()}-{uuid.uuid4().hex}"
+        _process_token_pid = os.getpid()
+    return _process_token
+
+
+class JobQueue:
+    """
+    Hàng đợi job tải video lưu trong SQLite.
+
+    Các job được ghi vào database dùng chung nên mọi worker gunicorn đều có thể
+    nhận job và trả lời trạng thái, bất kể worker nào đã tạo job. Mỗi tiến trình
+    chạy một nhóm thread có giới hạn để lấy job ra khỏi hàng đợi và thực thi.
+
+    Job đang chạy mang mã của tiến trình nhận nó và được tiến trình đó ghi heartbeat định kỳ;
+    các worker định kỳ đánh dấu thất bại job không còn heartbeat (tiến trình xử lý đã chết).
+    """
+
+    def __init__(self, db_path: str = None, max_workers: int = DEFAULT_MAX_WORKERS,
+                 max_pending: int = DEFAULT_MAX_PENDING, poll_interval: float = 1.0):
+        self.db_path = db_path or state.get_state_path(JOBS_DB_NAME)
+        self.max_workers = max(1, max_workers)
+        self.max_pending = max_pending
+        self.poll_interval = poll_interval
+        self._runners = {}
+        self._threads = []
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._next_recover = 0.0
+        self._init_db()
+
+    def _connect(self):
+        return state.connect(self.db_path)
+
+    def _init_db(self):
+        with closing(self._connect()) as conn:
+            conn.executescript(_SCHEMA)
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for name, column_type in _ADDED_COLUMNS.items():
+                if name not in columns:
+                    try:
+                        conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {column_type}")
+                    except Exception:
+                        # Tiến trình khác vừa thêm cột
+                        pass
+
+    def register(self, kind: str, runner):
+        """
+        Đăng ký hàm xử lý cho một loại job.
+
+        runner(params: dict, progress_callback) -> tuple[bool, str]
+        """
+        self._runners[kind] = runner
+
+    def start(self):
+        """Khởi động các thread worker (chỉ một lần cho mỗi tiến trình)"""
+        with self._lock:
+            if self._threads:
+                return
+            self._recover_interrupted()
+            self._purge_old()
+            heartbeat = threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True)
+            heartbeat.start()
+            self._threads.append(heartbeat)
+            for i in range(self.max_workers):
+                thread = threading.Thread(target=self._worker_loop, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        """Dừng các thread worker sau khi job hiện tại kết thúc"""
+        self._stop.set()
+        self._wakeup.set()
+
+    def submit(self, kind: str, params: dict) -> tuple[bool, str]:
+        """
+        Đưa một job vào hàng đợi.
+
+        Returns:
+            tuple: (success: bool, job_id hoặc thông báo lỗi: str)
+        """
+        if kind not in self._runners:
+            return False, f"Loại job không hợp lệ: {kind}"
+
+        job_id = uuid.uuid4().hex
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                pending = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)",
+                    (STATUS_QUEUED, STATUS_RUNNING)
+                ).fetchone()[0]
+                if self.max_pending and pending >= self.max_pending:
+                    conn.execute("ROLLBACK")
+                    return False, "Hàng đợi đang đầy, vui lòng thử lại sau"
+                conn.execute(
+                    "INSERT INTO jobs (id, kind, params, status, progress, files, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, kind, json.dumps(params), STATUS_QUEUED, json.dumps({}), json.dumps([]), time.time())
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+        self._wakeup.set()
+        return True, job_id
+
+    def get(self, job_id: str) -> dict:
+        """Lấy thông tin một job, trả về None nếu không tồn tại"""
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if not row:
+                return None
+            job = self._row_to_dict(row)
+            if job['status'] == STATUS_QUEUED:
+                job['queue_position'] = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = ? AND created_at <= ?",
+                    (STATUS_QUEUED, row['created_at'])
+                ).fetchone()[0]
+            return job
+
+    def list(self, limit: int = 50, status: str = None) -> list:
+        """Liệt kê các job mới nhất"""
+        query = "SELECT * FROM jobs"
+        args = []
+        if status:
+            query += " WHERE status = ?"
+            args.append(status)
+        query += " ORDER BY created_at DESC LIMIT ?"
+        args.append(limit)
+        with closing(self._connect()) as conn:
+            return [self._row_to_dict(row) for row in conn.execute(query, args)]
+
+    def watch(self, job_id: str, interval: float = PROGRESS_INTERVAL, timeout: float = None):
+        """
+        Theo dõi một job: sinh ra thông tin job mỗi khi trạng thái/tiến trình thay đổi,
+        dừng sau khi job kết thúc (hoặc hết thời gian). Đọc từ database dùng chung nên
+        theo dõi được job do bất kỳ worker nào thực thi.
+
+        Sinh ra None khi không có thay đổi để nơi gọi có thể gửi heartbeat.
+        """
+        deadline = time.monotonic() + timeout if timeout else None
+        last = None
+        while True:
+            job = self.get(job_id)
+            if not job:
+                return
+            snapshot = (job['status'], job['message'], job['progress'], len(job['files']),
+                        job.get('queue_position'))
+            if snapshot != last:
+                last = snapshot
+                yield job
+            else:
+                yield None
+            if job['status'] in (STATUS_FINISHED, STATUS_FAILED):
+                return
+            if deadline and time.monotonic() >= deadline:
+                return
+            time.sleep(interval)
+
+    def stats(self) -> dict:
+        """Đếm số job theo trạng thái"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        counts = {STATUS_QUEUED: 0, STATUS_RUNNING: 0, STATUS_FINISHED: 0, STATUS_FAILED: 0}
+        counts.update({row['status']: row['n'] for row in rows})
+        return counts
+
+    @staticmethod
+    def _row_to_dict(row) -> dict:
+        return {
+            'id': row['id'],
+            'kind': row['kind'],
+            'params': json.loads(row['params']),
+            'status': row['status'],
+            'message': row['message'],
+            'progress': json.loads(row['progress'] or '{}'),
+            'files': json.loads(row['files'] or '[]'),
+            'created_at': row['created_at'],
+            'started_at': row['started_at'],
+            'finished_at': row['finished_at'],
+        }
+
+    def _claim(self):
+        """Lấy nguyên tử job cũ nhất đang chờ, trả về (id, kind, params) hoặc None"""
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT id, kind, params FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1",
+                    (STATUS_QUEUED,)
+                ).fetchone()
+                if not row:
+                    conn.execute("COMMIT")
+                    return None
+                now = time.time()
+                conn.execute(
+                    "UPDATE jobs SET status = ?, worker_pid = ?, worker_token = ?, started_at = ?, heartbeat_at = ? "
+                    "WHERE id = ?",
+                    (STATUS_RUNNING, os.getpid(), _worker_token(), now, now, row['id'])
+                )
+                conn.execute("COMMIT")
+                return row['id'], row['kind'], json.loads(row['params'])
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _update(self, job_id: str, **fields):
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        values = [json.dumps(v) if name in ('progress', 'files') else v for name, v in fields.items()]
+        with closing(self._connect()) as conn:
+            conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", values + [job_id])
+
+    def _heartbeat(self):
+        """Ghi heartbeat cho các job đang chạy của tiến trình này"""
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE worker_token = ? AND status = ?",
+                (time.time(), _worker_token(), STATUS_RUNNING)
+            )
+
+    def _heartbeat_loop(self):
+        while not self._stop.is_set():
+            try:
+                self._heartbeat()
+            except Exception as e:
+                console.print(f"[red]Lỗi khi ghi heartbeat cho job: {e}[/red]")
+            self._stop.wait(HEARTBEAT_INTERVAL)
+
+    def _recover_interrupted(self) -> int:
+        """Đánh dấu thất bại các job đang chạy dở không còn heartbeat (tiến trình xử lý đã chết)"""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            # Job của phiên bản cũ chưa có heartbeat: tính từ lúc bắt đầu chạy
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, message = ?, finished_at = ? "
+                "WHERE status = ? AND COALESCE(heartbeat_at, started_at, created_at) < ? "
+                "AND (worker_token IS NULL OR worker_token != ?)",
+                (STATUS_FAILED, "Job bị gián đoạn do tiến trình xử lý đã dừng", now,
+                 STATUS_RUNNING, now - STALE_AFTER, _worker_token())
+            )
+            return cursor.rowcount
+
+    def _maybe_recover_interrupted(self):
+        """Thu hồi job bị gián đoạn, nhiều nhất một lần mỗi chu kỳ heartbeat cho mỗi tiến trình"""
+        with self._lock:
+            if time.monotonic() < self._next_recover:
+                return
+            self._next_recover = time.monotonic() + HEARTBEAT_INTERVAL
+        try:
+            recovered = self._recover_interrupted()
+        except Exception as e:
+            console.print(f"[red]Lỗi khi thu hồi job bị gián đoạn: {e}[/red]")
+            return
+        if recovered:
+            console.print(f"[yellow]Đã đánh dấu thất bại {recovered} job bị gián đoạn[/yellow]")
+
+    def _purge_old(self):
+        """Xóa các job đã kết thúc quá thời gian lưu giữ"""
+        cutoff = time.time() - DEFAULT_RETENTION
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+                (STATUS_FINISHED, STATUS_FAILED, cutoff)
+            )
+
+    def _worker_loop(self):
+        while not self._stop.is_set():
+            self._maybe_recover_interrupted()
+            try:
+                claimed = self._claim()
+            except Exception as e:
+                console.print(f"[red]Lỗi khi lấy job từ hàng đợi: {e}[/red]")
+                claimed = None
+
+            if not claimed:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            self._run(*claimed)
+
+    def _run(self, job_id: str, kind: str, params: dict):
+        runner = self._runners.get(kind)
+        progress = {}
+        files = []
+        last_write = [0.0]
+        # Tải song song gọi callback từ nhiều thread
+        lock = threading.Lock()
+
+        def save(**fields):
+            last_write[0] = time.monotonic()
+            self._update(job_id, progress=progress, **fields)
+
+        def progress_callback(event: dict):
+            with lock:
+                handle(event)
+
+        def handle(event: dict):
+            # Ghi lại tiến trình để mọi worker có thể trả lời trạng thái job
+            if event.get('event') == 'progress':
+                # Byte đã tải, tốc độ, ETA của file đang tải (ghi thưa để không ghi database liên tục)
+                progress['download'] = {k: event.get(k) for k in ('video_id', 'filename', 'status', 'downloaded_bytes',
+                                                                  'total_bytes', 'speed', 'eta')}
+                if event.get('status') == 'finished':
+                    progress['downloaded_bytes'] = progress.get('downloaded_bytes', 0) + (
+                        event.get('total_bytes') or event.get('downloaded_bytes') or 0)
+                    save()
+                elif time.monotonic() - last_write[0] >= PROGRESS_INTERVAL:
+                    save()
+            elif event.get('event') == 'file':
+                files.append(event['path'])
+                progress['completed'] = len(files)
+                save(files=files)
+            elif event.get('event') == 'postprocessor':
+                if event.get('status') == 'started':
+                    progress['stage'] = event.get('postprocessor')
+                    save()
+                    return
+                progress['stage'] = None
+                steps = progress.setdefault('postprocessors', [])
+                if len(steps) < 200:
+                    steps.append({k: event.get(k) for k in ('postprocessor', 'video_id', 'seconds', 'ffmpeg')})
+                if event.get('ffmpeg'):
+                    progress['ffmpeg_seconds'] = round(progress.get('ffmpeg_seconds', 0) + event['seconds'], 3)
+                save()
+            elif event.get('event') == 'video_start':
+                # Video đang tải của playlist (thứ tự trong danh sách)
+                progress['current'] = {k: event.get(k) for k in ('index', 'id', 'url')}
+                save()
+            elif event.get('event') == 'video':
+                # Kết quả từng video của playlist: đếm số video lỗi và giữ lại lý do
+                if not event.get('success'):
+                    progress['failed'] = progress.get('failed', 0) + 1
+                    failures = progress.setdefault('failures', [])
+                    if len(failures) < 200:
+                        failures.append({k: event.get(k) for k in ('index', 'id', 'url', 'message', 'error')})
+                    save()
+            elif event.get('event') == 'start':
+                progress['total'] = event.get('total')
+                progress['completed'] = len(files)
+                save()
+
+        try:
+            if not runner:
+                success, message = False, f"Không có hàm xử lý cho loại job: {kind}"
+            else:
+                success, message = runner(params, progress_callback)
+        except Exception as e:
+            success, message = False, f"Lỗi không mong muốn: {e}"
+            console.print(f"[red]Job {job_id} lỗi: {e}[/red]")
+
+        self._update(
+            job_id,
+            status=STATUS_FINISHED if success else STATUS_FAILED,
+            message=message,
+            progress=progress,
+            files=files,
+            finished_at=time.time()
+        )
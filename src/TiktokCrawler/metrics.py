@@ -0,0 +1,248 @@
+import os
+import time
+import atexit
+import threading
+from contextlib import closing
+
+from . import state
+
+METRICS_DB_NAME = "metrics.db"
+
+# Bật/tắt thu thập số liệu (1 = bật)
+METRICS_ENABLED = os.getenv('TIKTOK_CRAWLER_METRICS', '1') == '1'
+
+# Chu kỳ (giây) ghi số liệu đang đệm trong bộ nhớ xuống database
+FLUSH_INTERVAL = float(os.getenv('TIKTOK_CRAWLER_METRICS_FLUSH_INTERVAL', '5'))
+
+PREFIX = "tiktok_crawler_"
+
+# Ngưỡng (giây) của các histogram
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+FFMPEG_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HISTOGRAMS = {
+    'extraction_seconds': ("Thời gian trích xuất thông tin (một lần gọi extractor)", LATENCY_BUCKETS),
+    'download_seconds': ("Thời gian tải dữ liệu media của một file", LATENCY_BUCKETS),
+    'ffmpeg_seconds': ("Thời gian hậu xử lý bằng ffmpeg của một bước", FFMPEG_BUCKETS),
+}
+
+COUNTERS = {
+    'extractions_total': "Số lần trích xuất thông tin",
+    'downloads_total': "Số lần tải file media theo kết quả",
+    'downloaded_bytes_total': "Tổng dung lượng file đã tải xong",
+    'downloaded_files_total': "Số file đã tải xong",
+    'errors_total': "Số lỗi yt-dlp theo loại lỗi",
+    'coalesced_requests_total': "Số yêu cầu tải trùng video được trả kết quả có sẵn hoặc của yêu cầu khác",
+    'pipeline_busy_seconds_total': "Tổng thời gian bận của các worker theo bước pipeline",
+    'pipeline_items_total': "Số video đã qua từng bước pipeline theo kết quả",
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (name, labels)
+);
+"""
+
+
+def _labels(labels: dict) -> str:
+    """Chuỗi nhãn theo định dạng Prometheus, sắp xếp theo tên"""
+    return ",".join(f'{k}="{str(v)}"' for k, v in sorted(labels.items()) if v is not None)
+
+
+def _format(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class MetricsRegistry:
+    """
+    Bộ đếm và histogram dùng chung giữa các tiến trình (SQLite trên volume downloads).
+
+    Mỗi worker gunicorn và lệnh CLI cộng dồn vào cùng một database, nên /metrics trả về
+    số liệu tổng của mọi worker bất kể worker nào nhận request scrape.
+
+    inc/observe chỉ cộng vào bộ đệm trong bộ nhớ của tiến trình; thread nền ghi bộ đệm xuống
+    database theo lô mỗi FLUSH_INTERVAL giây, ngoài ra còn ghi khi scrape và khi tiến trình
+    thoát. Số liệu của các tiến trình khác có thể trễ tối đa một chu kỳ.
+    """
+
+    def __init__(self, db_path: str = None, enabled: bool = METRICS_ENABLED,
+                 flush_interval: float = FLUSH_INTERVAL):
+        self.enabled = enabled
+        self.db_path = db_path or state.get_state_path(METRICS_DB_NAME)
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self._pid = os.getpid()
+        if self.enabled:
+            with closing(state.connect(self.db_path)) as conn:
+                conn.executescript(_SCHEMA)
+
+    def _add(self, rows: list):
+        with self._lock:
+            self._check_fork()
+            for name, labels, amount in rows:
+                self._pending[(name, labels)] = self._pending.get((name, labels), 0) + amount
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True)
+                self._flusher.start()
+
+    def _check_fork(self):
+        # Tiến trình con sau fork: số liệu đang đệm thuộc về tiến trình cha (cha sẽ tự ghi),
+        # thread ghi nền của cha không tồn tại trong con
+        if self._pid != os.getpid():
+            self._pending = {}
+            self._flusher = None
+            self._pid = os.getpid()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                # Giữ lại số liệu, thử lại ở chu kỳ sau
+                pass
+
+    def flush(self):
+        """Ghi toàn bộ số liệu đang đệm xuống database trong một transaction"""
+        if not self.enabled:
+            return
+        with self._flush_lock:
+            with self._lock:
+                self._check_fork()
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            try:
+                with closing(state.connect(self.db_path)) as conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    try:
+                        conn.executemany(
+                            "INSERT INTO series (name, labels, value) VALUES (?, ?, ?) "
+                            "ON CONFLICT(name, labels) DO UPDATE SET value = value + excluded.value",
+                            [(name, labels, value) for (name, labels), value in pending.items()]
+                        )
+                        conn.execute("COMMIT")
+                    except BaseException:
+                        conn.execute("ROLLBACK")
+                        raise
+            except BaseException:
+                # Trả số liệu về bộ đệm để lần ghi sau không làm mất
+                with self._lock:
+                    for key, value in pending.items():
+                        self._pending[key] = self._pending.get(key, 0) + value
+                raise
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        """Tăng bộ đếm"""
+        if not self.enabled:
+            return
+        try:
+            self._add([(name, _labels(labels), amount)])
+        except Exception:
+            # Số liệu không được làm hỏng việc tải
+            pass
+
+    def observe(self, name: str, value: float, **labels):
+        """Ghi một giá trị vào histogram (đếm theo từng khoảng, cộng dồn khi xuất)"""
+        if not self.enabled:
+            return
+        _, buckets = HISTOGRAMS[name]
+        bucket = next((str(b) for b in buckets if value <= b), "+Inf")
+        base = _labels(labels)
+        try:
+            self._add([
+                (f"{name}_bucket", _labels(dict(labels, le=bucket)), 1),
+                (f"{name}_sum", base, value),
+                (f"{name}_count", base, 1),
+            ])
+        except Exception:
+            pass
+
+    def snapshot(self) -> dict:
+        """Toàn bộ giá trị: {(tên, nhãn): giá trị}"""
+        if not self.enabled:
+            return {}
+        try:
+            self.flush()
+        except Exception:
+            pass
+        with closing(state.connect(self.db_path)) as conn:
+            return {(row['name'], row['labels']): row['value']
+                    for row in conn.execute("SELECT name, labels, value FROM series")}
+
+    def render(self, gauges: list = None) -> str:
+        """
+        Xuất số liệu theo định dạng text của Prometheus.
+
+        Args:
+            gauges: Danh sách (tên, mô tả, kiểu, [(nhãn dict, giá trị)]) tính tại thời điểm scrape
+        """
+        values = self.snapshot()
+        lines = []
+
+        for name, description in COUNTERS.items():
+            lines.append(f"# HELP {PREFIX}{name} {description}")
+            lines.append(f"# TYPE {PREFIX}{name} counter")
+            series = sorted((labels, value) for (n, labels), value in values.items() if n == name)
+            for labels, value in series or [("", 0)]:
+                lines.append(f"{PREFIX}{name}{{{labels}}} {_format(value)}" if labels
+                             else f"{PREFIX}{name} {_format(value)}")
+
+        for name, (description, buckets) in HISTOGRAMS.items():
+            lines.append(f"# HELP {PREFIX}{name} {description}")
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+            # Đếm theo từng khoảng -> số đếm cộng dồn theo ngưỡng như Prometheus yêu cầu
+            cumulative = 0
+            for bound in [str(b) for b in buckets] + ["+Inf"]:
+                cumulative += values.get((f"{name}_bucket", _labels({'le': bound})), 0)
+                lines.append(f'{PREFIX}{name}_bucket{{le="{bound}"}} {_format(cumulative)}')
+            lines.append(f"{PREFIX}{name}_sum {_format(values.get((f'{name}_sum', ''), 0))}")
+            lines.append(f"{PREFIX}{name}_count {_format(values.get((f'{name}_count', ''), 0))}")
+
+        for name, description, kind, samples in gauges or []:
+            lines.append(f"# HELP {PREFIX}{name} {description}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+            for labels, value in samples:
+                label_text = _labels(labels)
+                lines.append(f"{PREFIX}{name}{{{label_text}}} {_format(value)}" if label_text
+                             else f"{PREFIX}{name} {_format(value)}")
+
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """Xóa toàn bộ số liệu"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pending = {}
+        with closing(state.connect(self.db_path)) as conn:
+            conn.execute("DELETE FROM series")
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics() -> MetricsRegistry:
+    """Bộ số liệu dùng chung trong tiến trình (khởi tạo khi cần)"""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = MetricsRegistry()
+        return _metrics
+
+
+@atexit.register
+def _flush_on_exit():
+    # Ghi nốt số liệu còn đệm (lệnh CLI thường kết thúc trước chu kỳ ghi nền)
+    if _metrics is not None:
+        try:
+            _metrics.flush()
+        except Exception:
+            pass
@@ -0,0 +1,230 @@
+import os
+import time
+import random
+import threading
+from contextlib import closing
+from urllib.parse import urlsplit
+
+from . import state
+
+PROXIES_DB_NAME = "proxies.db"
+
+# Danh sách proxy: file (mỗi dòng một proxy, bỏ qua dòng trống và dòng bắt đầu bằng #)
+# hoặc biến môi trường (các proxy cách nhau bởi dấu phẩy)
+PROXY_FILE = os.getenv('TIKTOK_CRAWLER_PROXY_FILE')
+PROXY_LIST = os.getenv('TIKTOK_CRAWLER_PROXIES', '')
+
+# Số proxy thử lần lượt cho một yêu cầu trước khi báo lỗi
+DEFAULT_ATTEMPTS = int(os.getenv('TIKTOK_CRAWLER_PROXY_ATTEMPTS', '3'))
+# Số lỗi liên tiếp trước khi ngắt mạch (tạm ngưng proxy)
+DEFAULT_FAILURE_THRESHOLD = int(os.getenv('TIKTOK_CRAWLER_PROXY_FAILURE_THRESHOLD', '3'))
+# Thời gian tạm ngưng (giây), tăng gấp đôi mỗi lần ngắt mạch liên tiếp đến mức tối đa
+DEFAULT_COOLDOWN = int(os.getenv('TIKTOK_CRAWLER_PROXY_COOLDOWN', '300'))
+DEFAULT_MAX_COOLDOWN = int(os.getenv('TIKTOK_CRAWLER_PROXY_MAX_COOLDOWN', '3600'))
+
+# Trọng số của lần đo mới nhất trong độ trễ trung bình
+_LATENCY_ALPHA = 0.3
+
+# Loại kết quả của một lần dùng proxy
+OUTCOME_SUCCESS = "success"
+OUTCOME_FAILURE = "failure"
+OUTCOME_BLOCKED = "blocked"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS proxies (
+    proxy TEXT PRIMARY KEY,
+    successes INTEGER NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0,
+    blocks INTEGER NOT NULL DEFAULT 0,
+    consecutive_failures INTEGER NOT NULL DEFAULT 0,
+    trips INTEGER NOT NULL DEFAULT 0,
+    latency REAL,
+    cooldown_until REAL NOT NULL DEFAULT 0,
+    last_used REAL,
+    last_error TEXT
+);
+"""
+
+
+def mask_proxy(proxy: str) -> str:
+    """Ẩn mật khẩu của proxy khi hiển thị"""
+    if not proxy:
+        return proxy
+    parts = urlsplit(proxy)
+    if parts.password:
+        netloc = parts.netloc.replace(f":{parts.password}@", ":***@", 1)
+        return parts._replace(netloc=netloc).geturl()
+    return proxy
+
+
+def load_proxies(path: str = None, value: str = None) -> list:
+    """Đọc danh sách proxy từ file và/hoặc chuỗi cách nhau bởi dấu phẩy (giữ thứ tự, bỏ trùng)"""
+    proxies = []
+    path = path if path is not None else PROXY_FILE
+    value = value if value is not None else PROXY_LIST
+    if path and os.path.isfile(path):
+        with open(path, encoding='utf-8') as f:
+            proxies.extend(line.strip() for line in f)
+    if value:
+        proxies.extend(item.strip() for item in value.split(','))
+    return list(dict.fromkeys(p for p in proxies if p and not p.startswith('#')))
+
+
+class ProxyPool:
+    """
+    Nhóm proxy có chấm điểm sức khỏe, dùng chung giữa các tiến trình (SQLite trên volume downloads).
+
+    Mỗi lần dùng proxy được ghi lại (độ trễ, thành công, lỗi, bị chặn). Proxy được chọn
+    theo điểm (tỷ lệ thành công và độ trễ); proxy lỗi liên tiếp hoặc bị TikTok chặn bị ngắt
+    mạch trong một khoảng thời gian tạm ngưng, sau đó được thử lại.
+    """
+
+    def __init__(self, proxies: list, db_path: str = None, attempts: int = DEFAULT_ATTEMPTS,
+                 failure_threshold: int = DEFAULT_FAILURE_THRESHOLD, cooldown: int = DEFAULT_COOLDOWN,
+                 max_cooldown: int = DEFAULT_MAX_COOLDOWN):
+        self.proxies = list(proxies)
+        self.db_path = db_path or state.get_state_path(PROXIES_DB_NAME)
+        self.attempts = max(1, attempts)
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        if not self.proxies:
+            return
+        with closing(state.connect(self.db_path)) as conn:
+            conn.executescript(_SCHEMA)
+            conn.executemany("INSERT OR IGNORE INTO proxies (proxy) VALUES (?)", [(p,) for p in self.proxies])
+
+    def __bool__(self):
+        return bool(self.proxies)
+
+    def _connect(self):
+        return state.connect(self.db_path)
+
+    def _rows(self) -> dict:
+        if not self.proxies:
+            return {}
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT * FROM proxies").fetchall()
+        return {row['proxy']: dict(row) for row in rows if row['proxy'] in self.proxies}
+
+    @staticmethod
+    def _score(row: dict) -> float:
+        """Điểm sức khỏe: tỷ lệ thành công (làm trơn) chia cho độ trễ"""
+        attempts = row['successes'] + row['failures'] + row['blocks']
+        success_rate = (row['successes'] + 1) / (attempts + 2)
+        latency = row['latency'] if row['latency'] is not None else 1.0
+        return success_rate / (1.0 + latency)
+
+    def choose(self, exclude=()) -> str:
+        """
+        Chọn proxy khỏe cho yêu cầu tiếp theo, None nếu mọi proxy đang bị tạm ngưng.
+
+        Chọn ngẫu nhiên theo trọng số là điểm sức khỏe, để proxy khỏe nhận nhiều yêu cầu hơn
+        mà tải vẫn được chia cho cả nhóm (không dồn toàn bộ vào một proxy duy nhất).
+        """
+        now = time.time()
+        candidates = [row for proxy, row in self._rows().items()
+                      if proxy not in exclude and row['cooldown_until'] <= now]
+        if not candidates:
+            return None
+        return random.choices(candidates, weights=[self._score(row) for row in candidates])[0]['proxy']
+
+    def next_available_in(self) -> float:
+        """Số giây đến khi có proxy hết thời gian tạm ngưng"""
+        rows = self._rows().values()
+        if not rows:
+            return 0.0
+        return max(0.0, min(row['cooldown_until'] for row in rows) - time.time())
+
+    def report(self, proxy: str, outcome: str, latency: float = None, error: str = None):
+        """Ghi nhận kết quả một lần dùng proxy, ngắt mạch khi vượt ngưỡng lỗi hoặc bị chặn"""
+        if proxy not in self.proxies:
+            return
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT * FROM proxies WHERE proxy = ?", (proxy,)).fetchone()
+                if not row:
+                    conn.execute("INSERT INTO proxies (proxy) VALUES (?)", (proxy,))
+                    row = conn.execute("SELECT * FROM proxies WHERE proxy = ?", (proxy,)).fetchone()
+                row = dict(row)
+
+                if latency is not None:
+                    previous = row['latency']
+                    row['latency'] = latency if previous is None else (
+                        _LATENCY_ALPHA * latency + (1 - _LATENCY_ALPHA) * previous)
+                row['last_used'] = now
+
+                if outcome == OUTCOME_SUCCESS:
+                    row['successes'] += 1
+                    row['consecutive_failures'] = 0
+                    row['trips'] = 0
+                else:
+                    row['failures' if outcome == OUTCOME_FAILURE else 'blocks'] += 1
+                    row['consecutive_failures'] += 1
+                    row['last_error'] = (error or outcome)[:500]
+                    # Bị chặn thì ngắt mạch ngay, lỗi mạng thì sau nhiều lần liên tiếp
+                    if outcome == OUTCOME_BLOCKED or row['consecutive_failures'] >= self.failure_threshold:
+                        row['trips'] += 1
+                        cooldown = min(self.cooldown * 2 ** (row['trips'] - 1), self.max_cooldown)
+                        row['cooldown_until'] = now + cooldown
+                        row['consecutive_failures'] = 0
+
+                conn.execute(
+                    "UPDATE proxies SET successes = ?, failures = ?, blocks = ?, consecutive_failures = ?, "
+                    "trips = ?, latency = ?, cooldown_until = ?, last_used = ?, last_error = ? WHERE proxy = ?",
+                    (row['successes'], row['failures'], row['blocks'], row['consecutive_failures'],
+                     row['trips'], row['latency'], row['cooldown_until'], row['last_used'], row['last_error'], proxy)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def reset(self, proxy: str = None):
+        """Xóa số liệu và mở lại mạch cho một proxy (hoặc tất cả)"""
+        if not self.proxies:
+            return
+        query = ("UPDATE proxies SET successes = 0, failures = 0, blocks = 0, consecutive_failures = 0, "
+                 "trips = 0, latency = NULL, cooldown_until = 0, last_error = NULL")
+        with closing(self._connect()) as conn:
+            if proxy:
+                conn.execute(query + " WHERE proxy = ?", (proxy,))
+            else:
+                conn.execute(query)
+
+    def stats(self) -> list:
+        """Tình trạng từng proxy (mật khẩu đã được ẩn), proxy khỏe nhất trước"""
+        now = time.time()
+        result = []
+        for proxy, row in self._rows().items():
+            attempts = row['successes'] + row['failures'] + row['blocks']
+            result.append({
+                'proxy': mask_proxy(proxy),
+                'available': row['cooldown_until'] <= now,
+                'cooldown_remaining': round(max(0.0, row['cooldown_until'] - now), 1),
+                'successes': row['successes'],
+                'failures': row['failures'],
+                'blocks': row['blocks'],
+                'success_rate': round(row['successes'] / attempts, 4) if attempts else None,
+                'latency': round(row['latency'], 3) if row['latency'] is not None else None,
+                'score': round(self._score(row), 4),
+                'last_used': row['last_used'],
+                'last_error': row['last_error'],
+            })
+        result.sort(key=lambda item: (not item['available'], -item['score']))
+        return result
+
+
+_proxy_pool = None
+_proxy_pool_lock = threading.Lock()
+
+
+def get_proxy_pool() -> ProxyPool:
+    """Nhóm proxy cấu hình qua TIKTOK_CRAWLER_PROXY_FILE / TIKTOK_CRAWLER_PROXIES (khởi tạo khi cần)"""
+    global _proxy_pool
+    with _proxy_pool_lock:
+        if _proxy_pool is None:
+            _proxy_pool = ProxyPool(load_proxies())
+        return _proxy_pool
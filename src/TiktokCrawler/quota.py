@@ -0,0 +1,378 @@
+import os
+import re
+import time
+import uuid
+import shutil
+import threading
+from contextlib import closing
+from rich.console import Console
+
+from . import state
+from .index import get_download_index, _normalize
+from .storage import prune_empty_dirs
+
+console = Console()
+
+
+def parse_size(value) -> int:
+    """Dung lượng dạng '500M', '20G', '1.5T' hoặc số byte -> số byte (0 = không giới hạn)"""
+    if value in (None, ''):
+        return 0
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*', str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Dung lượng không hợp lệ: {value}")
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' KMGT'.index(unit.upper() or ' '))
+
+
+# Hạn mức của thư mục downloads: tổng dung lượng (ví dụ 50G) và số file (0 = không giới hạn)
+DEFAULT_MAX_BYTES = parse_size(os.getenv('TIKTOK_CRAWLER_QUOTA_BYTES', '0'))
+DEFAULT_MAX_FILES = int(os.getenv('TIKTOK_CRAWLER_QUOTA_FILES', '0'))
+# Dung lượng trống tối thiểu phải giữ lại trên ổ đĩa (0 = không kiểm tra)
+DEFAULT_MIN_FREE = parse_size(os.getenv('TIKTOK_CRAWLER_MIN_FREE_BYTES', '0'))
+# Khi vượt hạn mức, xóa tới khi còn tỷ lệ này của hạn mức (tránh lần tải nào cũng phải xóa file)
+DEFAULT_TARGET = float(os.getenv('TIKTOK_CRAWLER_QUOTA_TARGET', '0.9'))
+# Chu kỳ chạy của janitor (giây)
+DEFAULT_INTERVAL = float(os.getenv('TIKTOK_CRAWLER_QUOTA_INTERVAL', '60'))
+# File mới tải/sửa gần đây hơn số giây này không bị xóa (đang được hậu xử lý hoặc vừa tải xong)
+DEFAULT_MIN_AGE = float(os.getenv('TIKTOK_CRAWLER_QUOTA_MIN_AGE', '300'))
+# Dung lượng giữ chỗ khi chưa biết kích thước video (bằng giới hạn kích thước file của downloader)
+DEFAULT_RESERVATION = 50 * 1024 * 1024
+# Thời hạn của giữ chỗ/đánh dấu đang phục vụ, phòng khi tiến trình chết mà không giải phóng (giây)
+RESERVATION_TTL = 3600
+LEASE_TTL = 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_access (
+    path TEXT PRIMARY KEY,
+    accessed_at REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS file_leases (
+    id TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    pid INTEGER,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_file_leases_path ON file_leases (path);
+CREATE TABLE IF NOT EXISTS space_reservations (
+    id TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    pid INTEGER,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS quota_stats (
+    directory TEXT PRIMARY KEY,
+    evicted_files INTEGER NOT NULL DEFAULT 0,
+    evicted_bytes INTEGER NOT NULL DEFAULT 0,
+    last_run_at REAL,
+    last_evicted_at REAL
+);
+"""
+
+
+class DiskQuota:
+    """
+    Hạn mức dung lượng/số file của thư mục downloads, dùng chung giữa các tiến trình
+    (các bảng nằm trong database chỉ mục file đã tải).
+
+    - Janitor chạy nền xóa các video lâu không được phục vụ nhất (LRU theo lần tải file
+      qua /downloads, hoặc thời điểm tải nếu chưa từng được phục vụ) khi vượt hạn mức.
+    - Mỗi lần tải giữ chỗ trước dung lượng dự kiến, xóa bớt file cũ nếu cần,
+      và thất bại ngay nếu không đủ chỗ thay vì hỏng giữa chừng khi ổ đĩa đầy.
+    - Không bao giờ xóa file đang được phục vụ (có đánh dấu) hoặc vừa được ghi (chưa đủ MIN_AGE).
+    """
+
+    def __init__(self, index=None, max_bytes: int = DEFAULT_MAX_BYTES, max_files: int = DEFAULT_MAX_FILES,
+                 min_free: int = DEFAULT_MIN_FREE, target: float = DEFAULT_TARGET,
+                 min_age: float = DEFAULT_MIN_AGE, interval: float = DEFAULT_INTERVAL):
+        self.index = index or get_download_index()
+        self.db_path = self.index.db_path
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.min_free = min_free
+        self.target = min(max(target, 0.0), 1.0)
+        self.min_age = min_age
+        self.interval = interval
+        self._janitor = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        with closing(state.connect(self.db_path)) as conn:
+            conn.executescript(_SCHEMA)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_bytes or self.max_files or self.min_free)
+
+    def _connect(self):
+        return state.connect(self.db_path)
+
+    def touch(self, path: str):
+        """Ghi nhận một lần phục vụ file (thứ tự LRU)"""
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO file_access (path, accessed_at, hits) VALUES (?, ?, 1) "
+                "ON CONFLICT(path) DO UPDATE SET accessed_at = excluded.accessed_at, hits = hits + 1",
+                (_normalize(path), time.time())
+            )
+
+    def acquire(self, path: str, ttl: float = LEASE_TTL) -> str:
+        """Đánh dấu file đang được phục vụ (không bị xóa), trả về ID để giải phóng"""
+        lease_id = uuid.uuid4().hex
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO file_leases (id, path, pid, expires_at) VALUES (?, ?, ?, ?)",
+                (lease_id, _normalize(path), os.getpid(), time.time() + ttl)
+            )
+        return lease_id
+
+    def release(self, lease_id: str):
+        """Bỏ đánh dấu đang phục vụ"""
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM file_leases WHERE id = ?", (lease_id,))
+
+    def acquire_many(self, paths: list, ttl: float = LEASE_TTL) -> list:
+        """Đánh dấu nhiều file đang được phục vụ trong một lần ghi (ví dụ các file của một ZIP)"""
+        expires_at = time.time() + ttl
+        leases = [(uuid.uuid4().hex, _normalize(path), os.getpid(), expires_at) for path in paths]
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("INSERT INTO file_leases (id, path, pid, expires_at) VALUES (?, ?, ?, ?)", leases)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return [lease[0] for lease in leases]
+
+    def release_many(self, lease_ids: list):
+        """Bỏ đánh dấu đang phục vụ của nhiều file"""
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("DELETE FROM file_leases WHERE id = ?", [(lease_id,) for lease_id in lease_ids])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def reserve(self, directory: str, size: int = None, ttl: float = RESERVATION_TTL) -> tuple[bool, str]:
+        """
+        Giữ chỗ trước khi tải một file, xóa bớt file cũ nếu không đủ chỗ.
+
+        Args:
+            size: Dung lượng dự kiến (byte), mặc định DEFAULT_RESERVATION
+
+        Returns:
+            tuple: (success: bool, ID giữ chỗ (None nếu không giới hạn) hoặc thông báo lỗi: str)
+        """
+        if not self.enabled:
+            return True, None
+        directory = _normalize(directory)
+        if not size:
+            # Chưa biết kích thước: giữ chỗ theo giới hạn kích thước file (không vượt hạn mức)
+            size = min(DEFAULT_RESERVATION, self.max_bytes) if self.max_bytes else DEFAULT_RESERVATION
+        elif self.max_bytes and size > self.max_bytes:
+            return False, f"Video ({size / 1024 / 1024:.1f} MB) lớn hơn hạn mức dung lượng của thư mục downloads"
+
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._evict(conn, directory, size, 1)
+                over_bytes, over_files = self._overage(conn, directory, size, 1, limit=1.0)
+                if over_bytes > 0 or over_files > 0:
+                    conn.execute("COMMIT")
+                    return False, "Không đủ dung lượng trong thư mục downloads (các file còn lại đang được sử dụng)"
+                reservation_id = uuid.uuid4().hex
+                conn.execute(
+                    "INSERT INTO space_reservations (id, directory, bytes, pid, expires_at) VALUES (?, ?, ?, ?, ?)",
+                    (reservation_id, directory, size, os.getpid(), time.time() + ttl)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return True, reservation_id
+
+    def unreserve(self, reservation_id: str):
+        """Giải phóng chỗ đã giữ (sau khi file đã được ghi vào chỉ mục hoặc tải thất bại)"""
+        if not reservation_id:
+            return
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM space_reservations WHERE id = ?", (reservation_id,))
+
+    def _usage(self, conn, directory: str) -> tuple:
+        now = time.time()
+        used_bytes, used_files = conn.execute(
+            "SELECT COALESCE(SUM(size), 0), COUNT(*) FROM downloads WHERE directory = ?", (directory,)
+        ).fetchone()
+        reserved_bytes, reserved_files = conn.execute(
+            "SELECT COALESCE(SUM(bytes), 0), COUNT(*) FROM space_reservations WHERE directory = ? AND expires_at > ?",
+            (directory, now)
+        ).fetchone()
+        return used_bytes, used_files, reserved_bytes, reserved_files
+
+    def _overage(self, conn, directory: str, extra_bytes: int = 0, extra_files: int = 0,
+                 limit: float = None) -> tuple:
+        """Số byte/số file cần xóa để (sau khi thêm extra) về dưới limit * hạn mức"""
+        limit = self.target if limit is None else limit
+        used_bytes, used_files, reserved_bytes, reserved_files = self._usage(conn, directory)
+        needed_bytes = used_bytes + reserved_bytes + extra_bytes
+        needed_files = used_files + reserved_files + extra_files
+        over_bytes = over_files = 0
+        if self.max_bytes:
+            over_bytes = needed_bytes - int(self.max_bytes * limit)
+        if self.max_files:
+            over_files = needed_files - int(self.max_files * limit)
+        if self.min_free and os.path.isdir(directory):
+            # Dung lượng đã giữ chỗ chưa được ghi ra ổ đĩa
+            free = shutil.disk_usage(directory).free - reserved_bytes - extra_bytes
+            over_bytes = max(over_bytes, self.min_free - free)
+        return over_bytes, over_files
+
+    def _evict(self, conn, directory: str, extra_bytes: int = 0, extra_files: int = 0) -> tuple:
+        """
+        Xóa file lâu không được phục vụ nhất cho tới khi về dưới hạn mức
+        (chạy trong giao dịch BEGIN IMMEDIATE của nơi gọi, nên các tiến trình không xóa chồng lên nhau).
+
+        Returns:
+            tuple: (số file đã xóa, số byte đã giải phóng)
+        """
+        over_bytes, over_files = self._overage(conn, directory, extra_bytes, extra_files, limit=1.0)
+        if over_bytes <= 0 and over_files <= 0:
+            return 0, 0
+        # Đã vượt hạn mức: xóa xuống mức target để lần tải sau không phải xóa tiếp
+        over_bytes, over_files = self._overage(conn, directory, extra_bytes, extra_files)
+
+        now = time.time()
+        candidates = conn.execute(
+            "SELECT d.path, d.size FROM downloads d LEFT JOIN file_access a ON a.path = d.path "
+            "WHERE d.directory = ? AND d.downloaded_at < ? AND d.modified_at < ? "
+            "AND NOT EXISTS (SELECT 1 FROM file_leases l WHERE l.path = d.path AND l.expires_at > ?) "
+            "ORDER BY COALESCE(a.accessed_at, d.downloaded_at) ASC",
+            (directory, now - self.min_age, now - self.min_age, now)
+        ).fetchall()
+
+        files = freed = 0
+        for row in candidates:
+            if over_bytes <= 0 and over_files <= 0:
+                break
+            path = row['path']
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                console.print(f"[red]Không thể xóa {path}: {e}[/red]")
+                continue
+            conn.execute("DELETE FROM downloads WHERE path = ?", (path,))
+            conn.execute("DELETE FROM file_access WHERE path = ?", (path,))
+            prune_empty_dirs(os.path.dirname(path), directory)
+            files += 1
+            freed += row['size']
+            over_bytes -= row['size']
+            over_files -= 1
+
+        if files:
+            conn.execute(
+                "INSERT INTO quota_stats (directory, evicted_files, evicted_bytes, last_evicted_at) "
+                "VALUES (?, ?, ?, ?) ON CONFLICT(directory) DO UPDATE SET "
+                "evicted_files = evicted_files + excluded.evicted_files, "
+                "evicted_bytes = evicted_bytes + excluded.evicted_bytes, last_evicted_at = excluded.last_evicted_at",
+                (directory, files, freed, now)
+            )
+            console.print(f"[yellow]Đã xóa {files} video cũ ({freed / 1024 / 1024:.1f} MB) "
+                          f"để giữ thư mục downloads trong hạn mức[/yellow]")
+        return files, freed
+
+    def enforce(self, directory: str) -> tuple[int, int]:
+        """
+        Một lượt dọn dẹp: xóa file cũ nếu thư mục vượt hạn mức, dọn các giữ chỗ/đánh dấu hết hạn.
+
+        Returns:
+            tuple: (số file đã xóa, số byte đã giải phóng)
+        """
+        directory = _normalize(directory)
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM file_leases WHERE expires_at <= ?", (now,))
+                conn.execute("DELETE FROM space_reservations WHERE expires_at <= ?", (now,))
+                conn.execute("DELETE FROM file_access WHERE path NOT IN (SELECT path FROM downloads)")
+                result = self._evict(conn, directory) if self.enabled else (0, 0)
+                conn.execute(
+                    "INSERT INTO quota_stats (directory, last_run_at) VALUES (?, ?) "
+                    "ON CONFLICT(directory) DO UPDATE SET last_run_at = excluded.last_run_at",
+                    (directory, now)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def stats(self, directory: str) -> dict:
+        """Dung lượng đã dùng, hạn mức, dung lượng giữ chỗ, số file đang phục vụ và số file đã bị xóa"""
+        directory = _normalize(directory)
+        now = time.time()
+        with closing(self._connect()) as conn:
+            used_bytes, used_files, reserved_bytes, reservations = self._usage(conn, directory)
+            leases = conn.execute(
+                "SELECT COUNT(DISTINCT l.path) FROM file_leases l JOIN downloads d ON d.path = l.path "
+                "WHERE d.directory = ? AND l.expires_at > ?", (directory, now)
+            ).fetchone()[0]
+            row = conn.execute("SELECT * FROM quota_stats WHERE directory = ?", (directory,)).fetchone()
+        disk = shutil.disk_usage(directory) if os.path.isdir(directory) else None
+        return {
+            'directory': directory,
+            'enabled': self.enabled,
+            'used_bytes': used_bytes,
+            'used_files': used_files,
+            'max_bytes': self.max_bytes or None,
+            'max_files': self.max_files or None,
+            'min_free_bytes': self.min_free or None,
+            'reserved_bytes': reserved_bytes,
+            'reservations': reservations,
+            'files_in_use': leases,
+            'disk_total_bytes': disk.total if disk else None,
+            'disk_free_bytes': disk.free if disk else None,
+            'evicted_files': row['evicted_files'] if row else 0,
+            'evicted_bytes': row['evicted_bytes'] if row else 0,
+            'last_run_at': row['last_run_at'] if row else None,
+            'last_evicted_at': row['last_evicted_at'] if row else None,
+        }
+
+    def start_janitor(self, directory: str):
+        """Khởi động thread janitor (chỉ một lần cho mỗi tiến trình, không làm gì nếu không đặt hạn mức)"""
+        with self._lock:
+            if self._janitor or not self.enabled:
+                return
+            self._janitor = threading.Thread(target=self._janitor_loop, args=(directory,),
+                                             name="quota-janitor", daemon=True)
+            self._janitor.start()
+
+    def stop_janitor(self):
+        self._stop.set()
+
+    def _janitor_loop(self, directory: str):
+        while not self._stop.is_set():
+            try:
+                self.enforce(directory)
+            except Exception as e:
+                console.print(f"[red]Lỗi khi dọn dẹp thư mục downloads: {e}[/red]")
+            self._stop.wait(self.interval)
+
+
+_disk_quota = None
+_disk_quota_lock = threading.Lock()
+
+
+def get_disk_quota() -> DiskQuota:
+    """Hạn mức thư mục downloads dùng chung trong tiến trình (khởi tạo khi cần)"""
+    global _disk_quota
+    with _disk_quota_lock:
+        if _disk_quota is None:
+            _disk_quota = DiskQuota()
+        return _disk_quota
@@ -0,0 +1,212 @@
+import os
+import time
+import threading
+from contextlib import closing
+from urllib.parse import urlsplit
+
+from . import state
+
+RATE_LIMIT_DB_NAME = "ratelimit.db"
+
+# Số request mỗi giây cho mỗi host (0 = tắt), số request được phép dồn cùng lúc
+# và tốc độ tối thiểu khi đang giảm tốc do bị chặn
+DEFAULT_RATE = float(os.getenv('TIKTOK_CRAWLER_RATE_LIMIT', '2'))
+DEFAULT_BURST = float(os.getenv('TIKTOK_CRAWLER_RATE_BURST', '5'))
+DEFAULT_MIN_RATE = float(os.getenv('TIKTOK_CRAWLER_RATE_MIN', '0.1'))
+# Thời gian tạm dừng (giây) khi bị chặn/giới hạn, tăng gấp đôi mỗi lần liên tiếp đến mức tối đa
+DEFAULT_BACKOFF = float(os.getenv('TIKTOK_CRAWLER_RATE_BACKOFF', '30'))
+DEFAULT_MAX_BACKOFF = float(os.getenv('TIKTOK_CRAWLER_RATE_MAX_BACKOFF', '600'))
+
+# Mỗi request thành công tăng tốc độ thêm một phần của tốc độ tối đa
+_RAMP_UP_FRACTION = 0.1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    host TEXT PRIMARY KEY,
+    rate REAL NOT NULL,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    backoff_until REAL NOT NULL DEFAULT 0,
+    consecutive_blocks INTEGER NOT NULL DEFAULT 0,
+    requests INTEGER NOT NULL DEFAULT 0,
+    blocks INTEGER NOT NULL DEFAULT 0,
+    waited REAL NOT NULL DEFAULT 0
+);
+"""
+
+
+def host_of(url: str) -> str:
+    """Host của một URL (chữ thường), None nếu không phải URL"""
+    if not url or '://' not in url:
+        return None
+    return (urlsplit(url).hostname or '').lower() or None
+
+
+class RateLimiter:
+    """
+    Bộ giới hạn tốc độ token bucket theo từng host, dùng chung giữa các tiến trình
+    (SQLite trên volume downloads) nên mọi worker gunicorn và lệnh CLI cùng chia một hạn mức.
+
+    Tự điều chỉnh: bị chặn/giới hạn (403/429) thì giảm nửa tốc độ và tạm dừng host đó,
+    mỗi request thành công thì tăng dần tốc độ trở lại mức tối đa.
+    """
+
+    def __init__(self, db_path: str = None, rate: float = DEFAULT_RATE, burst: float = DEFAULT_BURST,
+                 min_rate: float = DEFAULT_MIN_RATE, backoff: float = DEFAULT_BACKOFF,
+                 max_backoff: float = DEFAULT_MAX_BACKOFF):
+        self.db_path = db_path or state.get_state_path(RATE_LIMIT_DB_NAME)
+        self.max_rate = rate
+        self.burst = max(1.0, burst)
+        self.min_rate = min(min_rate, rate) if rate > 0 else min_rate
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        if self.enabled:
+            with closing(state.connect(self.db_path)) as conn:
+                conn.executescript(_SCHEMA)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_rate > 0
+
+    def _connect(self):
+        return state.connect(self.db_path)
+
+    def _load(self, conn, host: str, now: float) -> dict:
+        row = conn.execute("SELECT * FROM buckets WHERE host = ?", (host,)).fetchone()
+        if row:
+            bucket = dict(row)
+            # Nạp lại token theo thời gian đã trôi qua
+            elapsed = max(0.0, now - bucket['updated_at'])
+            bucket['tokens'] = min(self.burst, bucket['tokens'] + elapsed * bucket['rate'])
+        else:
+            bucket = {'host': host, 'rate': self.max_rate, 'tokens': self.burst, 'backoff_until': 0,
+                      'consecutive_blocks': 0, 'requests': 0, 'blocks': 0, 'waited': 0.0}
+        bucket['updated_at'] = now
+        return bucket
+
+    @staticmethod
+    def _save(conn, bucket: dict):
+        conn.execute(
+            "INSERT OR REPLACE INTO buckets (host, rate, tokens, updated_at, backoff_until, consecutive_blocks, "
+            "requests, blocks, waited) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (bucket['host'], bucket['rate'], bucket['tokens'], bucket['updated_at'], bucket['backoff_until'],
+             bucket['consecutive_blocks'], bucket['requests'], bucket['blocks'], bucket['waited'])
+        )
+
+    def _transaction(self, host: str, update):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                bucket = self._load(conn, host, now)
+                result = update(bucket, now)
+                self._save(conn, bucket)
+                conn.execute("COMMIT")
+                return result
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def acquire(self, host: str) -> float:
+        """
+        Lấy một lượt request cho host, chờ nếu đã hết token hoặc host đang bị tạm dừng.
+
+        Token được giữ chỗ ngay trong giao dịch (có thể âm), nên các tiến trình chờ
+        theo thứ tự và không cùng lao vào khi token được nạp lại.
+
+        Returns:
+            float: Số giây đã chờ
+        """
+        if not self.enabled or not host:
+            return 0.0
+
+        def reserve(bucket, now):
+            bucket['tokens'] -= 1
+            wait = 0.0
+            if bucket['tokens'] < 0:
+                wait = -bucket['tokens'] / bucket['rate']
+            wait = max(wait, bucket['backoff_until'] - now)
+            bucket['requests'] += 1
+            bucket['waited'] += wait
+            return wait
+
+        wait = self._transaction(host, reserve)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def report_success(self, host: str):
+        """Request thành công: tăng dần tốc độ trở lại mức tối đa"""
+        if not self.enabled or not host:
+            return
+
+        def ramp_up(bucket, now):
+            bucket['consecutive_blocks'] = 0
+            if bucket['rate'] < self.max_rate:
+                bucket['rate'] = min(self.max_rate, bucket['rate'] + self.max_rate * _RAMP_UP_FRACTION)
+
+        self._transaction(host, ramp_up)
+
+    def report_block(self, host: str):
+        """Bị chặn/giới hạn: giảm nửa tốc độ và tạm dừng host"""
+        if not self.enabled or not host:
+            return
+
+        def back_off(bucket, now):
+            bucket['blocks'] += 1
+            bucket['consecutive_blocks'] += 1
+            bucket['rate'] = max(self.min_rate, bucket['rate'] / 2)
+            bucket['tokens'] = min(bucket['tokens'], 0.0)
+            delay = min(self.backoff * 2 ** (bucket['consecutive_blocks'] - 1), self.max_backoff)
+            bucket['backoff_until'] = max(bucket['backoff_until'], now + delay)
+
+        self._transaction(host, back_off)
+
+    def reset(self):
+        """Xóa toàn bộ trạng thái (tốc độ trở về mức tối đa)"""
+        if not self.enabled:
+            return
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM buckets")
+
+    def stats(self) -> dict:
+        """Tốc độ hiện tại và trạng thái tạm dừng của từng host"""
+        result = {
+            'enabled': self.enabled,
+            'max_rate': self.max_rate,
+            'min_rate': self.min_rate,
+            'burst': self.burst,
+            'hosts': [],
+        }
+        if not self.enabled:
+            return result
+        now = time.time()
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT * FROM buckets ORDER BY requests DESC").fetchall()
+        for row in rows:
+            elapsed = max(0.0, now - row['updated_at'])
+            result['hosts'].append({
+                'host': row['host'],
+                'rate': round(row['rate'], 3),
+                'tokens': round(min(self.burst, row['tokens'] + elapsed * row['rate']), 2),
+                'backing_off': row['backoff_until'] > now,
+                'backoff_remaining': round(max(0.0, row['backoff_until'] - now), 1),
+                'consecutive_blocks': row['consecutive_blocks'],
+                'requests': row['requests'],
+                'blocks': row['blocks'],
+                'waited_seconds': round(row['waited'], 1),
+            })
+        return result
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Bộ giới hạn tốc độ dùng chung trong tiến trình (khởi tạo khi cần)"""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+        return _rate_limiter
@@ -0,0 +1,163 @@
+import os
+import json
+import inspect
+import functools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Các option là hook theo từng lần gọi, không dùng để phân biệt phiên
+HOOK_OPTIONS = ('post_hooks', 'progress_hooks', 'postprocessor_hooks')
+
+DEFAULT_MAX_IDLE_PER_KEY = int(os.getenv('TIKTOK_CRAWLER_SESSION_IDLE', '4'))
+DEFAULT_MAX_KEYS = int(os.getenv('TIKTOK_CRAWLER_SESSION_KEYS', '32'))
+
+# cached_property của YoutubeDL giữ request director
+DIRECTOR_ATTR = '_request_director'
+
+
+def _has_director_slot(factory) -> bool:
+    """Lớp YoutubeDL còn giữ request director trong một functools.cached_property tên DIRECTOR_ATTR"""
+    return isinstance(inspect.getattr_static(factory, DIRECTOR_ATTR, None), functools.cached_property)
+
+
+def _per_call(name: str, value) -> bool:
+    """Option gắn theo từng lần gọi: các hook và download archive dạng set trong bộ nhớ"""
+    return name in HOOK_OPTIONS or (name == 'download_archive' and isinstance(value, set))
+
+
+def session_key(ydl_opts: dict) -> str:
+    """Khóa phiên: toàn bộ option (gồm proxy, thư mục output...) trừ các option theo từng lần gọi"""
+    opts = {k: v for k, v in ydl_opts.items() if not _per_call(k, v)}
+    return json.dumps(opts, sort_keys=True, default=repr)
+
+
+class SessionPool:
+    """
+    Nhóm trạng thái phiên YoutubeDL dùng lại theo bộ option (proxy, output...): các extractor
+    đã khởi tạo (token, thông tin app... của TikTok), cookie jar và request director (handler
+    HTTP cùng SSL context, kết nối keep-alive).
+
+    Mỗi lần gọi tạo một YoutubeDL mới với đúng option của lần gọi (kể cả hook, download archive)
+    rồi gắn extractor và cookie của một phiên rảnh qua API công khai của yt-dlp, nên không có
+    option hay trạng thái tải nào của lần gọi trước còn sót lại. Request director không có API
+    công khai nên chỉ được dùng lại khi lớp YoutubeDL còn khai báo ô cached_property
+    `_request_director` (nếu không, mỗi lần gọi tự tạo director mới như yt-dlp mặc định); cùng khóa
+    phiên nghĩa là cùng header/proxy/cookie nên director dùng chung được. Mỗi phiên chỉ được một
+    thread dùng tại một thời điểm.
+    """
+
+    def __init__(self, factory, extractors, max_idle_per_key: int = DEFAULT_MAX_IDLE_PER_KEY,
+                 max_keys: int = DEFAULT_MAX_KEYS):
+        """
+        Args:
+            factory: Lớp YoutubeDL, được gọi factory(params, auto_init=False)
+            extractors: Hàm trả về danh sách extractor (instance) mới cho một phiên
+        """
+        self.factory = factory
+        self.extractors = extractors
+        self.reuse_director = _has_director_slot(factory)
+        self.max_idle_per_key = max_idle_per_key
+        self.max_keys = max_keys
+        self._idle = OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, ydl_opts: dict):
+        """Lấy một phiên phù hợp với option (tạo mới nếu chưa có phiên rảnh), trả về (key, phiên, YoutubeDL)"""
+        key = session_key(ydl_opts)
+        session = None
+        with self._lock:
+            self._check_fork()
+            sessions = self._idle.get(key)
+            if sessions:
+                session = sessions.pop()
+                self._idle.move_to_end(key)
+                self.reused += 1
+            else:
+                self.created += 1
+
+        if session is None:
+            session = {'extractors': self.extractors(), 'cookiejar': None, 'director': None}
+        ydl = self.factory(dict(ydl_opts), auto_init=False)
+        for ie in session['extractors']:
+            ydl.add_info_extractor(ie)
+        if session['cookiejar'] is not None:
+            ydl.cookiejar = session['cookiejar']
+        if self.reuse_director and session['director'] is not None:
+            ydl.__dict__[DIRECTOR_ATTR] = session['director']
+        return key, session, ydl
+
+    def release(self, key: str, session: dict, ydl):
+        """Đóng YoutubeDL của lần gọi, trả phiên về nhóm để dùng lại (bỏ nếu nhóm đã đầy)"""
+        session['cookiejar'] = ydl.cookiejar
+        # Lấy director ra trước khi close() để nó không bị đóng cùng YoutubeDL
+        if self.reuse_director:
+            session['director'] = ydl.__dict__.pop(DIRECTOR_ATTR, None)
+        self._close(ydl)
+        evicted = []
+        with self._lock:
+            self._check_fork()
+            sessions = self._idle.setdefault(key, [])
+            self._idle.move_to_end(key)
+            if len(sessions) < self.max_idle_per_key:
+                sessions.append(session)
+            else:
+                evicted.append(session)
+            while len(self._idle) > self.max_keys:
+                evicted.extend(self._idle.popitem(last=False)[1])
+        for session in evicted:
+            self._close_session(session)
+
+    def discard(self, ydl):
+        """Đóng YoutubeDL bị lỗi, không dùng lại phiên của nó"""
+        self._close(ydl)
+
+    @contextmanager
+    def session(self, ydl_opts: dict):
+        """Context manager: lấy phiên, trả về nhóm khi xong (bỏ phiên nếu có lỗi bất thường)"""
+        key, session, ydl = self.acquire(ydl_opts)
+        try:
+            yield ydl
+        except BaseException:
+            self.discard(ydl)
+            raise
+        else:
+            self.release(key, session, ydl)
+
+    def clear(self):
+        """Bỏ toàn bộ phiên đang rảnh"""
+        with self._lock:
+            evicted = [session for sessions in self._idle.values() for session in sessions]
+            self._idle.clear()
+        for session in evicted:
+            self._close_session(session)
+
+    def stats(self) -> dict:
+        with self._lock:
+            idle = sum(len(sessions) for sessions in self._idle.values())
+            return {'created': self.created, 'reused': self.reused, 'idle': idle, 'keys': len(self._idle)}
+
+    def _check_fork(self):
+        # Không dùng lại cookie/extractor/kết nối kế thừa từ tiến trình cha sau khi fork
+        if self._pid != os.getpid():
+            self._idle.clear()
+            self._pid = os.getpid()
+
+    @staticmethod
+    def _close(ydl):
+        try:
+            ydl.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _close_session(session: dict):
+        director = session.get('director')
+        if director is not None:
+            try:
+                director.close()
+            except Exception:
+                pass
@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from contextlib import closing, contextmanager
+from rich.console import Console
+
+from . import state
+
+console = Console()
+
+SINGLEFLIGHT_DB_NAME = "singleflight.db"
+LOCKS_DIRNAME = state.LOCKS_DIRNAME
+
+# Thời gian tối đa một yêu cầu trùng chờ yêu cầu đầu tiên tải xong (giây)
+DEFAULT_WAIT_TIMEOUT = float(os.getenv('TIKTOK_CRAWLER_SINGLEFLIGHT_TIMEOUT', '900'))
+# Thời gian giữ kết quả để trả cho các yêu cầu đã chờ (giây)
+RESULT_TTL = 3600
+# Số file khóa dùng chung (khóa theo hash của video, không tạo một file cho mỗi video)
+LOCK_STRIPES = 4096
+POLL_INTERVAL = 0.2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS flight_results (
+    key TEXT PRIMARY KEY,
+    success INTEGER NOT NULL,
+    message TEXT,
+    files TEXT,
+    finished_at REAL NOT NULL
+);
+"""
+
+
+class SingleFlight:
+    """
+    Gộp các yêu cầu tải trùng nhau (cùng khóa, ví dụ cùng ID video và thư mục) giữa mọi
+    tiến trình trên cùng volume downloads: yêu cầu đầu tiên tải, các yêu cầu đến trong lúc
+    đó chờ và nhận luôn kết quả của nó thay vì gọi TikTok thêm lần nữa.
+
+    Khóa là file trong thư mục trạng thái (flock), hệ điều hành tự nhả khóa khi tiến trình
+    đang giữ bị chết, nên không có khóa treo. Kết quả được lưu trong SQLite cho các yêu cầu đang chờ.
+    """
+
+    def __init__(self, db_path: str = None, lock_dir: str = None, wait_timeout: float = DEFAULT_WAIT_TIMEOUT,
+                 result_ttl: float = RESULT_TTL):
+        self.db_path = db_path or state.get_state_path(SINGLEFLIGHT_DB_NAME)
+        self.lock_dir = lock_dir or state.get_state_path(LOCKS_DIRNAME)
+        self.wait_timeout = wait_timeout
+        self.result_ttl = result_ttl
+        os.makedirs(self.lock_dir, exist_ok=True)
+        with closing(state.connect(self.db_path)) as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        return state.connect(self.db_path)
+
+    def _lock_path(self, key: str) -> str:
+        stripe = int(hashlib.sha1(key.encode()).hexdigest(), 16) % LOCK_STRIPES
+        return os.path.join(self.lock_dir, f"flight-{stripe:04d}.lock")
+
+    @contextmanager
+    def _locked(self, key: str, timeout: float):
+        """Giữ khóa của key trong khối with, nhận (đã lấy được khóa, đã phải chờ)"""
+        with open(self._lock_path(key), 'a+') as f:
+            waited = False
+            deadline = time.monotonic() + timeout
+            acquired = state.try_lock_file(f)
+            while not acquired and time.monotonic() < deadline:
+                waited = True
+                time.sleep(POLL_INTERVAL)
+                acquired = state.try_lock_file(f)
+            try:
+                yield acquired, waited
+            finally:
+                if acquired:
+                    state.unlock_file(f)
+
+    def result(self, key: str, since: float = 0) -> dict:
+        """Kết quả gần nhất của key hoàn tất sau thời điểm since, None nếu không có"""
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM flight_results WHERE key = ? AND finished_at >= ?",
+                               (key, since)).fetchone()
+        if not row:
+            return None
+        return {'success': bool(row['success']), 'message': row['message'],
+                'files': json.loads(row['files'] or '[]'), 'finished_at': row['finished_at']}
+
+    def _save(self, key: str, success: bool, message: str, files: list):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO flight_results (key, success, message, files, finished_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, int(bool(success)), message, json.dumps(files or []), now)
+            )
+            conn.execute("DELETE FROM flight_results WHERE finished_at < ?", (now - self.result_ttl,))
+
+    def run(self, key: str, operation, existing=None) -> tuple[bool, str, list, str]:
+        """
+        Chạy operation() -> (success, message, files) một lần cho mỗi nhóm yêu cầu trùng key.
+
+        Args:
+            key: Khóa gộp yêu cầu
+            operation: Công việc thực sự (chỉ yêu cầu đầu tiên chạy)
+            existing: Hàm trả về (success, message, files) nếu kết quả đã có sẵn
+                (ví dụ file đã tải), None nếu chưa; được kiểm tra lại sau khi có khóa
+
+        Returns:
+            tuple: (success, message, files, vai trò: 'leader' | 'shared' | 'existing' | 'timeout')
+        """
+        started = time.time()
+        # Đã có sẵn: trả về ngay, không cần chờ khóa
+        found = existing() if existing else None
+        if found:
+            return (*found, 'existing')
+
+        with self._locked(key, self.wait_timeout) as (acquired, waited):
+            if not acquired:
+                return (False, f"Video đang được tải bởi một yêu cầu khác quá {self.wait_timeout:.0f} giây, "
+                               f"vui lòng thử lại sau", [], 'timeout')
+            # Yêu cầu đầu tiên vừa xong trong lúc chờ: dùng luôn kết quả của nó
+            if waited:
+                shared = self.result(key, since=started)
+                if shared:
+                    return shared['success'], shared['message'], shared['files'], 'shared'
+                found = existing() if existing else None
+                if found:
+                    return (*found, 'existing')
+
+            success, message, files = False, "Lỗi không mong muốn", []
+            try:
+                success, message, files = operation()
+            finally:
+                try:
+                    self._save(key, success, message, files)
+                except Exception as e:
+                    console.print(f"[red]Không thể lưu kết quả tải cho các yêu cầu đang chờ: {e}[/red]")
+            return success, message, files, 'leader'
+
+
+_single_flight = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight() -> SingleFlight:
+    """Bộ gộp yêu cầu tải trùng dùng chung trong tiến trình (khởi tạo khi cần)"""
+    global _single_flight
+    with _single_flight_lock:
+        if _single_flight is None:
+            _single_flight = SingleFlight()
+        return _single_flight
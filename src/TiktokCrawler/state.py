@@ -0,0 +1,115 @@
+import os
+import time
+import random
+import sqlite3
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Thư mục lưu video mặc định (downloader dùng lại hằng số này)
+DOWNLOADS_DIR = "downloads"
+
+# Thư mục chứa dữ liệu trạng thái (SQLite) nằm trong volume downloads,
+# để mọi worker gunicorn và lệnh CLI trên cùng máy dùng chung.
+STATE_DIRNAME = ".crawler"
+
+
+def get_state_dir(base_dir: str = None) -> str:
+    """
+    Lấy thư mục lưu dữ liệu trạng thái theo thứ tự ưu tiên:
+    1. Biến môi trường TIKTOK_CRAWLER_STATE_DIR
+    2. Thư mục con .crawler trong thư mục downloads
+    """
+    state_dir = os.getenv('TIKTOK_CRAWLER_STATE_DIR')
+    if not state_dir:
+        state_dir = os.path.join(base_dir or DOWNLOADS_DIR, STATE_DIRNAME)
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir, exist_ok=True)
+    return state_dir
+
+
+def get_state_path(name: str, base_dir: str = None) -> str:
+    """Đường dẫn tới một file trạng thái trong thư mục trạng thái"""
+    return os.path.join(get_state_dir(base_dir), name)
+
+
+def connect(path: str, timeout: float = 30.0) -> sqlite3.Connection:
+    """
+    Mở kết nối SQLite dùng chung giữa nhiều tiến trình.
+
+    Mỗi thao tác nên mở kết nối riêng (không chia sẻ qua fork của gunicorn).
+    WAL cho phép đọc song song trong khi một tiến trình khác đang ghi.
+    """
+    conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(timeout * 1000)}")
+    return conn
+
+
+# Thư mục con của thư mục trạng thái chứa các file khóa (flock) dùng chung giữa các tiến trình
+LOCKS_DIRNAME = "locks"
+
+
+def try_lock_file(f) -> bool:
+    """Khóa độc quyền file đang mở, không chờ (hệ điều hành tự nhả khi tiến trình chết)"""
+    try:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+
+def unlock_file(f):
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class ProcessSemaphore:
+    """
+    Semaphore dùng chung giữa mọi tiến trình trên cùng volume downloads (worker gunicorn,
+    job, lệnh CLI): mỗi chỗ là một file khóa trong thư mục trạng thái, nên tổng số chỗ đang
+    được giữ trên cả máy không vượt quá slots. Tiến trình chết thì khóa tự được nhả.
+    """
+
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, name: str, slots: int, lock_dir: str = None):
+        self.name = name
+        self.slots = max(1, slots)
+        self.lock_dir = lock_dir or get_state_path(LOCKS_DIRNAME)
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+    def _slot_path(self, slot: int) -> str:
+        return os.path.join(self.lock_dir, f"{self.name}-{slot:03d}.lock")
+
+    @contextmanager
+    def acquire(self):
+        """Giữ một chỗ trong khối with (chờ tới khi có chỗ trống), nhận số thứ tự của chỗ"""
+        while True:
+            # Bắt đầu từ một chỗ ngẫu nhiên để các tiến trình không cùng tranh chỗ đầu tiên
+            start = random.randrange(self.slots)
+            for offset in range(self.slots):
+                slot = (start + offset) % self.slots
+                f = open(self._slot_path(slot), 'a+')
+                if try_lock_file(f):
+                    try:
+                        yield slot
+                    finally:
+                        unlock_file(f)
+                        f.close()
+                    return
+                f.close()
+            time.sleep(self.POLL_INTERVAL)
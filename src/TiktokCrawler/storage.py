@@ -0,0 +1,161 @@
+import os
+
+# Tên file của mỗi video (giữ nguyên ở mọi kiểu bố trí thư mục)
+FILENAME_TEMPLATE = '%(title).50s_%(id)s.%(ext)s'
+
+# Kiểu bố trí thư mục con trong thư mục downloads (template thư mục của yt-dlp):
+# - flat: tất cả file nằm trực tiếp trong thư mục downloads
+# - id: theo 4 chữ số cuối của ID video (2 cấp, tối đa 10.000 thư mục, phân bố đều)
+# - uploader: mỗi tác giả một thư mục
+# - uploader-id: theo tác giả rồi theo 2 chữ số cuối của ID video
+LAYOUTS = {
+    'flat': '',
+    'id': '%(id.-2:)s/%(id.-4:-2)s',
+    'uploader': '%(uploader,uploader_id|_unknown)s',
+    'uploader-id': '%(uploader,uploader_id|_unknown)s/%(id.-2:)s',
+}
+DEFAULT_LAYOUT = os.getenv('TIKTOK_CRAWLER_STORAGE_LAYOUT', 'flat')
+
+
+def get_layout(layout: str = None) -> str:
+    """Kiểu bố trí đang dùng (mặc định TIKTOK_CRAWLER_STORAGE_LAYOUT)"""
+    layout = layout or DEFAULT_LAYOUT
+    if layout not in LAYOUTS:
+        raise ValueError(f"Kiểu bố trí thư mục không hợp lệ: {layout} (hỗ trợ: {', '.join(LAYOUTS)})")
+    return layout
+
+
+def output_template(layout: str = None) -> str:
+    """Template output của yt-dlp (tương đối so với thư mục downloads, dùng với option 'paths')"""
+    directory = LAYOUTS[get_layout(layout)]
+    return f"{directory}/{FILENAME_TEMPLATE}" if directory else FILENAME_TEMPLATE
+
+
+def is_hidden(name: str) -> bool:
+    # Thư mục ẩn (ví dụ .crawler chứa dữ liệu trạng thái) không thuộc thư viện video
+    return name.startswith('.')
+
+
+def iter_files(root: str, extensions: tuple = None):
+    """Duyệt mọi file trong thư viện (kể cả thư mục con, bỏ qua thư mục ẩn), trả về os.DirEntry"""
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not is_hidden(entry.name):
+                            stack.append(entry.path)
+                    elif entry.is_file() and (not extensions or entry.name.lower().endswith(extensions)):
+                        yield entry
+        except OSError:
+            continue
+
+
+def relative_path(path: str, root: str) -> str:
+    """Đường dẫn của file so với thư mục downloads (dùng '/'), None nếu file nằm ngoài"""
+    root = os.path.realpath(os.path.abspath(root))
+    path = os.path.realpath(os.path.abspath(path))
+    if os.path.commonpath([root, path]) != root or path == root:
+        return None
+    return os.path.relpath(path, root).replace(os.sep, '/')
+
+
+def resolve(root: str, relative: str) -> str:
+    """
+    Đường dẫn tuyệt đối của một file trong thư mục downloads từ đường dẫn tương đối.
+
+    Raises:
+        ValueError: Đường dẫn trỏ ra ngoài thư mục downloads hoặc vào thư mục ẩn
+    """
+    parts = [part for part in relative.replace('\\', '/').split('/') if part]
+    if not parts or any(part == '..' or is_hidden(part) for part in parts) or os.path.isabs(relative):
+        raise ValueError(f"Đường dẫn không hợp lệ: {relative}")
+    path = os.path.join(os.path.realpath(os.path.abspath(root)), *parts)
+    if relative_path(path, root) is None:
+        raise ValueError(f"Đường dẫn không hợp lệ: {relative}")
+    return path
+
+
+def prune_empty_dirs(directory: str, root: str):
+    """Xóa các thư mục con rỗng từ directory ngược lên tới (không gồm) thư mục downloads"""
+    root = os.path.realpath(os.path.abspath(root))
+    directory = os.path.realpath(os.path.abspath(directory))
+    while directory != root and relative_path(directory, root):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            return
+        directory = os.path.dirname(directory)
+
+
+def _template_ydl():
+    """YoutubeDL chỉ dùng để tính đường dẫn theo template (không nạp extractor)"""
+    import yt_dlp
+    return yt_dlp.YoutubeDL({'quiet': True}, auto_init=False)
+
+
+def target_path(root: str, path: str, entry: dict, layout: str = None, ydl=None) -> str:
+    """
+    Vị trí của một file theo kiểu bố trí (giữ nguyên tên file), tính bằng chính template
+    của yt-dlp để file đã chuyển trùng với vị trí các lần tải mới.
+
+    Args:
+        entry: Bản ghi chỉ mục của file (video_id, uploader, uploader_id)
+    """
+    directory = LAYOUTS[get_layout(layout)]
+    if not directory:
+        return os.path.join(root, os.path.basename(path))
+    ydl = ydl or _template_ydl()
+    info = {
+        'id': entry.get('video_id') or '',
+        'uploader': entry.get('uploader'),
+        'uploader_id': entry.get('uploader_id'),
+        'title': 'x',
+        'ext': 'mp4',
+    }
+    shard = os.path.dirname(ydl.prepare_filename(info, outtmpl=f"{directory}/x"))
+    return os.path.join(root, shard, os.path.basename(path))
+
+
+def migrate(root: str, index, layout: str = None, dry_run: bool = False, progress=None) -> dict:
+    """
+    Chuyển toàn bộ file của thư viện sang kiểu bố trí mới (đổi tên trong cùng ổ đĩa,
+    cập nhật chỉ mục, xóa thư mục con rỗng). Chạy lại an toàn: file đã đúng vị trí được bỏ qua.
+
+    Args:
+        index: Chỉ mục file đã tải (DownloadIndex), được đồng bộ với thư mục trước khi chuyển
+        progress: Hàm nhận (đường dẫn cũ, đường dẫn mới) sau mỗi file
+
+    Returns:
+        dict: Số file đã chuyển, đã đúng vị trí, bị bỏ qua do trùng tên và lỗi
+    """
+    layout = get_layout(layout)
+    root = os.path.realpath(os.path.abspath(root))
+    index.sync(root)
+    ydl = _template_ydl()
+    result = {'moved': 0, 'unchanged': 0, 'conflicts': 0, 'errors': 0}
+
+    for entry in index.list(root):
+        old_path = entry['path']
+        new_path = target_path(root, old_path, entry, layout, ydl)
+        if old_path == new_path:
+            result['unchanged'] += 1
+            continue
+        if os.path.exists(new_path):
+            result['conflicts'] += 1
+            continue
+        if not dry_run:
+            try:
+                os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                os.rename(old_path, new_path)
+            except OSError:
+                result['errors'] += 1
+                continue
+            index.rename(old_path, new_path)
+            prune_empty_dirs(os.path.dirname(old_path), root)
+        result['moved'] += 1
+        if progress:
+            progress(old_path, new_path)
+    return result
@@ -1,16 +1,32 @@
 import os
+import re
 import time
 import shutil
 import json
-import io
+import stat
 import zipfile
+import mimetypes
+import hashlib
+import threading
+from queue import Queue, Full
+from collections import OrderedDict
 from pathlib import Path
-from flask import Flask, request, jsonify, send_from_directory, render_template, send_file
-from TiktokCrawler.downloader import download_video, get_video_info, download_user_videos
+from urllib.parse import quote
+from flask import Flask, request, jsonify, send_file, render_template, Response, stream_with_context, abort
+from TiktokCrawler.downloader import download_video, get_video_info, download_user_videos, warm_up
+from TiktokCrawler.jobs import JobQueue, STATUS_FINISHED, STATUS_FAILED
+from TiktokCrawler.cache import get_info_cache, is_video_url
+from TiktokCrawler.export import RecordWriter, run_export, EXPORT_FORMATS
+from TiktokCrawler.index import get_download_index
+from TiktokCrawler.quota import get_disk_quota
+from TiktokCrawler.storage import iter_files, relative_path, resolve, prune_empty_dirs
+from TiktokCrawler.proxies import get_proxy_pool
+from TiktokCrawler.ratelimit import get_rate_limiter
+from TiktokCrawler.metrics import get_metrics
 
 app = Flask(__name__)
 
-# Disable caching completely
+# Disable caching for pages and API responses (videos in /downloads set their own cache headers)
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
 app.config['TEMPLATES_AUTO_RELOAD'] = True
 
@@ -19,12 +35,77 @@ DOWNLOADS_DIR = os.path.join(os.getcwd(), "downloads")
 if not os.path.exists(DOWNLOADS_DIR):
     os.makedirs(DOWNLOADS_DIR)
 
+# Thời gian trình duyệt/CDN được dùng lại video đã tải xong mà không hỏi lại server (giây);
+# sau đó chỉ cần kiểm tra ETag (304) thay vì tải lại cả file
+VIDEO_CACHE_MAX_AGE = int(os.environ.get('TIKTOK_CRAWLER_VIDEO_CACHE_MAX_AGE', str(30 * 24 * 3600)))
+
+# Giao việc gửi file video cho proxy phía trước thay vì worker gunicorn:
+# '' (gunicorn tự gửi), 'x-accel' (nginx X-Accel-Redirect), 'x-sendfile' (Apache/lighttpd X-Sendfile)
+SENDFILE_MODES = ('', 'x-accel', 'x-sendfile')
+SENDFILE_MODE = os.environ.get('TIKTOK_CRAWLER_SENDFILE', '').strip().lower()
+if SENDFILE_MODE not in SENDFILE_MODES:
+    raise ValueError(f"TIKTOK_CRAWLER_SENDFILE không hợp lệ: {SENDFILE_MODE} (hỗ trợ: x-accel, x-sendfile)")
+# Location internal của nginx trỏ tới thư mục downloads (chế độ x-accel)
+ACCEL_PREFIX = os.environ.get('TIKTOK_CRAWLER_ACCEL_PREFIX', '/protected-downloads/')
+app.config['USE_X_SENDFILE'] = SENDFILE_MODE == 'x-sendfile'
+# Proxy đọc file sau khi worker đã trả response: giữ đánh dấu đang phục vụ trong khoảng này (giây)
+OFFLOAD_LEASE_TTL = 60
+
+# Số video tải song song tối đa cho mỗi job tải theo user
+MAX_CONCURRENCY = int(os.environ.get('TIKTOK_CRAWLER_MAX_CONCURRENCY', '8'))
+
+# Thời gian tối đa của một kết nối SSE (giây), trình duyệt tự kết nối lại sau đó;
+# giới hạn để kết nối treo không giữ thread của worker gunicorn mãi mãi
+SSE_MAX_DURATION = int(os.environ.get('TIKTOK_CRAWLER_SSE_MAX_DURATION', '60'))
+# Số kết nối SSE mở cùng lúc tối đa của mỗi worker: mỗi kết nối giữ một thread gthread, phần thread
+# còn lại (--threads trừ giá trị này) luôn dành cho các endpoint khác. Vượt giới hạn thì trả 503 và
+# trình duyệt chuyển sang hỏi trạng thái job định kỳ
+SSE_MAX_STREAMS = int(os.environ.get('TIKTOK_CRAWLER_SSE_MAX_STREAMS', '8'))
+_sse_slots = threading.BoundedSemaphore(max(1, SSE_MAX_STREAMS))
+# Gửi comment giữ kết nối (giây) khi không có thay đổi, tránh proxy đóng kết nối
+SSE_HEARTBEAT = 15
+
+def _run_video_job(params, progress_callback):
+    """Thực thi job tải video đơn lẻ"""
+    return download_video(params['url'], params.get('proxy'), params['output_dir'], params.get('limit'),
+                          progress_callback=progress_callback, fast_path=params.get('fast_path'))
+
+def _run_user_job(params, progress_callback):
+    """Thực thi job tải video từ user"""
+    if is_video_url(params['url']):
+        # Job link video được xếp hàng với loại 'user' trước khi sửa cách phân loại URL
+        return _run_video_job(params, progress_callback)
+    return download_user_videos(params['url'], params.get('proxy'), params.get('limit'), params['output_dir'],
+                                progress_callback=progress_callback, concurrency=params.get('concurrency'),
+                                incremental=params.get('incremental', False),
+                                fast_path=params.get('fast_path'))
+
+# Hàng đợi job dùng chung giữa các worker gunicorn (lưu trong SQLite trên volume downloads)
+job_queue = JobQueue()
+job_queue.register('video', _run_video_job)
+job_queue.register('user', _run_user_job)
+
+# Khi chạy trực tiếp `python web/app.py`, các tiến trình hậu xử lý (spawn/forkserver) nạp lại
+# file này với tên __mp_main__: chỉ khởi động các việc nền trong tiến trình web
+if __name__ != '__mp_main__':
+    # Dò ffmpeg một lần khi khởi động worker thay vì mỗi lần tải
+    warm_up()
+
+    # Nhập thư viện có sẵn vào chỉ mục ở lần chạy đầu tiên (chỉ duyệt thư mục một lần)
+    get_download_index().ensure_synced(DOWNLOADS_DIR)
+
+    # Dọn dẹp nền giữ thư mục downloads trong hạn mức (TIKTOK_CRAWLER_QUOTA_BYTES / TIKTOK_CRAWLER_QUOTA_FILES)
+    get_disk_quota().start_janitor(DOWNLOADS_DIR)
+
+    job_queue.start()
+
 @app.after_request
 def after_request(response):
-    """Disable caching for all responses"""
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate, public, max-age=0'
-    response.headers['Expires'] = '0'
-    response.headers['Pragma'] = 'no-cache'
+    """Disable caching for pages and API responses (videos keep their ETag/Cache-Control)"""
+    if request.endpoint != 'download_file':
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate, public, max-age=0'
+        response.headers['Expires'] = '0'
+        response.headers['Pragma'] = 'no-cache'
     # Add CORS headers
     response.headers['Access-Control-Allow-Origin'] = '*'
     response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
@@ -36,10 +117,97 @@ def index():
     """Serve the main HTML page"""
     return render_template('index.html')
 
+def _file_url(path):
+    """URL tải của một file trong thư mục downloads (gồm thư mục con), None nếu file nằm ngoài"""
+    relative = relative_path(path, DOWNLOADS_DIR)
+    return f'/downloads/{quote(relative)}' if relative else None
+
+def _file_etag(relative, stats):
+    """ETag mạnh của một file video: đổi khi file được tải lại/ghi đè (đường dẫn, kích thước, mtime)"""
+    key = f'{relative}:{stats.st_size}:{stats.st_mtime_ns}'
+    return hashlib.sha1(key.encode()).hexdigest()[:32]
+
+def _accel_response(path, relative, stats, etag, max_age):
+    """
+    Response rỗng có X-Accel-Redirect: nginx tự gửi file (kể cả Range) từ location internal.
+    Request có điều kiện vẫn được trả lời 304 ngay tại đây.
+    """
+    response = Response(mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+    response.headers['X-Accel-Redirect'] = ACCEL_PREFIX.rstrip('/') + '/' + quote(relative)
+    response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(os.path.basename(path))}"
+    response.last_modified = stats.st_mtime
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    if not max_age:
+        response.cache_control.no_cache = True
+    response = response.make_conditional(request)
+    if response.status_code == 304:
+        response.headers.pop('X-Accel-Redirect', None)
+    return response
+
 @app.route('/downloads/<path:filename>')
 def download_file(filename):
-    """Serve downloaded files"""
-    return send_from_directory(DOWNLOADS_DIR, filename, as_attachment=True)
+    """
+    Serve downloaded files (đường dẫn tương đối, gồm thư mục con của kiểu bố trí thư mục)
+
+    Video đã tải xong (có trong chỉ mục) không đổi nội dung: trả về ETag mạnh, Cache-Control dài hạn,
+    hỗ trợ request có điều kiện (304) và Range (tua video không phải tải lại từ đầu).
+    File chưa hoàn tất vẫn có ETag nhưng client phải kiểm tra lại mỗi lần.
+    """
+    try:
+        path = resolve(DOWNLOADS_DIR, filename)
+        stats = os.stat(path)
+    except (ValueError, OSError):
+        abort(404)
+    if not stat.S_ISREG(stats.st_mode):
+        abort(404)
+
+    relative = relative_path(path, DOWNLOADS_DIR)
+    etag = _file_etag(relative, stats)
+    max_age = VIDEO_CACHE_MAX_AGE if get_download_index().get(path) else 0
+    if SENDFILE_MODE == 'x-accel':
+        response = _accel_response(path, relative, stats, etag, max_age)
+    else:
+        # Chế độ x-sendfile: send_file chỉ gắn header X-Sendfile (USE_X_SENDFILE), proxy gửi nội dung
+        response = send_file(path, as_attachment=True, etag=etag, max_age=max_age, conditional=True)
+
+    # Ghi nhận lần phục vụ (thứ tự xóa LRU khi vượt hạn mức, kể cả khi client dùng bản cache - 304)
+    # và không cho janitor xóa file trong lúc đang gửi cho client
+    quota = get_disk_quota()
+    try:
+        quota.touch(path)
+        if response.status_code == 304:
+            pass
+        elif SENDFILE_MODE:
+            # Không biết khi nào proxy gửi xong: đánh dấu tự hết hạn
+            quota.acquire(path, ttl=OFFLOAD_LEASE_TTL)
+        else:
+            lease = quota.acquire(path)
+            _call_on_close(response, lambda: quota.release(lease))
+    except Exception as e:
+        app.logger.warning('Không thể ghi nhận lần phục vụ %s: %s', filename, e)
+    return response
+
+def _call_on_close(response, callback):
+    """
+    Gọi callback khi server đã gửi xong (hoặc bỏ dở) response.
+    Response file của send_file được trả thẳng cho server (direct_passthrough, để gunicorn dùng sendfile)
+    nên call_on_close của Flask không chạy: gắn callback vào close() của chính file wrapper.
+    """
+    body = response.response
+    if not (response.direct_passthrough and hasattr(body, 'close')):
+        response.call_on_close(callback)
+        return
+    close = body.close
+
+    def close_then_callback():
+        try:
+            close()
+        finally:
+            callback()
+
+    body.close = close_then_callback
 
 @app.route('/api/download', methods=['POST'])
 def api_download():
@@ -55,6 +223,9 @@ def api_download():
     proxy = data.get('proxy', '').strip() or None
     custom_dir = data.get('customDir', '').strip()
     limit = data.get('limit')
+    concurrency = data.get('concurrency')
+    incremental = bool(data.get('incremental', False))
+    fast_path = data.get('fastPath')
     
     if not url:
         return jsonify({
@@ -78,26 +249,40 @@ def api_download():
                     'message': 'Số lượng video không hợp lệ'
                 })
 
+        # Số video tải song song (giới hạn để không làm nghẽn worker)
+        if concurrency:
+            try:
+                concurrency = min(int(concurrency), MAX_CONCURRENCY)
+                if concurrency < 1:
+                    return jsonify({
+                        'success': False,
+                        'message': 'Số luồng tải phải lớn hơn 0'
+                    })
+            except ValueError:
+                return jsonify({
+                    'success': False,
+                    'message': 'Số luồng tải không hợp lệ'
+                })
+
         # Sử dụng thư mục tùy chỉnh nếu được cung cấp
         output_dir = DOWNLOADS_DIR
 
-        # Kiểm tra nếu là URL user hay video đơn lẻ
-        if '@' in url and not url.endswith('/video/'):
-            success, message = download_user_videos(url, proxy, limit, output_dir)
+        # Kiểm tra nếu là URL user hay video đơn lẻ: link video (/@user/video/<id>) cũng chứa '@'
+        # nhưng phải đi qua download_video để được gộp yêu cầu trùng và dùng cache thông tin
+        if '@' in url and not is_video_url(url):
+            kind = 'user'
         else:
-            success, message = download_video(url, proxy, output_dir, limit)
+            kind = 'video'
 
-        if success:
-            return jsonify({
-                'success': True,
-                'message': message,
-                'localPath': output_dir
-            })
-        else:
-            return jsonify({
-                'success': False,
-                'message': message
-            })
+        return _submit_job(kind, {
+            'url': url,
+            'proxy': proxy,
+            'limit': limit,
+            'concurrency': concurrency,
+            'incremental': incremental,
+            'fast_path': fast_path,
+            'output_dir': output_dir
+        })
 
     except Exception as e:
         return jsonify({
@@ -137,6 +322,127 @@ def api_info():
             'message': f'Lỗi: {str(e)}'
         })
 
+@app.route('/api/info-cache')
+def api_info_cache():
+    """API endpoint để xem số liệu cache thông tin video (hit/miss, kích thước)"""
+    try:
+        return jsonify({
+            'success': True,
+            'stats': get_info_cache().stats()
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'Lỗi: {str(e)}'
+        })
+
+@app.route('/api/proxies')
+def api_proxies():
+    """API endpoint để xem tình trạng nhóm proxy (điểm, tỷ lệ thành công, độ trễ, tạm ngưng)"""
+    try:
+        return jsonify({
+            'success': True,
+            'proxies': get_proxy_pool().stats()
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'Lỗi: {str(e)}'
+        })
+
+@app.route('/api/proxies/reset', methods=['POST'])
+def api_proxies_reset():
+    """API endpoint để xóa số liệu và mở lại toàn bộ proxy đang tạm ngưng"""
+    try:
+        get_proxy_pool().reset()
+        return jsonify({
+            'success': True,
+            'message': 'Đã đặt lại trạng thái nhóm proxy'
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'Lỗi: {str(e)}'
+        })
+
+@app.route('/api/rate-limits')
+def api_rate_limits():
+    """API endpoint để xem tốc độ hiện tại và trạng thái tạm dừng theo từng host"""
+    try:
+        return jsonify({
+            'success': True,
+            'stats': get_rate_limiter().stats()
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'Lỗi: {str(e)}'
+        })
+
+@app.route('/api/storage')
+def api_storage():
+    """API endpoint để xem dung lượng đã dùng, hạn mức và số video đã bị xóa do vượt hạn mức"""
+    try:
+        return jsonify({
+            'success': True,
+            'stats': get_disk_quota().stats(DOWNLOADS_DIR)
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'Lỗi: {str(e)}'
+        })
+
+@app.route('/api/storage/enforce', methods=['POST'])
+def api_storage_enforce():
+    """API endpoint để chạy ngay một lượt dọn dẹp theo hạn mức (không đợi janitor)"""
+    try:
+        files, freed = get_disk_quota().enforce(DOWNLOADS_DIR)
+        return jsonify({
+            'success': True,
+            'message': f'Đã xóa {files} file ({_human_readable_size(freed)})',
+            'stats': get_disk_quota().stats(DOWNLOADS_DIR)
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'Lỗi: {str(e)}'
+        })
+
+@app.route('/metrics')
+def metrics():
+    """Số liệu theo định dạng Prometheus, cộng dồn từ mọi worker gunicorn"""
+    job_stats = job_queue.stats()
+    cache_stats = get_info_cache().stats()
+    proxy_stats = get_proxy_pool().stats()
+    storage_stats = get_disk_quota().stats(DOWNLOADS_DIR)
+    gauges = [
+        ('jobs', "Số job theo trạng thái", 'gauge',
+         [({'status': status}, count) for status, count in sorted(job_stats.items())]),
+        ('jobs_in_flight', "Số job đang chạy", 'gauge', [({}, job_stats.get('running', 0))]),
+        ('jobs_queued', "Số job đang chờ", 'gauge', [({}, job_stats.get('queued', 0))]),
+        ('info_cache_lookups_total', "Số lần tra cứu cache thông tin video theo kết quả", 'counter',
+         [({'result': name}, cache_stats[name]) for name in ('hits', 'negative_hits', 'misses')]),
+        ('info_cache_evictions_total', "Số mục cache bị loại bỏ", 'counter', [({}, cache_stats['evictions'])]),
+        ('info_cache_entries', "Số mục trong cache thông tin video", 'gauge', [({}, cache_stats['size'])]),
+        ('proxies', "Số proxy trong nhóm theo trạng thái", 'gauge', [
+            ({'state': 'available'}, sum(1 for p in proxy_stats if p['available'])),
+            ({'state': 'cooldown'}, sum(1 for p in proxy_stats if not p['available'])),
+        ]),
+        ('storage_used_bytes', "Dung lượng video trong thư mục downloads", 'gauge',
+         [({}, storage_stats['used_bytes'])]),
+        ('storage_files', "Số video trong thư mục downloads", 'gauge', [({}, storage_stats['used_files'])]),
+        ('storage_quota_bytes', "Hạn mức dung lượng của thư mục downloads (0 = không giới hạn)", 'gauge',
+         [({}, storage_stats['max_bytes'] or 0)]),
+        ('storage_reserved_bytes', "Dung lượng đang giữ chỗ cho các lần tải", 'gauge',
+         [({}, storage_stats['reserved_bytes'])]),
+        ('storage_evicted_files_total', "Số video đã bị xóa do vượt hạn mức", 'counter',
+         [({}, storage_stats['evicted_files'])]),
+        ('storage_evicted_bytes_total', "Dung lượng đã giải phóng do vượt hạn mức", 'counter',
+         [({}, storage_stats['evicted_bytes'])]),
+    ]
+    return Response(get_metrics().render(gauges), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/user-videos', methods=['POST'])
 def api_user_videos():
     """API endpoint để tải video từ user"""
@@ -150,6 +456,9 @@ def api_user_videos():
     url = data.get('url', '').strip()
     proxy = data.get('proxy', '').strip() or None
     limit = data.get('limit')
+    concurrency = data.get('concurrency')
+    incremental = bool(data.get('incremental', False))
+    fast_path = data.get('fastPath')
     custom_dir = data.get('customDir', '').strip()
     
     if not url:
@@ -174,58 +483,395 @@ def api_user_videos():
                     'message': 'Số lượng video không hợp lệ'
                 })
 
+        # Số video tải song song (giới hạn để không làm nghẽn worker)
+        if concurrency:
+            try:
+                concurrency = min(int(concurrency), MAX_CONCURRENCY)
+                if concurrency < 1:
+                    return jsonify({
+                        'success': False,
+                        'message': 'Số luồng tải phải lớn hơn 0'
+                    })
+            except ValueError:
+                return jsonify({
+                    'success': False,
+                    'message': 'Số luồng tải không hợp lệ'
+                })
+
         # Sử dụng thư mục tùy chỉnh nếu được cung cấp
         output_dir = custom_dir if custom_dir else DOWNLOADS_DIR
 
-        success, message = download_user_videos(url, proxy, limit, output_dir)
+        return _submit_job('user', {
+            'url': url,
+            'proxy': proxy,
+            'limit': limit,
+            'concurrency': concurrency,
+            'incremental': incremental,
+            'fast_path': fast_path,
+            'output_dir': output_dir
+        })
 
-        if success:
-            # Lấy danh sách file đã tải
-            files = []
-            if os.path.exists(output_dir):
-                files = [f for f in os.listdir(output_dir) if f.endswith('.mp4')]
-            
-            return jsonify({
-                'success': True,
-                'message': message,
-                'download_location': output_dir,
-                'files': files
-            })
-        else:
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'Lỗi: {str(e)}'
+        })
+
+# Số dòng chờ gửi tối đa khi client đọc chậm (xuất metadata), giữ bộ nhớ cố định
+EXPORT_QUEUE_SIZE = 1000
+
+class _ExportCancelled(Exception):
+    """Client đã ngắt kết nối trong lúc xuất metadata"""
+
+class _QueueOutput:
+    """Đích ghi của RecordWriter: đưa từng dòng vào hàng đợi có giới hạn cho response stream"""
+
+    def __init__(self, queue, cancelled):
+        self._queue = queue
+        self._cancelled = cancelled
+
+    def write(self, text):
+        # Hàng đợi đầy thì chờ client đọc bớt (không dồn cả profile vào bộ nhớ)
+        while True:
+            if self._cancelled.is_set():
+                raise _ExportCancelled()
+            try:
+                self._queue.put(text, timeout=1)
+                return len(text)
+            except Full:
+                continue
+
+@app.route('/api/export', methods=['POST'])
+def api_export():
+    """
+    API endpoint để xuất metadata video (lượt xem/thích/bình luận...) của một hoặc nhiều profile,
+    không tải media. Kết quả được stream dạng JSON lines hoặc CSV ngay khi từng trang danh sách được lấy về.
+
+    Body: {"urls": [...] hoặc "url": "...", "format": "jsonl" | "csv", "limit": số video mỗi profile,
+           "full": mở trang video khi danh sách không có số liệu thống kê}
+    """
+    data = request.get_json()
+    if not data:
+        return jsonify({
+            'success': False,
+            'message': 'Dữ liệu không hợp lệ'
+        }), 400
+
+    urls = [url.strip() for url in (data.get('urls') or [data.get('url') or '']) if url and url.strip()]
+    fmt = data.get('format') or 'jsonl'
+    proxy = (data.get('proxy') or '').strip() or None
+    full = bool(data.get('full', False))
+    if not urls:
+        return jsonify({
+            'success': False,
+            'message': 'URL không được để trống'
+        }), 400
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({
+            'success': False,
+            'message': f'Định dạng không hợp lệ: {fmt} (hỗ trợ: {", ".join(EXPORT_FORMATS)})'
+        }), 400
+    limit = data.get('limit')
+    if limit:
+        try:
+            limit = int(limit)
+            if limit < 1:
+                raise ValueError()
+        except (TypeError, ValueError):
             return jsonify({
                 'success': False,
-                'message': message
-            })
+                'message': 'Số lượng video không hợp lệ'
+            }), 400
+
+    queue = Queue(maxsize=EXPORT_QUEUE_SIZE)
+    cancelled = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            writer = RecordWriter(_QueueOutput(queue, cancelled), fmt)
+            summary = run_export(urls, writer, proxy=proxy, limit=limit or None, full=full, cancelled=cancelled)
+            app.logger.info('Đã xuất %s video từ %s profile (%s bản ghi/giây, %s profile lỗi)', summary['records'],
+                            summary['profiles'], summary['records_per_second'], summary['failed'])
+        except _ExportCancelled:
+            pass
+        except Exception as e:
+            app.logger.error('Lỗi khi xuất metadata: %s', e)
+        finally:
+            while not cancelled.is_set():
+                try:
+                    queue.put(done, timeout=1)
+                    break
+                except Full:
+                    continue
+
+    def generate():
+        producer = threading.Thread(target=produce, name="metadata-export", daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = queue.get()
+                if item is done:
+                    return
+                # Gom các dòng đang chờ thành một khối để giảm số lần ghi ra socket
+                chunks = [item]
+                while not queue.empty() and len(chunks) < 100:
+                    item = queue.get_nowait()
+                    if item is done:
+                        yield ''.join(chunks)
+                        return
+                    chunks.append(item)
+                yield ''.join(chunks)
+        finally:
+            cancelled.set()
+
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="export.{fmt}"'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def _submit_job(kind, params):
+    """Đưa job vào hàng đợi và trả về ID job ngay lập tức"""
+    success, result = job_queue.submit(kind, params)
+    if not success:
+        return jsonify({
+            'success': False,
+            'message': result
+        }), 503
+
+    return jsonify({
+        'success': True,
+        'message': 'Đã đưa yêu cầu vào hàng đợi',
+        'job_id': result,
+        'status_url': f'/api/jobs/{result}',
+        'events_url': f'/api/jobs/{result}/events',
+        'download_location': params['output_dir']
+    }), 202
+
+def _job_to_json(job):
+    """Bổ sung URL tải cho các file nằm trong thư mục downloads"""
+    files = []
+    for path in job['files']:
+        entry = {'name': os.path.basename(path), 'path': path}
+        url = _file_url(path)
+        if url:
+            entry['url'] = url
+        files.append(entry)
+    job['files'] = files
+    return job
+
+@app.route('/api/jobs/<job_id>')
+def api_job_status(job_id):
+    """API endpoint để xem trạng thái, tiến trình và các file của một job"""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({
+            'success': False,
+            'message': f'Không tìm thấy job {job_id}'
+        }), 404
+
+    return jsonify({
+        'success': True,
+        'job': _job_to_json(job)
+    })
+
+def _sse(event, data, event_id=None):
+    """Một sự kiện theo định dạng Server-Sent Events"""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data, ensure_ascii=False)}')
+    return '\n'.join(lines) + '\n\n'
+
+@app.route('/api/jobs/<job_id>/events')
+def api_job_events(job_id):
+    """
+    Stream tiến trình của một job bằng Server-Sent Events (thay cho việc hỏi trạng thái liên tục)
+
+    Sự kiện:
+        progress: Thông tin job mỗi khi trạng thái/tiến trình thay đổi (byte đã tải, tốc độ, ETA,
+            video đang tải của profile, bước hậu xử lý)
+        done: Thông tin job khi đã kết thúc, sau đó server đóng stream
+    """
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({
+            'success': False,
+            'message': f'Không tìm thấy job {job_id}'
+        }), 404
+
+    if not _sse_slots.acquire(blocking=False):
+        return jsonify({
+            'success': False,
+            'message': 'Quá nhiều kết nối theo dõi job, vui lòng dùng status_url'
+        }), 503, {'Retry-After': '5'}
+
+    def generate():
+        # Báo trình duyệt đợi 2 giây trước khi kết nối lại khi stream bị ngắt
+        yield 'retry: 2000\n\n'
+        seq = 0
+        idle_since = time.monotonic()
+        for job in job_queue.watch(job_id, timeout=SSE_MAX_DURATION):
+            if job is None:
+                if time.monotonic() - idle_since >= SSE_HEARTBEAT:
+                    idle_since = time.monotonic()
+                    yield ': keepalive\n\n'
+                continue
+            seq += 1
+            idle_since = time.monotonic()
+            done = job['status'] in (STATUS_FINISHED, STATUS_FAILED)
+            yield _sse('done' if done else 'progress', _job_to_json(job), seq)
+
+    try:
+        response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+        # Không để nginx gom dữ liệu, sự kiện phải tới client ngay
+        response.headers['X-Accel-Buffering'] = 'no'
+        _call_on_close(response, _sse_slots.release)
+    except Exception:
+        _sse_slots.release()
+        raise
+    return response
+
+@app.route('/api/jobs')
+def api_list_jobs():
+    """API endpoint để liệt kê các job gần đây"""
+    status = request.args.get('status') or None
+    try:
+        limit = min(int(request.args.get('limit', 50)), 500)
+    except ValueError:
+        limit = 50
+
+    return jsonify({
+        'success': True,
+        'stats': job_queue.stats(),
+        'jobs': [_job_to_json(job) for job in job_queue.list(limit=limit, status=status)]
+    })
+
+# Số file mỗi trang mặc định/tối đa của /api/list-downloads
+LIST_PAGE_SIZE = 100
+LIST_MAX_PAGE_SIZE = 1000
+# Số trang danh sách giữ trong cache của mỗi worker
+LIST_CACHE_SIZE = 256
+
+_list_cache = OrderedDict()
+_list_cache_version = None
+_list_cache_lock = threading.Lock()
+
+def _list_query():
+    """Đọc tham số phân trang/sắp xếp/lọc của /api/list-downloads (ValueError nếu không hợp lệ)"""
+    def number(name, cast=float):
+        value = request.args.get(name)
+        return cast(value) if value not in (None, '') else None
 
+    order = request.args.get('order', 'desc')
+    if order not in ('asc', 'desc'):
+        raise ValueError(f"Thứ tự sắp xếp không hợp lệ: {order}")
+    limit = number('limit', int) or LIST_PAGE_SIZE
+    if limit < 1:
+        raise ValueError("limit phải lớn hơn 0")
+    return {
+        'sort': request.args.get('sort', 'date'),
+        'descending': order == 'desc',
+        'limit': min(limit, LIST_MAX_PAGE_SIZE),
+        'cursor': request.args.get('cursor') or None,
+        'uploader': request.args.get('uploader') or None,
+        'prefix': request.args.get('prefix') or None,
+        'since': number('since'),
+        'until': number('until'),
+        'min_size': number('min_size', int),
+        'max_size': number('max_size', int),
+    }
+
+def _list_page(version, query):
+    """
+    Một trang danh sách file, lấy từ cache nếu chỉ mục chưa thay đổi.
+    Chỉ mục tăng phiên bản mỗi khi có file được tải/xóa (từ bất kỳ tiến trình nào),
+    nên cache tự mất hiệu lực mà không cần dựng lại danh sách ở mỗi request.
+    """
+    global _list_cache_version
+    key = json.dumps(query, sort_keys=True)
+    with _list_cache_lock:
+        if _list_cache_version != version:
+            _list_cache.clear()
+            _list_cache_version = version
+        page = _list_cache.get(key)
+        if page is not None:
+            _list_cache.move_to_end(key)
+            return page
+
+    result = get_download_index().page(DOWNLOADS_DIR, **query)
+    page = {
+        'files': [{
+            'name': entry['filename'],
+            'file': relative_path(entry['path'], DOWNLOADS_DIR),
+            'size': _human_readable_size(entry['size']),
+            'bytes': entry['size'],
+            'date': time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['downloaded_at'])),
+            'timestamp': entry['downloaded_at'],
+            'video_id': entry['video_id'],
+            'uploader': entry['uploader'],
+            'duration': entry['duration'],
+            'url': _file_url(entry['path'])
+        } for entry in result['files']],
+        'next_cursor': result['next_cursor'],
+        'total': result['total'],
+    }
+
+    with _list_cache_lock:
+        if _list_cache_version == version:
+            _list_cache[key] = page
+            while len(_list_cache) > LIST_CACHE_SIZE:
+                _list_cache.popitem(last=False)
+    return page
+
+@app.route('/api/list-downloads')
+def api_list_downloads():
+    """
+    API endpoint để liệt kê các file đã tải (truy vấn chỉ mục, không duyệt thư mục)
+
+    Query:
+        sort: date | size | name (mặc định date), order: asc | desc (mặc định desc)
+        limit: Số file mỗi trang, cursor: next_cursor của trang trước
+        uploader, prefix: Lọc theo tác giả / tên file bắt đầu bằng
+        since, until: Lọc theo thời điểm tải (timestamp), min_size, max_size: theo dung lượng (byte)
+    """
+    try:
+        query = _list_query()
+        version = get_download_index().version()
+        etag = f'{version}-{hashlib.sha1(json.dumps(query, sort_keys=True).encode()).hexdigest()[:16]}'
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        page = _list_page(version, query)
+        response = jsonify({
+            'success': True,
+            **page
+        })
+        response.set_etag(etag)
+        return response
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': f'Tham số không hợp lệ: {str(e)}'
+        }), 400
     except Exception as e:
         return jsonify({
             'success': False,
             'message': f'Lỗi: {str(e)}'
         })
 
-@app.route('/api/list-downloads')
-def api_list_downloads():
-    """API endpoint để liệt kê các file đã tải"""
+@app.route('/api/reindex', methods=['POST'])
+def api_reindex():
+    """API endpoint để đồng bộ lại chỉ mục với thư mục downloads"""
     try:
-        files = []
-        if os.path.exists(DOWNLOADS_DIR):
-            for filename in os.listdir(DOWNLOADS_DIR):
-                file_path = os.path.join(DOWNLOADS_DIR, filename)
-                if os.path.isfile(file_path):
-                    stats = os.stat(file_path)
-                    files.append({
-                        'name': filename,
-                        'size': _human_readable_size(stats.st_size),
-                        'date': time.strftime('%Y-%m-%d %H:%M', time.localtime(stats.st_mtime)),
-                        'url': f'/downloads/{filename}'
-                    })
-        
-        # Sắp xếp theo thời gian mới nhất
-        files.sort(key=lambda x: x['date'], reverse=True)
-        
+        count = get_download_index().sync(DOWNLOADS_DIR)
         return jsonify({
             'success': True,
-            'files': files
+            'message': f'Đã đồng bộ chỉ mục: {count} file'
         })
     except Exception as e:
         return jsonify({
@@ -243,6 +889,7 @@ def api_delete_file():
             'message': 'Dữ liệu không hợp lệ'
         })
 
+    # Đường dẫn tương đối trong thư mục downloads (trường 'file' của /api/list-downloads)
     filename = data.get('filename')
     if not filename:
         return jsonify({
@@ -251,9 +898,17 @@ def api_delete_file():
         })
 
     try:
-        file_path = os.path.join(DOWNLOADS_DIR, filename)
-        if os.path.exists(file_path):
+        try:
+            file_path = resolve(DOWNLOADS_DIR, filename)
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'message': str(e)
+            }), 400
+        if os.path.isfile(file_path):
             os.remove(file_path)
+            get_download_index().remove(file_path)
+            prune_empty_dirs(os.path.dirname(file_path), DOWNLOADS_DIR)
             return jsonify({
                 'success': True,
                 'message': f'Đã xóa file {filename}'
@@ -274,10 +929,13 @@ def api_delete_all():
     """API endpoint để xóa tất cả file"""
     try:
         if os.path.exists(DOWNLOADS_DIR):
-            for filename in os.listdir(DOWNLOADS_DIR):
-                file_path = os.path.join(DOWNLOADS_DIR, filename)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
+            directories = set()
+            for entry in list(iter_files(DOWNLOADS_DIR)):
+                os.remove(entry.path)
+                directories.add(os.path.dirname(entry.path))
+            for directory in sorted(directories, reverse=True):
+                prune_empty_dirs(directory, DOWNLOADS_DIR)
+        get_download_index().remove_directory(DOWNLOADS_DIR)
         
         return jsonify({
             'success': True,
@@ -295,10 +953,10 @@ def api_cleanup_non_mp4():
     try:
         if os.path.exists(DOWNLOADS_DIR):
             deleted_count = 0
-            for filename in os.listdir(DOWNLOADS_DIR):
-                file_path = os.path.join(DOWNLOADS_DIR, filename)
-                if os.path.isfile(file_path) and not filename.lower().endswith('.mp4'):
-                    os.remove(file_path)
+            for entry in list(iter_files(DOWNLOADS_DIR)):
+                if not entry.name.lower().endswith('.mp4'):
+                    os.remove(entry.path)
+                    get_download_index().remove(entry.path)
                     deleted_count += 1
         
         return jsonify({
@@ -311,18 +969,107 @@ def api_cleanup_non_mp4():
             'message': f'Lỗi: {str(e)}'
         })
 
+# Kích thước mỗi khối dữ liệu khi stream file ZIP
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+class _ZipStream:
+    """Đích ghi không seek được cho zipfile, gom dữ liệu để trả dần cho client"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def _iter_zip(paths):
+    """
+    Sinh file ZIP theo từng khối khi client đọc (ZIP_STORED, không nén lại video),
+    bộ nhớ dùng không phụ thuộc kích thước file ZIP.
+
+    Các file được đánh dấu đang phục vụ trong suốt lúc stream để janitor không xóa mất;
+    file đã biến mất trước khi kịp mở thì bị bỏ qua (ZIP vẫn hợp lệ).
+    """
+    quota = get_disk_quota()
+    try:
+        leases = quota.acquire_many(paths)
+    except Exception as e:
+        app.logger.warning('Không thể đánh dấu các file của ZIP đang phục vụ: %s', e)
+        leases = []
+    try:
+        stream = _ZipStream()
+        with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED, allowZip64=True) as zipf:
+            for path in paths:
+                try:
+                    src = open(path, 'rb')
+                except OSError:
+                    continue
+                with src:
+                    # Thông tin lấy từ file đã mở, không stat lại theo đường dẫn
+                    stats = os.fstat(src.fileno())
+                    # Giữ cấu trúc thư mục (shard) trong ZIP: file trùng tên ở các thư mục khác nhau không đè nhau
+                    arcname = relative_path(path, DOWNLOADS_DIR) or os.path.basename(path)
+                    zinfo = zipfile.ZipInfo(arcname, time.localtime(stats.st_mtime)[:6])
+                    zinfo.external_attr = (stats.st_mode & 0xFFFF) << 16
+                    zinfo.compress_type = zipfile.ZIP_STORED
+                    zinfo.file_size = stats.st_size
+                    with zipf.open(zinfo, 'w') as dest:
+                        while True:
+                            chunk = src.read(ZIP_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            dest.write(chunk)
+                            yield stream.drain()
+                yield stream.drain()
+        yield stream.drain()
+    finally:
+        if leases:
+            try:
+                quota.release_many(leases)
+            except Exception as e:
+                app.logger.warning('Không thể bỏ đánh dấu các file của ZIP: %s', e)
+
 @app.route("/download-zip")
 def download_zip():
-    """Tải tất cả file dưới dạng ZIP"""
-    memory_file = io.BytesIO()
-    with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for filename in os.listdir(DOWNLOADS_DIR):
-            file_path = os.path.join(DOWNLOADS_DIR, filename)
-            if os.path.isfile(file_path) and filename.lower().endswith('.mp4'):
-                zipf.write(file_path, arcname=filename)
-    memory_file.seek(0)
-    return send_file(memory_file, mimetype='application/zip',
-                     as_attachment=True, download_name='videos.zip')
+    """
+    Tải file dưới dạng ZIP (stream, không tạo file ZIP trong bộ nhớ)
+
+    Query:
+        files: Đường dẫn tương đối so với thư mục downloads (trường 'file' của /api/list-downloads,
+            có thể lặp lại), mặc định tất cả. Tên file trùng nhau ở các shard khác nhau không bị lẫn
+        uploader: Chỉ tải video của một tác giả
+    """
+    selected = {f.replace('\\', '/').strip('/') for f in request.args.getlist('files') if f.strip()}
+    uploader = request.args.get('uploader')
+
+    paths = []
+    for entry in get_download_index().list(DOWNLOADS_DIR):
+        if not entry['filename'].lower().endswith('.mp4'):
+            continue
+        if selected and relative_path(entry['path'], DOWNLOADS_DIR) not in selected:
+            continue
+        if uploader and entry['uploader'] != uploader:
+            continue
+        paths.append(entry['path'])
+
+    if not paths:
+        return jsonify({
+            'success': False,
+            'message': 'Không có file nào để tải'
+        }), 404
+
+    download_name = f"{re.sub(r'[^A-Za-z0-9_.-]', '_', uploader)}.zip" if uploader else 'videos.zip'
+    response = Response(stream_with_context(_iter_zip(paths)), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+    return response
 
 def _human_readable_size(size_bytes):
     """Chuyển đổi kích thước file sang định dạng dễ đọc"""